@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from client_core import ClientCore
+from protocol import PROTOCOL_VERSION
+
+# Load generator for the server: N simulated drawers join one room and replay pen traces the way the
+# GUI client sends them (STROKE chunks every STROKE_FLUSH_POINTS points or STROKE_FLUSH_MS, less often
+# while the server paces them, then STROKEEND), while every one of them also receives what the others
+# draw. Each client count is measured for a while and the results are printed as JSON so runs can be
+# compared:
+#
+#   python benchmark.py --clients 1,2,4,8,16 --duration 10 --mode async --output results.json
+#
+# Without --server a local server is started with a throwaway self-signed certificate (needs the
+# openssl command), with --server host:port --certificate cert.pem an already running one is used.
+# Traces are generated from a fixed seed unless --traces points at a JSON file of strokes, each a
+# list of [x, y, milliseconds since the stroke started] points. --join-burst N also times N clients
+# joining at once and then reconnecting with their TLS sessions.
+
+SAMPLE_RATE = 120       # pen points per second of the synthetic traces, about what a mouse reports
+STROKE_POINTS = (20, 150)   # shortest and longest synthetic stroke in points
+STROKE_PAUSE_MS = (100, 400)    # pause between two strokes of one drawer
+BOARD_SIZE = 2000       # synthetic strokes start anywhere in a square this big
+DRAIN_TIMEOUT = 5       # seconds to wait for the last ops to arrive after the drawers stop
+SERVER_SCRIPT = """
+import sys, ssl_server
+ssl_server.PORT = int(sys.argv[1])
+ssl_server.CERTFILE_PATH, ssl_server.KEYFILE_PATH = sys.argv[2], sys.argv[3]
+ssl_server.SERVER_MODE = sys.argv[4]
+ssl_server.main()
+"""
+
+#func to make one synthetic pen stroke: a curve with smoothly changing direction and speed, as
+# (x, y, ms) points
+def synthetic_stroke(rng):
+    x, y = rng.uniform(0, BOARD_SIZE), rng.uniform(0, BOARD_SIZE)
+    heading = rng.uniform(0, 2 * math.pi)
+    turn = rng.uniform(-0.1, 0.1)
+    points = []
+    for index in range(rng.randint(*STROKE_POINTS)):
+        speed = 2 + 3 * abs(math.sin(index / 15))
+        turn = max(-0.2, min(0.2, turn + rng.uniform(-0.03, 0.03)))
+        heading += turn
+        x += speed * math.cos(heading)
+        y += speed * math.sin(heading)
+        points.append((round(x), round(y), index * 1000 / SAMPLE_RATE))
+    return points
+
+def load_traces(path):
+    with open(path) as f:
+        return [[tuple(point) for point in stroke] for stroke in json.load(f)]
+
+#func to get the value below which the given fraction of the sorted values fall (nearest rank)
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+# What one run measures, shared by all its drawers. Chunks are numbered per stroke in the order they
+# are sent, receivers count the chunks of each stroke they get to know which send time to look up
+class Recorder:
+    def __init__(self):
+        self.sent_at = {}   # (stroke id, chunk number) -> time it was sent
+        self.latencies = []
+        self.ops_sent = 0
+        self.ops_received = 0
+        self.chunks_sent = 0
+        self.lock = threading.Lock()
+
+    def sent(self, ops, stroke_id, chunk):
+        with self.lock:
+            if chunk is not None:
+                self.sent_at[(stroke_id, chunk)] = time.perf_counter()
+                self.chunks_sent += 1
+            self.ops_sent += len(ops)
+
+    #func to make the on_ops callback of one receiving client
+    def receiver(self):
+        chunks = {}     # stroke id -> chunks of it received so far
+
+        def on_ops(ops):
+            now = time.perf_counter()
+            with self.lock:
+                self.ops_received += len(ops)
+                for op in ops:
+                    if op[0] != "STROKE":
+                        continue
+                    chunk = chunks.get(op[1], 0)
+                    chunks[op[1]] = chunk + 1
+                    sent_at = self.sent_at.get((op[1], chunk))
+                    if sent_at is not None:
+                        self.latencies.append(now - sent_at)
+        return on_ops
+
+# One simulated user: replays strokes in real time, chunked like the GUI client does
+class Drawer:
+    def __init__(self, core, recorder, strokes, rng):
+        self.core = core
+        self.recorder = recorder
+        self.strokes = strokes
+        self.rng = rng
+
+    def send(self, ops, stroke_id=None, chunk=None):
+        self.recorder.sent(ops, stroke_id, chunk)
+        self.core.send_ops(ops)
+
+    def run(self, deadline):
+        while time.perf_counter() < deadline:
+            stroke = self.rng.choice(self.strokes)
+            self.draw(stroke, deadline)
+            time.sleep(self.rng.uniform(*STROKE_PAUSE_MS) / 1000)
+
+    def draw(self, stroke, deadline):
+        stroke_id = self.rng.getrandbits(31)
+        op_id = self.core.new_op_id()
+        colour = f"#{self.rng.getrandbits(24):06x}"
+        start = time.perf_counter()
+        pending = list(stroke[0][:2])
+        pending_since = start
+        chunk = 0
+        for x, y, ms in stroke[1:]:
+            delay = start + ms / 1000 - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pending += [x, y]
+            now = time.perf_counter()
+            if (len(pending) // 2 > self.core.stroke_flush_points()
+                    or now - pending_since >= self.core.stroke_flush_ms() / 1000):
+                ops = [("STROKE", stroke_id, colour, 2, tuple(pending))]
+                if chunk == 0 and op_id:
+                    ops.insert(0, ("OPID",) + op_id)
+                self.send(ops, stroke_id, chunk)
+                chunk += 1
+                pending = pending[-2:]
+                pending_since = now
+            if now > deadline:
+                break
+
+        ops = []
+        if len(pending) >= 4:
+            ops.append(("STROKE", stroke_id, colour, 2, tuple(pending)))
+            if chunk == 0 and op_id:
+                ops.insert(0, ("OPID",) + op_id)
+        ops.append(("STROKEEND", stroke_id))
+        self.send(ops, stroke_id, chunk if len(ops) > 1 else None)
+
+#func to run one client count: connect everyone, draw for duration seconds, wait for the last ops
+# to arrive and summarise
+def run_step(host, port, certificate, clients, duration, strokes, seed, compress=True):
+    recorder = Recorder()
+    room = f"bench-{os.getpid()}-{clients}-{int(time.time())}"
+    cores = [ClientCore(host, port, certificate, room, recorder.receiver()) for _ in range(clients)]
+    context = cores[0].create_context()
+    for core in cores:
+        core.context = context
+        core.compress = compress
+        core.start()
+    connect_deadline = time.perf_counter() + 10
+    while any(core.board_epoch is None for core in cores) and time.perf_counter() < connect_deadline:
+        time.sleep(0.01)
+    connected = sum(core.board_epoch is not None for core in cores)
+
+    start = time.perf_counter()
+    sent_before = sum(core.bytes_sent for core in cores)
+    received_before = sum(core.bytes_received for core in cores)
+    drawers = [Drawer(core, recorder, strokes, random.Random(seed + index)) for index, core in enumerate(cores)]
+    threads = [threading.Thread(target=drawer.run, args=(start + duration,), daemon=True) for drawer in drawers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # every chunk should reach every other client, wait until they have or nothing new turns up
+    expected = recorder.chunks_sent * (clients - 1)
+    drain_deadline = time.perf_counter() + DRAIN_TIMEOUT
+    last_count = -1
+    while time.perf_counter() < drain_deadline:
+        with recorder.lock:
+            count = len(recorder.latencies)
+        if count >= expected or count == last_count:
+            break
+        last_count = count
+        time.sleep(0.25)
+
+    for core in cores:
+        core.close()
+
+    bytes_sent = sum(core.bytes_sent for core in cores) - sent_before
+    bytes_received = sum(core.bytes_received for core in cores) - received_before
+    latencies = sorted(recorder.latencies)
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "clients": clients,
+        "connected": connected,
+        "protocol_version": min((core.protocol_version for core in cores), default=None),
+        "compressed": sum(core.compressor is not None for core in cores),
+        "seconds": round(elapsed, 3),
+        "ops_sent": recorder.ops_sent,
+        "ops_received": recorder.ops_received,
+        "ops_sent_per_second": round(recorder.ops_sent / elapsed, 1),
+        "ops_received_per_second": round(recorder.ops_received / elapsed, 1),
+        "bytes_per_op_sent": round(bytes_sent / recorder.ops_sent, 2) if recorder.ops_sent else None,
+        "bytes_per_op_received": round(bytes_received / recorder.ops_received, 2) if recorder.ops_received else None,
+        "chunks_expected": expected,
+        "chunks_delivered": len(latencies),
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p90": to_ms(percentile(latencies, 0.90)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+    }
+
+#func to start every client at once and wait until all of them have been welcomed, returns (seconds, welcomed)
+def join_all(cores, timeout=30):
+    start = time.perf_counter()
+    for core in cores:
+        core.start()    # connects on the core's own thread
+    deadline = start + timeout
+    while any(core.board_epoch is None for core in cores) and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    return time.perf_counter() - start, sum(core.board_epoch is not None for core in cores)
+
+#func to time a burst of clients joining one room, then the same clients reconnecting with the TLS
+# sessions of their first connection
+def join_burst(host, port, certificate, clients):
+    room = f"burst-{os.getpid()}-{int(time.time())}"
+    first = [ClientCore(host, port, certificate, room) for _ in range(clients)]
+    # one shared TLS context, like separate machines would each have ready. Loading the CA bundle
+    # 200 times over would otherwise be what gets measured
+    context = first[0].create_context()
+    for core in first:
+        core.context = context
+    join_seconds, joined = join_all(first)
+    for core in first:
+        core.close()
+
+    again = []
+    for old in first:
+        core = ClientCore(host, port, certificate, room)
+        core.context, core.tls_session = old.context, old.tls_session
+        again.append(core)
+    rejoin_seconds, rejoined = join_all(again)
+    resumed = 0
+    for core in again:
+        client_socket = core.client_socket
+        resumed += bool(client_socket and client_socket.session_reused)
+        core.close()
+    return {
+        "clients": clients,
+        "joined": joined,
+        "join_seconds": round(join_seconds, 3),
+        "rejoined": rejoined,
+        "rejoin_seconds": round(rejoin_seconds, 3),
+        "sessions_resumed": resumed,
+    }
+
+#func to make a self-signed certificate and key for a local server, with the openssl command
+def make_certificate(directory):
+    certificate = os.path.join(directory, "certificate.pem")
+    key = os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", key, "-out", certificate,
+                    "-days", "1", "-subj", "/CN=localhost"], check=True, capture_output=True)
+    return certificate, key
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+#func to start ssl_server.py in its own process (so it does not share our GIL) and wait until it listens
+def start_server(mode, certificate, key):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-c", SERVER_SCRIPT, str(port), certificate, key, mode],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 10
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server, port
+        except OSError:
+            time.sleep(0.05)
+    server.kill()
+    raise RuntimeError("Server did not start listening")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the whiteboard server with simulated drawers")
+    parser.add_argument("--clients", default="1,2,4,8,16", help="comma separated client counts to measure")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of drawing per client count")
+    parser.add_argument("--mode", default="threaded", choices=("threaded", "async", "sharded"),
+                        help="server mode of the local server")
+    parser.add_argument("--server", help="host:port of a running server instead of starting one")
+    parser.add_argument("--certificate", help="certificate of the running server")
+    parser.add_argument("--traces", help="JSON file of strokes to replay instead of synthetic ones")
+    parser.add_argument("--join-burst", type=int, default=0, help="also time this many clients joining at once")
+    parser.add_argument("--no-compression", action="store_true", help="do not ask the server to compress connections")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the results to this file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    strokes = load_traces(args.traces) if args.traces else [synthetic_stroke(rng) for _ in range(200)]
+    counts = [int(count) for count in args.clients.split(",")]
+
+    server = None
+    with tempfile.TemporaryDirectory() as directory:
+        if args.server:
+            host, port = args.server.rsplit(":", 1)
+            port = int(port)
+            certificate = args.certificate
+            mode = None
+        else:
+            certificate, key = make_certificate(directory)
+            server, port = start_server(args.mode, certificate, key)
+            host, mode = "127.0.0.1", args.mode
+
+        try:
+            steps = [run_step(host, port, certificate, count, args.duration, strokes, args.seed, not args.no_compression)
+                     for count in counts]
+            burst = join_burst(host, port, certificate, args.join_burst) if args.join_burst else None
+        finally:
+            if server:
+                server.terminate()
+                server.wait()
+
+    results = {
+        "benchmark": "whiteboard-load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "client_protocol_version": PROTOCOL_VERSION,
+        "server": args.server or "local",
+        "server_mode": mode,
+        "duration": args.duration,
+        "traces": args.traces or f"synthetic seed {args.seed}",
+        "steps": steps,
+    }
+    if burst:
+        results["join_burst"] = burst
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+import random
+import threading
+from collections import deque
+from protocol import DRAWING_COMMANDS, RESYNC_LEGACY, RESYNC_PLAIN, RESYNC_ALL
+from spatial import SpatialGrid, op_bounds, intersects
+
+MAX_HISTORY_SIZE = 10000    # entries, not pen events: a whole stroke is a single entry
+SIMPLIFY_TOLERANCE = 1.0    # pixels a simplified stroke may stray from the drawn one, 0 turns it off
+SEQ_RING_SIZE = 4096        # recent ops kept by sequence number for clients catching up after a reconnect
+COMPACT_MIN_TOMBSTONES = 64     # undone entries left in place before the board is compacted
+
+# Runs of LINE segments from clients that predate strokes are merged into stroke entries with ids
+# from this range. Client stroke ids are 31 bit so the two never collide.
+LINE_RUN_ID_BASE = 0x80000000
+
+#func to simplify a flat x1, y1, x2, y2, ... point list with Ramer-Douglas-Peucker
+def simplify(points, tolerance=SIMPLIFY_TOLERANCE):
+    count = len(points) // 2
+    if tolerance <= 0 or count < 3:
+        return list(points)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, count - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[2 * first], points[2 * first + 1]
+        dx, dy = points[2 * last] - x1, points[2 * last + 1] - y1
+        length_sq = dx * dx + dy * dy
+
+        max_dist_sq = -1
+        index = first
+        for i in range(first + 1, last):
+            px, py = points[2 * i] - x1, points[2 * i + 1] - y1
+            if length_sq:
+                cross = px * dy - py * dx
+                dist_sq = cross * cross / length_sq
+            else:
+                dist_sq = px * px + py * py
+            if dist_sq > max_dist_sq:
+                max_dist_sq = dist_sq
+                index = i
+
+        if max_dist_sq > tolerance_sq:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    simplified = []
+    for i in range(count):
+        if keep[i]:
+            simplified += points[2 * i:2 * i + 2]
+    return simplified
+
+def is_line_run(op):
+    return op[0] == "STROKE" and op[1] >= LINE_RUN_ID_BASE
+
+# The ops that make up what is currently on the board. Only what is visible is kept: CLEAR empties
+# it, UNDO removes the entry it cancels, the chunks of a stroke (or a run of connected LINE
+# segments) are merged into one entry and finished strokes are simplified.
+#
+# Every entry has an op id (see protocol.py) and can be looked up by it, so an UNDO with an id is a
+# dict lookup. An entry taken back from the middle is only marked dead (a tombstone) and skipped;
+# the dead entries are dropped in one pass once they make up a good part of the board.
+class Board:
+    def __init__(self, max_size=MAX_HISTORY_SIZE, tolerance=SIMPLIFY_TOLERANCE, journal=None):
+        self.ops = deque(maxlen=max_size)
+        self.index = SpatialGrid()  # where each op is, to find the ops in a viewport
+        self.ids = {}       # op id -> entry, for every live entry
+        self.entry_ids = {}     # id(entry) -> op id
+        self.dead = set()   # id(entry) of the tombstones still in ops
+        self.next_anonymous = 1     # entries from clients that send no op ids get (0, n) ids
+        self.open_strokes = {}      # strokes still being drawn, by stroke id
+        self.line_run = None        # the LINE run the next connected segment would extend
+        self.next_run_id = LINE_RUN_ID_BASE
+        self.tolerance = tolerance
+        self.revision = 0   # bumped by every op, so anything derived from the board can be cached
+        self.journal = journal      # optional journal.Journal every applied op is written to
+        # every applied op gets the next sequence number, the latest ones stay in a ring so a client
+        # that reconnects can be sent just what it missed. Sequence numbers only mean something
+        # within one epoch, which changes whenever the server starts
+        self.seq = 0
+        self.recent = deque(maxlen=SEQ_RING_SIZE)
+        self.epoch = f"{random.getrandbits(32):08x}"
+        # seq of the newest UNDO that clients without op ids (or any client) could not follow, a
+        # client that missed it has to be sent the whole board
+        self.resync_seq = {RESYNC_LEGACY: 0, RESYNC_PLAIN: 0, RESYNC_ALL: 0}
+        self.created = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ops) - len(self.dead)
+
+    #func to apply an op to the board, safe to call from several client threads. Returns the op's
+    # sequence number. op_id is the id from the OPID sent ahead of the op, if any. effects (a dict)
+    # is filled in with what happened: "id" is the entry the op started or took back, "undone" the
+    # entry an UNDO took back, "resync" which clients could not follow that UNDO, "trimmed" is set
+    # when the UNDO only took the last segment off a LINE run and "duplicate" when the op was
+    # ignored because an entry with its id is already on the board
+    def apply(self, op, op_id=None, effects=None):
+        if effects is None:
+            effects = {}
+        with self.lock:
+            if op_id is not None and op_id in self.ids:
+                effects["duplicate"] = True
+                return self.seq
+
+            self.revision += 1
+            self.seq += 1
+            self.created = None
+            cmd = op[0]
+            if cmd == "LINE":
+                self._add_line(op, op_id)
+            elif cmd in DRAWING_COMMANDS:
+                self._append(op, op_id)
+            elif cmd == "STROKE":
+                self._add_stroke_chunk(op, op_id)
+            elif cmd == "STROKEEND":
+                stroke = self.open_strokes.pop(op[1], None)
+                if stroke:
+                    stroke[4][:] = simplify(stroke[4], self.tolerance)
+            elif cmd == "CLEAR":
+                self.ops.clear()
+                self.index.clear()
+                self.ids.clear()
+                self.entry_ids.clear()
+                self.dead.clear()
+                self.open_strokes.clear()
+                self.line_run = None
+            elif cmd == "UNDO":
+                self._undo(op, effects)
+
+            # what was applied is recorded with its ids, for clients catching up and the journal
+            if self.created:
+                effects["id"] = self.created
+                recorded = [("OPID",) + self.created, op]
+            elif cmd == "UNDO":
+                if "id" not in effects:
+                    recorded = []
+                elif effects.get("trimmed"):
+                    recorded = [op]     # by id the whole run would be taken back on replay
+                else:
+                    recorded = [("UNDO",) + effects["id"]]
+                if "resync" in effects:
+                    self.resync_seq[effects["resync"]] = self.seq
+            else:
+                recorded = [op]
+
+            for record in recorded:
+                self.recent.append((self.seq, record))
+            if self.journal and any([self.journal.append(record) for record in recorded]):
+                self.journal.checkpoint(self._copy_ops(ids=True), list(self.open_strokes))
+            return self.seq
+
+    #func to apply ops that may carry OPIDs, as read back from a journal or sent by another server
+    def apply_all(self, ops):
+        op_id = None
+        for op in ops:
+            if op[0] == "OPID":
+                op_id = op[1:]
+                continue
+            self.apply(op, op_id)
+            op_id = None
+
+    #func to get (ops after last_seq, seq of the newest op), or None when some of them have already
+    # left the ring (or include an UNDO the client cannot follow) and it needs the whole board instead
+    def ops_since(self, last_seq, ids=True):
+        with self.lock:
+            if last_seq > self.seq:
+                return None
+            oldest = self.recent[0][0] if self.recent else self.seq + 1
+            if last_seq + 1 < oldest and last_seq != self.seq:
+                return None
+            if last_seq < self.resync_seq[RESYNC_ALL] or (not ids and last_seq < self.resync_seq[RESYNC_PLAIN]):
+                return None
+            return [op for seq, op in self.recent if seq > last_seq], self.seq
+
+    #func to replace the board with ops loaded from a checkpoint, or synced from another server when
+    # seq is given. Ops may carry OPIDs
+    def restore(self, ops, open_ids=(), seq=None):
+        with self.lock:
+            self.revision += 1
+            if seq is not None:
+                self.seq = seq
+                self.recent.clear()
+            self.ops.clear()
+            self.index.clear()
+            self.ids.clear()
+            self.entry_ids.clear()
+            self.dead.clear()
+            self.open_strokes.clear()
+            self.line_run = None
+            op_id = None
+            for op in ops:
+                if op[0] == "OPID":
+                    op_id = op[1:]
+                    continue
+                if op[0] == "STROKE":
+                    op = op[:4] + (list(op[4]),)
+                    if op[1] in open_ids:
+                        self.open_strokes[op[1]] = op
+                self._push(op, op_id)
+                op_id = None
+
+    #func to get a copy of the ops on the board, oldest first. Stroke points are copied too since
+    # open strokes keep growing after this returns
+    def history(self):
+        with self.lock:
+            return self._copy_ops()
+
+    #func to get (revision, seq, ops, ids of strokes still being drawn) as one consistent view, of
+    # the whole board or only of what intersects view. With ids every entry has its OPID ahead of it
+    def snapshot(self, view=None, ids=False):
+        with self.lock:
+            if view is None:
+                return self.revision, self.seq, self._copy_ops(ids=ids), list(self.open_strokes)
+            ops = self.index.query(view)
+            open_ids = [op[1] for op in ops if op[0] == "STROKE" and op[1] in self.open_strokes]
+            return self.revision, self.seq, self._copy_ops(ops, ids), open_ids
+
+    #func to get the ids of the strokes still being drawn that reach into view
+    def open_strokes_in(self, view):
+        with self.lock:
+            bounds = {stroke_id: op_bounds(stroke) for stroke_id, stroke in self.open_strokes.items()}
+        return [stroke_id for stroke_id, box in bounds.items() if box is not None and intersects(box, view)]
+
+    def _copy_ops(self, ops=None, ids=False):
+        copied = []
+        for op in (self.ops if ops is None else ops):
+            if id(op) in self.dead:
+                continue
+            if ids:
+                copied.append(("OPID",) + self.entry_ids[id(op)])
+            copied.append(op[:4] + (tuple(op[4]),) if op[0] == "STROKE" else op)
+        return copied
+
+    #func to add an entry at the end under op_id (a new anonymous id when None), the oldest entry
+    # falls off when the board is full
+    def _push(self, op, op_id=None):
+        if len(self.ops) == self.ops.maxlen:
+            self._forget(self.ops[0])
+        if op_id is None:
+            op_id = (0, self.next_anonymous)
+        if op_id[0] == 0:
+            self.next_anonymous = max(self.next_anonymous, op_id[1] + 1)
+        self.ops.append(op)
+        self.index.insert(op)
+        self.ids[op_id] = op
+        self.entry_ids[id(op)] = op_id
+        self.created = op_id
+
+    #func to drop everything known about an entry that is leaving the board
+    def _forget(self, op):
+        if id(op) in self.dead:
+            self.dead.discard(id(op))
+            return
+        self.index.remove(op)
+        op_id = self.entry_ids.pop(id(op), None)
+        if op_id is not None:
+            self.ids.pop(op_id, None)
+        if op is self.line_run:
+            self.line_run = None
+        elif op[0] == "STROKE" and self.open_strokes.get(op[1]) is op:
+            del self.open_strokes[op[1]]
+
+    def _append(self, op, op_id=None):
+        self._finish_line_run()
+        self._push(op, op_id)
+
+    def _finish_line_run(self):
+        if self.line_run:
+            self.line_run[4][:] = simplify(self.line_run[4], self.tolerance)
+            self.line_run = None
+
+    def _add_line(self, op, op_id=None):
+        _, x1, y1, x2, y2, colour, width = op
+        run = self.line_run
+        if (run and self.ops and self.ops[-1] is run and run[2] == colour and run[3] == width
+                and run[4][-2] == x1 and run[4][-1] == y1):
+            run[4].extend((x2, y2))
+            self.index.grow(run, op_bounds(op))
+            return
+
+        self._finish_line_run()
+        run = ("STROKE", self.next_run_id, colour, width, [x1, y1, x2, y2])
+        self.next_run_id = LINE_RUN_ID_BASE + (self.next_run_id + 1) % LINE_RUN_ID_BASE
+        self._push(run, op_id)
+        self.line_run = run
+
+    def _add_stroke_chunk(self, op, op_id=None):
+        stroke = self.open_strokes.get(op[1])
+        if stroke:
+            stroke[4].extend(op[4][2:])     # chunks overlap by one point
+            self.index.grow(stroke, op_bounds(op))
+            return
+
+        stroke = ("STROKE", op[1], op[2], op[3], list(op[4]))
+        self.open_strokes[op[1]] = stroke
+        self._append(stroke, op_id)
+
+    #func to take back the entry an UNDO names, or the newest one for an UNDO without an id
+    def _undo(self, op, effects):
+        # tombstones at the end are dropped first so ops[-1] is the newest live entry
+        while self.ops and id(self.ops[-1]) in self.dead:
+            self.dead.discard(id(self.ops.pop()))
+
+        if len(op) == 3:
+            target = self.ids.get(op[1:])
+            if target is None:
+                return
+        elif self.ops:
+            target = self.ops[-1]
+        else:
+            return
+
+        effects["undone"] = target
+        effects["id"] = self.entry_ids[id(target)]
+        if target is self.ops[-1]:
+            # each LINE of a run was drawn as its own item on the clients, so UNDO takes back one
+            # segment. Clients that loaded the run from a snapshot hold it as one item and need it again
+            if len(op) == 1 and is_line_run(target) and len(target[4]) > 4:
+                del target[4][-2:]
+                effects["trimmed"] = True
+                effects["resync"] = RESYNC_ALL
+                return
+            if target[0] == "STROKE" and not is_line_run(target):
+                # clients before strokes were sent it as LINE segments, an UNDO only takes back the last
+                effects["resync"] = RESYNC_LEGACY
+            self._forget(self.ops.pop())
+            return
+
+        # an entry from the middle of the board: leave a tombstone and compact once there are many
+        self._forget(target)
+        self.dead.add(id(target))
+        effects["resync"] = RESYNC_PLAIN
+        if len(self.dead) > COMPACT_MIN_TOMBSTONES and len(self.dead) * 4 > len(self.ops):
+            self.ops = deque((entry for entry in self.ops if id(entry) not in self.dead), maxlen=self.ops.maxlen)
+            self.dead.clear()
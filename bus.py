@@ -0,0 +1,269 @@
+import os
+import socket
+import struct
+import random
+import logging
+import threading
+from collections import deque
+from board import Board
+from framing import encode_frame, send_frame, FrameReader
+from protocol import Message, encode_op, encode_snapshot, decode_ops
+
+logger = logging.getLogger('WhiteboardServer.bus')
+
+BUS_PATH = "/tmp/whiteboard-bus.sock"   # where `python bus.py` runs the hub
+NODE_QUEUE_SIZE = 10000     # deliveries a node may fall behind by before the hub drops it
+
+# Federation lets several server nodes serve the same rooms. Nodes publish the messages their
+# clients send and apply only what the bus delivers back. The hub delivers every message to every
+# node, the publisher included, stamped with one global sequence number, so all nodes apply the
+# same ops in the same order and end up with identical boards. A node that connects late is first
+# synced with a snapshot of every room the hub has seen.
+#
+# Backends subclass Bus and only have to move bytes: publish() hands a message to the hub and the
+# hub's deliveries are passed to deliver(). LocalBus talks to a Hub in the same process, UnixBus to
+# a UnixHub over a UNIX socket. Something like a TCP or broker backed bus plugs in the same way.
+DELIVER_OPS, DELIVER_SYNC = 0, 1
+
+PUBLISH_HEADER = struct.Struct(">IQH")      # node id, tag, room name length
+DELIVER_HEADER = struct.Struct(">BQIQH")    # kind, global seq, node id, tag, room name length
+
+# One connected node as the hub sees it. Deliveries wait in a queue that a thread of its own hands
+# to deliver, so a slow node only ever holds up itself, never the hub or the other nodes. A node
+# that falls NODE_QUEUE_SIZE deliveries behind or fails a delivery is closed, on_drop (if given)
+# then cuts it off so it notices
+class NodeOutbox:
+    def __init__(self, deliver, on_drop=None):
+        self.deliver = deliver
+        self.on_drop = on_drop
+        self.queue = deque()    # (kind, seq, room, payload, node id, tag) waiting to be delivered
+        self.ready = threading.Condition()
+        self.closed = False
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    #func to queue one delivery, returns False when the node is closed or too far behind to take it
+    def put(self, *delivery):
+        with self.ready:
+            if self.closed or len(self.queue) >= NODE_QUEUE_SIZE:
+                return False
+            self.queue.append(delivery)
+            self.ready.notify()
+            return True
+
+    def write_loop(self):
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                deliveries = list(self.queue)
+                self.queue.clear()
+            try:
+                for delivery in deliveries:
+                    self.deliver(*delivery)
+            except Exception as e:
+                logger.error(f"Dropping bus node after failed delivery: {e}")
+                self.close()
+                return
+
+    def close(self):
+        with self.ready:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.clear()
+            self.ready.notify()
+        if self.on_drop:
+            self.on_drop()
+
+# The sequencer at the centre of the bus. Messages are numbered and queued for every node under one
+# lock, so the order they are numbered in is the order every node receives them
+class Hub:
+    def __init__(self):
+        self.seq = 0
+        self.boards = {}    # room name -> Board, kept to sync nodes that connect late
+        self.nodes = []     # NodeOutbox of every connected node
+        self.lock = threading.Lock()
+
+    #func to connect a node, deliver(kind, seq, room, payload, node_id, tag) is called on a thread of
+    # its own for everything the hub delivers to it, starting with a sync of every room
+    def add_node(self, deliver, on_drop=None):
+        node = NodeOutbox(deliver, on_drop)
+        with self.lock:
+            for name, board in self.boards.items():
+                _, board_seq, ops, open_ids = board.snapshot(ids=True)
+                payload = encode_op(("SEQ", board_seq)) + encode_snapshot(ops, open_ids)
+                node.put(DELIVER_SYNC, self.seq, name, payload, 0, 0)
+            self.nodes.append(node)
+
+    def remove_node(self, deliver):
+        with self.lock:
+            nodes = [node for node in self.nodes if node.deliver == deliver]
+            for node in nodes:
+                self.nodes.remove(node)
+        for node in nodes:
+            node.close()
+
+    def publish(self, room, payload, node_id, tag):
+        dropped = []
+        with self.lock:
+            self.seq += 1
+            board = self.boards.get(room)
+            if board is None:
+                board = self.boards[room] = Board()
+            board.apply_all(Message.from_payload(payload).ops)
+
+            for node in list(self.nodes):
+                if not node.put(DELIVER_OPS, self.seq, room, payload, node_id, tag):
+                    self.nodes.remove(node)
+                    dropped.append(node)
+        for node in dropped:
+            if not node.closed:
+                logger.error(f"Dropping bus node {NODE_QUEUE_SIZE} deliveries behind")
+            node.close()
+
+# One node's end of the bus. on_message(room, payload, ours, tag) is called for every message in
+# the global order, ours telling whether this node published it (tag is the one it published
+# with). on_sync(room, ops, open_ids, seq) replaces a room's board when the node first connects
+class Bus:
+    def __init__(self, on_message, on_sync):
+        self.node_id = random.getrandbits(32)
+        self.on_message = on_message
+        self.on_sync = on_sync
+        self.seq = 0    # global sequence number of the last delivery
+
+    def publish(self, room, payload, tag):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def deliver(self, kind, seq, room, payload, node_id, tag):
+        if kind == DELIVER_SYNC:
+            (_, board_seq), (_, ops, open_ids) = decode_ops(payload)
+            self.seq = seq
+            self.on_sync(room, ops, open_ids, board_seq)
+            return
+
+        if seq != self.seq + 1:
+            logger.warning(f"Bus skipped from {self.seq} to {seq}, boards may have diverged")
+        self.seq = seq
+        self.on_message(room, payload, node_id == self.node_id, tag)
+
+# Reference backend for nodes in one process: deliveries arrive on the hub's thread for the node
+class LocalBus(Bus):
+    def __init__(self, hub, on_message, on_sync):
+        super().__init__(on_message, on_sync)
+        self.hub = hub
+        hub.add_node(self.deliver)
+
+    def publish(self, room, payload, tag):
+        self.hub.publish(room, bytes(payload), self.node_id, tag)
+
+    def close(self):
+        self.hub.remove_node(self.deliver)
+
+# Serves a Hub to nodes on the same machine, one thread per connected node
+class UnixHub:
+    def __init__(self, path=BUS_PATH):
+        self.path = path
+        self.hub = Hub()
+        if os.path.exists(path):
+            os.remove(path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen(16)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        logger.info(f"Bus hub listening on {self.path}")
+
+    def serve_forever(self):
+        while True:
+            try:
+                node_socket, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_node, args=(node_socket,), daemon=True).start()
+
+    def handle_node(self, node_socket):
+        # called on the node's own delivery thread, in sequence order
+        def deliver(kind, seq, room, payload, node_id, tag):
+            name = room.encode()
+            header = DELIVER_HEADER.pack(kind, seq, node_id, tag, len(name))
+            send_frame(node_socket, encode_frame(header + name + payload))
+
+        # a dropped node is cut off, which ends this loop and tells the node it lost the bus
+        def drop():
+            try:
+                node_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        self.hub.add_node(deliver, drop)
+        try:
+            reader = FrameReader(node_socket)
+            while True:
+                record = reader.read_frame()
+                if not record:
+                    break
+                node_id, tag, length = PUBLISH_HEADER.unpack_from(record)
+                start = PUBLISH_HEADER.size
+                room = str(record[start:start + length], 'utf-8')
+                self.hub.publish(room, bytes(record[start + length:]), node_id, tag)
+        except Exception as e:
+            logger.error(f"Error reading from bus node: {e}")
+        finally:
+            self.hub.remove_node(deliver)
+            node_socket.close()
+
+    def close(self):
+        self.server_socket.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+# Reference backend for nodes on one machine, deliveries arrive on a background thread
+class UnixBus(Bus):
+    def __init__(self, path, on_message, on_sync):
+        super().__init__(on_message, on_sync)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.send_lock = threading.Lock()
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+
+    def publish(self, room, payload, tag):
+        name = room.encode()
+        frame = encode_frame(PUBLISH_HEADER.pack(self.node_id, tag, len(name)) + name + payload)
+        with self.send_lock:
+            send_frame(self.socket, frame)
+
+    def receive_loop(self):
+        reader = FrameReader(self.socket)
+        try:
+            while True:
+                record = reader.read_frame()
+                if not record:
+                    break
+                kind, seq, node_id, tag, length = DELIVER_HEADER.unpack_from(record)
+                start = DELIVER_HEADER.size
+                room = str(record[start:start + length], 'utf-8')
+                self.deliver(kind, seq, room, bytes(record[start + length:]), node_id, tag)
+        except Exception as e:
+            logger.error(f"Error reading from bus: {e}")
+        logger.error("Lost connection to the bus hub")
+
+    def close(self):
+        self.socket.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    hub = UnixHub(BUS_PATH)
+    logger.info(f"Bus hub listening on {BUS_PATH}")
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        hub.close()
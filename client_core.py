@@ -0,0 +1,297 @@
+import socket
+import threading
+import ssl
+import random
+import time
+from collections import deque
+from framing import encode_frame, send_frame, FrameReader
+from protocol import (BINARY_VERSION, SEQ_VERSION, VIEW_VERSION, OPID_VERSION, parse_command, format_command, encode_ops, decode_ops,
+                      is_binary, hello_message, parse_handshake, wants_compression, is_compressed, StreamCompressor,
+                      StreamDecompressor)
+
+STROKE_FLUSH_POINTS = 16    #pen points are batched and sent once this many have built up...
+STROKE_FLUSH_MS = 50        #...or this long after the first unsent point, whichever comes first
+RECONNECT_DELAY = 0.5       #seconds before the first reconnect attempt, doubled after every failure...
+RECONNECT_MAX_DELAY = 10    #...up to this
+COMPRESS = True             #ask the server to compress the connection, worth it on slow links and cheap on fast ones
+OFFLINE_QUEUE_SIZE = 4096   #messages kept while offline (or not acknowledged yet) to be sent after reconnecting, the oldest go first
+WELCOME_TIMEOUT = 2.0       #seconds ops are held back waiting for WELCOME, a server that never sends one is an old one
+
+# The protocol side of a whiteboard client, without any UI: connecting and saying HELLO, sending ops,
+# reading and parsing what the server sends and reconnecting when the connection drops. Received ops
+# are handed to on_ops(ops) on the receive thread, connection changes to on_status(text, connected).
+# The GUI client is built on this, and so are the benchmark's simulated drawers.
+#
+# Ops drawn while offline or still connecting are kept and sent once the server has answered the
+# next HELLO, and so are ops that were sent but never acknowledged (servers from SEQ_VERSION on
+# acknowledge every message with its SEQ). Entries carry op ids, so one the server did get before
+# the connection dropped is ignored when it arrives again
+class ClientCore:
+    def __init__(self, host, port, certificate_path, room=None, on_ops=None, on_status=None):
+        self.host = host
+        self.port = port
+        self.certificate_path = certificate_path
+        self.room = room
+        self.on_ops = on_ops or (lambda ops: None)
+        self.on_status = on_status or (lambda text, connected: None)
+        self.protocol_version = 1   # raised once the server answers our HELLO
+        self.client_socket = None
+        self.context = None     # made once, TLS sessions can only be resumed with the context they came from
+        self.tls_session = None     # session of the last connection, offered again when reconnecting
+        self.board_epoch = None     # which board last_seq belongs to, changes when the server restarts
+        self.last_seq = None        # newest op we have, so a reconnect only fetches what we missed
+        self.view = None    # part of the board (x1, y1, x2, y2) the server is sending us
+        self.hello_view = None  # the view our last HELLO declared
+        self.synced_view = None     # the view the server last heard from us, which is what our board holds
+        self.view_stale = False     # set when the server has to be told our view again
+        self.pace_ms = 0    # least time between stroke chunks the server asked for, 0 when it is keeping up
+        self.compress = COMPRESS
+        self.compressor = None      # both set while the connection is compressed
+        self.decompressor = None
+        self.welcomed = False   # the server answered the HELLO of this connection
+        self.joining = False    # the next frame is the one bringing us up to date, not an acknowledgement
+        self.hello_time = 0.0
+        self.unsent = deque(maxlen=OFFLINE_QUEUE_SIZE)  # ops of each message waiting for the connection, oldest first
+        self.in_flight = deque(maxlen=OFFLINE_QUEUE_SIZE)   # ops of each message sent but not acknowledged yet
+        self.resent = []    # ops sent again after the last reconnect, drawn again if the board arrives as a snapshot
+        self.send_lock = threading.Lock()
+        self.client_id = random.randrange(1, 2**32)     # author part of our op ids, 0 is the server's
+        self.op_count = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.closed = False
+
+    #func to start the receive thread, which connects and then reconnects whenever the connection
+    # drops. Returns straight away, on_status says when the connection is up
+    def start(self):
+        receive_thread = threading.Thread(target=self.run)
+        receive_thread.daemon = True
+        receive_thread.start()
+
+    def run(self):
+        try:
+            self.connect()
+            self.on_status("Connected", True)
+        except Exception as e:
+            print(f"Connection error details: {str(e)}")
+            self.on_status("Disconnected, retrying...", False)
+        self.receive_data()
+
+    #func to open the connection and say HELLO, on a reconnect the HELLO carries the last op we saw
+    def connect(self):
+        if self.context is None:
+            self.context = self.create_context()
+        raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket = self.context.wrap_socket(raw_socket, server_hostname=self.host, session=self.tls_session)
+        client_socket.connect((self.host, self.port))
+        with self.send_lock:
+            self.protocol_version = 1
+            self.pace_ms = 0
+            self.compressor = self.decompressor = None
+            self.welcomed = self.joining = False
+            # whatever the last connection did not acknowledge goes out again, ahead of anything newer
+            self.unsent = deque(list(self.in_flight) + list(self.unsent), maxlen=OFFLINE_QUEUE_SIZE)
+            self.in_flight.clear()
+            # after moving the view while offline the ops we missed are not enough, the new view is sent whole
+            last_seq = self.last_seq if self.view == self.synced_view else None
+            self.hello_view = self.synced_view = self.view
+            hello = encode_frame(hello_message(self.board_epoch, last_seq, self.room, self.view, self.compress))
+            send_frame(client_socket, hello)
+            self.bytes_sent += len(hello)
+            self.hello_time = time.monotonic()
+            self.client_socket = client_socket
+
+    def create_context(self):
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.load_verify_locations(self.certificate_path)
+        context.check_hostname = False      #false here because otherwise new certificate will have to be generated each time IP changes
+        context.verify_mode = ssl.CERT_REQUIRED
+        return context
+
+    #func to keep trying to connect, backing off exponentially (with jitter so a room does not retry in lockstep)
+    def reconnect(self):
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                self.connect()
+                self.on_status("Connected", True)
+                return
+            except Exception as e:
+                print(f"Reconnect error details: {str(e)}")
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def drop_connection(self, reason, client_socket=None):
+        client_socket = client_socket or self.client_socket
+        if self.client_socket is client_socket:
+            self.client_socket = None
+        if client_socket:
+            try:
+                #TLS 1.3 tickets arrive after the handshake, by now the session has them
+                self.tls_session = client_socket.session or self.tls_session
+            except (ssl.SSLError, ValueError):
+                pass
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)    #wakes the receive thread if it is blocked in recv
+            except OSError:
+                pass
+            client_socket.close()
+        if not self.closed:
+            self.on_status(f"Reconnecting: {reason}", False)
+
+    #func to disconnect for good, the receive thread stops instead of reconnecting
+    def close(self):
+        self.closed = True
+        self.drop_connection("closed")
+
+    #func to get the op id for a new shape of ours, None when the server does not know op ids
+    def new_op_id(self):
+        if self.protocol_version < OPID_VERSION:
+            return None
+        self.op_count += 1
+        return (self.client_id, self.op_count)
+
+    #func to get how long pen points may wait before they are sent, longer while the server paces us
+    def stroke_flush_ms(self):
+        return max(STROKE_FLUSH_MS, self.pace_ms)
+
+    #func to get how many pen points make a chunk worth sending, grows with the pace so a fast pen
+    # does not make up in chunks what the pace saves
+    def stroke_flush_points(self):
+        return STROKE_FLUSH_POINTS * self.stroke_flush_ms() // STROKE_FLUSH_MS
+
+    def send_op(self, op):
+        self.send_ops([op])
+
+    #func to send ops as one message, or keep them until the server has answered our HELLO
+    def send_ops(self, ops):
+        with self.send_lock:
+            if self.client_socket and not self.welcomed and time.monotonic() - self.hello_time > WELCOME_TIMEOUT:
+                self.resend()   #old servers never answer
+            if self.client_socket is None or not self.welcomed:
+                if any(op[0] != "VIEW" for op in ops):  #the view goes with the next HELLO anyway
+                    self.unsent.append(ops)
+                return
+            self.send_message(ops)
+
+    #func to send ops as one message, binary once negotiated and as text commands otherwise. Messages
+    # the server will acknowledge are kept until it does
+    def send_message(self, ops):
+        if self.client_socket is None:
+            self.unsent.append(ops)
+            return
+        if self.protocol_version >= SEQ_VERSION and any(op[0] != "VIEW" for op in ops):
+            self.in_flight.append(ops)
+        for op in ops:
+            if op[0] == "VIEW":
+                self.synced_view = op[1:]
+        payload = encode_ops(ops) if self.protocol_version >= BINARY_VERSION else None
+        self.send_data(payload if payload else "\n".join(format_command(op) for op in ops))
+
+    #func to send the messages kept back while offline or connecting, once the connection can take them
+    def resend(self):
+        self.welcomed = True
+        pending = list(self.unsent)
+        self.unsent.clear()
+        self.resent = [op for ops in pending for op in ops]
+        for ops in pending:
+            self.send_message(ops)
+
+    def send_data(self, data):
+        client_socket = self.client_socket
+        if client_socket is None:
+            return      #offline, the receive thread is reconnecting
+        try:
+            frame = encode_frame(data)
+            compressor = self.compressor
+            if compressor:
+                frame = compressor.compress(frame)
+            send_frame(client_socket, frame)
+            self.bytes_sent += len(frame)
+        except Exception as e:
+            print(f"Send error details: {str(e)}")  # Add detailed logging
+            self.drop_connection(str(e), client_socket)
+
+    def receive_data(self):
+        while not self.closed:
+            if self.client_socket is None:
+                self.reconnect()
+                if self.closed:
+                    break
+
+            client_socket = self.client_socket
+            reader = FrameReader(client_socket)
+            try:
+                while True:
+                    payload = reader.read_frame()
+
+                    if not payload:
+                        raise ConnectionError("Server closed the connection")
+
+                    self.bytes_received += len(payload) + 4
+                    if is_compressed(payload):
+                        if self.decompressor is None:
+                            raise ValueError("Compressed frame before compression was agreed")
+                        for inner in self.decompressor.payloads(payload):
+                            self.handle_payload(inner)
+                    else:
+                        self.handle_payload(payload)
+            except Exception as e:
+                if not self.closed:
+                    print(f"Receive error details: {str(e)}")
+                self.drop_connection(str(e), client_socket)
+
+    def handle_payload(self, payload):
+        if is_binary(payload):
+            self.handle_ops(decode_ops(payload))
+        else:
+            self.process_command(str(payload, 'utf-8'))
+
+    def process_command(self, data):
+        ops = []
+        for command in data.split("\n"):
+            op = parse_command(command)
+            if op:
+                ops.append(op)
+            elif command.startswith("WELCOME"):
+                # the server understood our HELLO, use whatever it agreed to
+                self.protocol_version, epoch, _, _, _ = parse_handshake(command)
+                if wants_compression(command):
+                    # what we send from now on is compressed, what the server sends after this WELCOME may be
+                    self.decompressor = StreamDecompressor()
+                    self.compressor = StreamCompressor()
+                if self.protocol_version >= VIEW_VERSION and self.view != self.hello_view:
+                    self.view_stale = True
+                if epoch != self.board_epoch:
+                    self.board_epoch = epoch
+                    self.last_seq = None
+                self.joining = self.protocol_version >= SEQ_VERSION
+                with self.send_lock:
+                    self.resend()
+            elif command.strip():
+                print(f"Unknown command: {command}")
+        if ops:
+            self.handle_ops(ops)
+
+    #func to keep track of SEQ, which reconnecting needs, and PACE, and pass everything else on. A SEQ
+    # with no ops behind it acknowledges our oldest message not acknowledged yet
+    def handle_ops(self, ops):
+        received = []
+        joining, self.joining = self.joining, False
+        for index, op in enumerate(ops):
+            if op[0] == "SEQ":
+                self.last_seq = op[1] if self.last_seq is None else max(self.last_seq, op[1])
+                acknowledged = index + 1 == len(ops) or ops[index + 1][0] == "SEQ"
+                if acknowledged and not joining and self.in_flight:
+                    self.in_flight.popleft()
+            elif op[0] == "PACE":
+                self.pace_ms = op[1]
+            else:
+                received.append(op)
+        if joining and any(op[0] == "SNAPSHOT" for op in received):
+            #the board was sent whole, without what we sent again after it, so that is drawn again on top
+            received += self.resent
+        if joining:
+            self.resent = []
+        if received:
+            self.on_ops(received)
@@ -0,0 +1,118 @@
+import time
+import logging
+from board import simplify
+
+logger = logging.getLogger('WhiteboardServer.flow')
+
+DECIMATE_LOAD = 0.25        # room load from which stroke chunks are simplified before they are passed on...
+DECIMATE_TOLERANCE = 2.0    # ...by this many pixels at load 1, more the further behind the room is
+DECIMATE_MAX_TOLERANCE = 8.0
+PACE_LOAD = 0.5             # room load at which senders are asked to slow down
+PACE_MS = 200               # stroke chunk interval senders are asked for while paced
+FORCED_COMMANDS = ("STROKEEND", "UNDO", "CLEAR")    # never held back or dropped, only charged for
+
+# Tokens that refill at rate per second up to burst. Each op takes one
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now=None):
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    #func to take n tokens if there are enough. force takes them anyway, running into debt (at most a
+    # burst's worth) that later ops pay back
+    def take(self, n=1, force=False):
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        if force:
+            self.tokens = max(-self.burst, self.tokens - n)
+            return True
+        return False
+
+# Flow control for the messages of one connection, applied before they reach the board. A client
+# sending faster than its token bucket allows has its stroke chunks held back and merged into one
+# chunk that goes out once there are tokens again (or the stroke ends), and its other drawing ops
+# dropped. The sender has drawn those already, rejected lists them so the server can take them back
+# on its screen (see rooms.Room.reject_frame). While the room is falling behind (load, see rooms.Room) stroke chunks are simplified
+# before they go out, and senders that understand PACE are asked to send less often
+class Flow:
+    def __init__(self, rate, burst, client_id=None):
+        self.bucket = TokenBucket(rate, burst)
+        self.client_id = client_id
+        self.held = {}      # stroke id -> (OPID or None, merged chunk) waiting for tokens
+        self.pace_ms = 0    # what this client was last asked for
+        self.dropped = 0
+        self.rejected = []  # (OPID or None, op) of the drawing ops the last admit dropped
+
+    #func to get (what is let through of message now, or None, PACE value to send the client, or None)
+    def admit(self, message, load=0.0, now=None):
+        self.bucket.refill(now)
+        self.rejected = []
+        ops = []
+        op_id = None
+        for op in message.ops:
+            cmd = op[0]
+            if cmd == "OPID":
+                op_id = op
+                continue
+
+            if cmd == "STROKE":
+                held_id, held = self.held.pop(op[1], (None, None))
+                if held:
+                    op = held[:4] + (held[4] + tuple(op[4][2:]),)    # chunks overlap by one point
+                    op_id = held_id or op_id
+                if self.bucket.take():
+                    ops += self._release(op_id, op, load)
+                else:
+                    self.held[op[1]] = (op_id, op)
+
+            elif cmd in FORCED_COMMANDS:
+                if cmd == "STROKEEND" and op[1] in self.held:
+                    held_id, held = self.held.pop(op[1])
+                    self.bucket.take(force=True)
+                    ops += self._release(held_id, held, load)
+                elif cmd == "CLEAR":
+                    self.held.clear()
+                self.bucket.take(force=True)
+                ops += ([op_id] if op_id else []) + [op]
+
+            elif self.bucket.take():
+                ops += ([op_id] if op_id else []) + [op]
+            else:
+                if self.dropped == 0:
+                    logger.warning(f"Rate limit hit by {self.client_id}, dropping ops")
+                self.dropped += 1
+                self.rejected.append((op_id, op))
+            op_id = None
+
+        if not ops:
+            return None, self._pace(load)
+        message.set_ops(ops)
+        return message, self._pace(load)
+
+    def _release(self, op_id, op, load):
+        if load >= DECIMATE_LOAD and len(op[4]) > 4:
+            tolerance = min(DECIMATE_MAX_TOLERANCE, DECIMATE_TOLERANCE * load)
+            op = op[:4] + (tuple(simplify(op[4], tolerance)),)
+        return ([op_id] if op_id else []) + [op]
+
+    #func to decide whether the client should be told to slow down (or may speed up again), with
+    # some slack between the two so it is not told back and forth
+    def _pace(self, load):
+        bucket = self.bucket
+        if bucket.tokens < bucket.burst / 4 or load >= PACE_LOAD:
+            pace_ms = PACE_MS
+        elif bucket.tokens >= bucket.burst / 2 and load < PACE_LOAD / 2:
+            pace_ms = 0
+        else:
+            return None
+        if pace_ms == self.pace_ms:
+            return None
+        self.pace_ms = pace_ms
+        return pace_ms
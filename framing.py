@@ -0,0 +1,59 @@
+HEADER_SIZE = 4     # every message is sent as a 4 byte big-endian length followed by the payload
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+RECV_BUFFER_SIZE = 64 * 1024
+
+#func to build a complete frame (header + payload) so it can be encoded once and sent to many peers
+def encode_frame(message):
+    if isinstance(message, str):
+        message = message.encode()
+    return len(message).to_bytes(HEADER_SIZE, 'big') + message
+
+#func to send an already encoded frame with a single write
+def send_frame(sock, frame):
+    sock.sendall(frame)
+
+# Reads frames from a socket into one preallocated buffer. recv() may return only part of a
+# frame (it often does under TLS), so reads loop on recv_into until the exact length has arrived.
+# The views returned are only valid until the next read from the same reader.
+class FrameReader:
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+
+    def recv_exact(self, size):
+        if size > len(self.buffer):
+            self.buffer = bytearray(size)
+            self.view = memoryview(self.buffer)
+
+        view = self.view[:size]
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:], size - received)
+            if count == 0:
+                if received == 0:
+                    return None     # clean close between frames
+                raise ConnectionError("Connection closed in the middle of a frame")
+            received += count
+        return view
+
+    #returns the payload of the next frame, or None once the peer has closed the connection
+    def read_frame(self):
+        header = self.recv_exact(HEADER_SIZE)
+        if header is None:
+            return None
+
+        message_length = int.from_bytes(header, 'big')
+        if message_length > MAX_FRAME_SIZE:
+            raise ValueError(f"Frame of {message_length} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+
+        payload = self.recv_exact(message_length)
+        if payload is None:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        return payload
+
+    def read_message(self):
+        payload = self.read_frame()
+        if payload is None:
+            return None
+        return str(payload, 'utf-8')
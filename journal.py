@@ -0,0 +1,211 @@
+import os
+import mmap
+import zlib
+import struct
+import logging
+import threading
+from framing import HEADER_SIZE, encode_frame
+from protocol import encode_op, format_command, encode_snapshot, decode_ops, parse_commands, is_binary
+
+logger = logging.getLogger('WhiteboardServer.journal')
+
+FSYNC_INTERVAL = 0.2        # seconds between batched fsyncs of the journal
+CHECKPOINT_EVERY = 5000     # journal records between checkpoints
+
+# On disk a board is a series of generations. checkpoint-<n>.snap holds the board as it was when
+# generation n started (a SNAPSHOT payload) and journal-<n>.log every op applied after that, each
+# record length prefixed like a frame on the wire. Recovery loads the newest checkpoint and replays
+# the journals from that generation on. Once a newer checkpoint is safely on disk the older files
+# are deleted, so the journal never grows past CHECKPOINT_EVERY records plus one checkpoint.
+def checkpoint_path(directory, generation):
+    return os.path.join(directory, f"checkpoint-{generation:08d}.snap")
+
+def journal_path(directory, generation):
+    return os.path.join(directory, f"journal-{generation:08d}.log")
+
+def _generations(directory, prefix):
+    generations = []
+    for name in os.listdir(directory):
+        if name.startswith(prefix + "-") and not name.endswith(".tmp"):
+            try:
+                generations.append(int(name[len(prefix) + 1:].split(".")[0]))
+            except ValueError:
+                pass
+    return sorted(generations)
+
+def _decode_record(payload):
+    if is_binary(payload):
+        return decode_ops(payload)
+    return parse_commands(str(payload, 'utf-8'))
+
+#func to read the ops of a journal through mmap, returns (ops, length of the intact part) so a
+# record torn by a crash can be cut off before appending resumes
+def read_journal(path):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return [], 0
+
+    ops = []
+    offset = 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            end = len(view)
+            while offset + HEADER_SIZE <= end:
+                length = int.from_bytes(view[offset:offset + HEADER_SIZE], 'big')
+                if offset + HEADER_SIZE + length > end:
+                    break
+                # the slice is released before the mmap closes, even when decoding it fails
+                with view[offset + HEADER_SIZE:offset + HEADER_SIZE + length] as record:
+                    try:
+                        ops.extend(_decode_record(record))
+                    except (ValueError, IndexError, struct.error, zlib.error) as e:
+                        # the record is whole, only what it holds is lost
+                        logger.warning(f"Skipping a corrupt record of {path} at {offset}: {e}")
+                offset += HEADER_SIZE + length
+    return ops, offset
+
+def read_checkpoint(path):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with memoryview(mapped) as view:
+            _, ops, open_ids = decode_ops(view)[0]
+    return ops, open_ids
+
+#func to fsync a duplicated file descriptor and close it, the file itself may be closed by then
+def _fsync(fd):
+    try:
+        os.fsync(fd)
+    except OSError as e:
+        logger.error(f"Failed to sync the journal: {e}")
+    finally:
+        os.close(fd)
+
+class Journal:
+    def __init__(self, directory, fsync_interval=FSYNC_INTERVAL, checkpoint_every=CHECKPOINT_EVERY):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.checkpoint_every = checkpoint_every
+        self.generation = 0
+        self.records = 0
+        self.file = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.checkpointed = 0   # newest generation with its checkpoint on disk
+        self.closed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    #func to rebuild a board from disk and then start journaling into it
+    def restore(self, board):
+        checkpoints = _generations(self.directory, "checkpoint")
+        journals = _generations(self.directory, "journal")
+
+        start = 0
+        for generation in reversed(checkpoints):
+            try:
+                ops, open_ids = read_checkpoint(checkpoint_path(self.directory, generation))
+            except Exception as e:
+                logger.warning(f"Skipping unreadable checkpoint {generation}: {e}")
+                continue
+            board.restore(ops, open_ids)
+            start = self.checkpointed = generation
+            break
+
+        self.generation = max([start] + journals)
+        for generation in journals:
+            if generation < start:
+                continue
+            path = journal_path(self.directory, generation)
+            ops, intact = read_journal(path)
+            board.apply_all(ops)
+            if generation == self.generation:
+                self.records = len(ops)
+                if intact < os.path.getsize(path):
+                    os.truncate(path, intact)
+
+        self.file = open(journal_path(self.directory, self.generation), 'ab')
+        board.journal = self
+        threading.Thread(target=self.fsync_loop, daemon=True).start()
+
+    #func to append one applied op, called under the board lock so records keep the board's order.
+    # Returns True once a checkpoint is due
+    def append(self, op):
+        record = encode_op(op) or format_command(op).encode()
+        with self.lock:
+            if self.file is None:
+                return False
+            self.file.write(encode_frame(record))
+            self.dirty = True
+            self.records += 1
+            return self.records >= self.checkpoint_every
+
+    #func to start a new generation from the given board contents. The new journal is opened right
+    # away, the old one is synced and the checkpoint written in the background
+    def checkpoint(self, ops, open_ids):
+        with self.lock:
+            previous = self._flush()
+            self.file.close()
+            self.generation += 1
+            self.records = 0
+            self.file = open(journal_path(self.directory, self.generation), 'ab')
+            generation = self.generation
+        threading.Thread(target=self.write_checkpoint, args=(generation, ops, open_ids, previous), daemon=True).start()
+
+    #func to write the checkpoint starting generation, after syncing the previous journal (a file
+    # descriptor from _flush) when given. Checkpoints are written one at a time, newest wins
+    def write_checkpoint(self, generation, ops, open_ids, previous=None):
+        if previous is not None:
+            _fsync(previous)
+        with self.checkpoint_lock:
+            if generation <= self.checkpointed:
+                return      # a newer one got there first
+            path = checkpoint_path(self.directory, generation)
+            try:
+                with open(path + ".tmp", 'wb') as f:
+                    f.write(encode_snapshot(ops, open_ids))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(path + ".tmp", path)
+            except Exception as e:
+                logger.error(f"Failed to write checkpoint {generation}: {e}")
+                return
+            self.checkpointed = generation
+
+            # everything before this generation is now covered by the checkpoint
+            for old in _generations(self.directory, "checkpoint"):
+                if old < generation:
+                    os.remove(checkpoint_path(self.directory, old))
+            for old in _generations(self.directory, "journal"):
+                if old < generation:
+                    os.remove(journal_path(self.directory, old))
+            logger.info(f"Checkpoint {generation} written ({len(ops)} ops)")
+
+    #func to sync the journal every fsync_interval. Only the flush holds the lock, appends (which
+    # hold the board lock) never wait for the disk
+    def fsync_loop(self):
+        while not self.closed.wait(self.fsync_interval):
+            with self.lock:
+                fd = self._flush()
+            if fd is not None:
+                _fsync(fd)
+
+    #func to flush what was appended since the last sync, returns a duplicate of the journal's file
+    # descriptor to fsync without the lock (and to close afterwards), None when nothing was appended
+    def _flush(self):
+        if not self.dirty or self.file is None:
+            return None
+        self.file.flush()
+        self.dirty = False
+        return os.dup(self.file.fileno())
+
+    def _sync(self):
+        if self.dirty:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.dirty = False
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            if self.file:
+                self._sync()
+                self.file.close()
+                self.file = None
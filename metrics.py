@@ -0,0 +1,138 @@
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('WhiteboardServer.metrics')
+
+BROADCAST_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+HANDSHAKE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, lines):
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+# Counters and histograms the server updates on its hot paths, plus gauges read when scraped. The
+# server only creates one when METRICS_PORT is set and checks for None before every update, so
+# running without metrics costs one comparison per message. Rates (ops per second and so on) are
+# left to Prometheus, which derives them from the counters with rate()
+class Metrics:
+    def __init__(self):
+        self.ops = defaultdict(int)     # command -> ops received from clients
+        self.messages = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.broadcast = Histogram(BROADCAST_BUCKETS)
+        self.handshake = Histogram(HANDSHAKE_BUCKETS)
+        self.gauges = []    # (name, help, collect) where collect() returns [(labels dict, value)]
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def add_gauge(self, name, help_text, collect):
+        self.gauges.append((name, help_text, collect))
+
+    def received(self, message, size):
+        with self.lock:
+            self.messages += 1
+            self.bytes_in += size
+            for op in message.ops:
+                self.ops[op[0]] += 1
+
+    def sent(self, size):
+        with self.lock:
+            self.bytes_out += size
+
+    def observe_broadcast(self, seconds):
+        with self.lock:
+            self.broadcast.observe(seconds)
+
+    def observe_handshake(self, seconds):
+        with self.lock:
+            self.handshake.observe(seconds)
+
+    #func to get everything in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            lines += ["# HELP whiteboard_ops_received_total Ops received from clients, by command",
+                      "# TYPE whiteboard_ops_received_total counter"]
+            lines += [f'whiteboard_ops_received_total{{command="{command}"}} {count}'
+                      for command, count in sorted(self.ops.items())]
+            lines += ["# HELP whiteboard_messages_received_total Messages received from clients",
+                      "# TYPE whiteboard_messages_received_total counter",
+                      f"whiteboard_messages_received_total {self.messages}",
+                      "# HELP whiteboard_bytes_received_total Bytes of frames received from clients",
+                      "# TYPE whiteboard_bytes_received_total counter",
+                      f"whiteboard_bytes_received_total {self.bytes_in}",
+                      "# HELP whiteboard_bytes_sent_total Bytes of frames sent to clients",
+                      "# TYPE whiteboard_bytes_sent_total counter",
+                      f"whiteboard_bytes_sent_total {self.bytes_out}",
+                      "# HELP whiteboard_broadcast_seconds Time to fan one message out to a room",
+                      "# TYPE whiteboard_broadcast_seconds histogram"]
+            self.broadcast.render("whiteboard_broadcast_seconds", lines)
+            lines += ["# HELP whiteboard_tls_handshake_seconds Time the TLS handshake of a new connection took",
+                      "# TYPE whiteboard_tls_handshake_seconds histogram"]
+            self.handshake.render("whiteboard_tls_handshake_seconds", lines)
+
+        for name, help_text, collect in self.gauges:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.warning(f"Failed to collect {name}: {e}")
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            lines += [f"{name}{format_labels(labels)} {value}" for labels, value in samples]
+
+        lines += ["# HELP whiteboard_start_time_seconds When the server started, as a unix timestamp",
+                  "# TYPE whiteboard_start_time_seconds gauge",
+                  f"whiteboard_start_time_seconds {self.started}"]
+        return "\n".join(lines) + "\n"
+
+    #func to serve /metrics over plain HTTP on a background thread
+    def serve(self, host, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass    # scrapes are not worth a log line each
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"Metrics available on http://{host}:{port}/metrics")
+        return server
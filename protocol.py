@@ -0,0 +1,565 @@
+import struct
+import zlib
+from framing import encode_frame, HEADER_SIZE, MAX_FRAME_SIZE
+
+# Version 1 is the original space separated text commands, version 2 adds the binary encoding,
+# version 3 adds strokes, version 4 board snapshots, version 5 sequence numbers, version 6 rooms,
+# version 7 viewports, version 8 op ids, version 9 pacing and version 10 compression. A client opens
+# with "HELLO <version> room=<name>" (plus "view=<x1>,<y1>,<x2>,<y2>" to only be sent what it can see)
+# and a server that understands it answers "WELCOME <version> <board epoch>". Old servers never
+# answer, so both sides keep talking text until WELCOME arrives. A reconnecting client adds
+# "epoch=<board epoch> seq=<last seq>" to its HELLO to get only the ops it missed (version 5 sent the
+# two positionally). A client from version 10 on may add "compress=zlib", and when the WELCOME has
+# it too either side may send compressed frames from then on (see StreamCompressor).
+PROTOCOL_VERSION = 10
+BINARY_VERSION = 2
+STROKE_VERSION = 3
+SNAPSHOT_VERSION = 4
+SEQ_VERSION = 5
+ROOM_VERSION = 6
+VIEW_VERSION = 7
+OPID_VERSION = 8
+PACE_VERSION = 9
+COMPRESS_VERSION = 10
+SNAPSHOT_COMPRESSION_LEVEL = 6
+STREAM_COMPRESSION_LEVEL = 6
+STREAM_MAX_FRAME = 32 * 1024    # frames bigger than this (snapshots, which are compressed already) go out as they are
+SYNC_FLUSH_TAIL = b"\x00\x00\xff\xff"  # every sync flush ends with these, so they are left off and added back
+
+# Ops are plain tuples, the same shape as the text commands:
+#   ("LINE", x1, y1, x2, y2, colour, width)
+#   ("RECT", x1, y1, x2, y2, colour, width)
+#   ("CIRC", x, y, radius, colour, width)
+#   ("TEXT", x, y, colour, text)
+#   ("UNDO",)   ("CLEAR",)
+#   ("UNDO", author, n)     takes back the entry with that op id, wherever it is on the board
+#   ("STROKE", stroke_id, colour, width, points)     points is a flat x1, y1, x2, y2, ... sequence
+#   ("STROKEEND", stroke_id)
+#   ("SNAPSHOT", ops, open_stroke_ids)     the whole board, only ever sent by the server
+#   ("SEQ", seq)    sent by the server ahead of the ops of a message: seq of the last of them
+#   ("VIEW", x1, y1, x2, y2)    sent by a client: the part of the board it wants to be sent from now on
+#   ("OPID", author, n)     the id of the entry the next op starts: author is a random client id,
+#                           n counts that client's entries. Redo sends an op again under its old id
+#   ("PACE", ms)    sent by the server when a client sends faster than it is allowed to: wait at least
+#                   ms between stroke chunks from now on, 0 lifts it
+# A pen stroke is sent as several STROKE chunks sharing an id, each chunk starting with the last
+# point of the one before, and STROKEEND once the pen is lifted.
+# Clients from OPID_VERSION on put OPID ahead of every entry they start and undo their own entries by
+# id. The server gives entries from older clients ids with author 0 so every entry on the board has one.
+DRAWING_COMMANDS = ("LINE", "RECT", "CIRC", "TEXT")
+STROKE_COMMANDS = ("STROKE", "STROKEEND")
+DEFAULT_WIDTH = 2
+
+# Binary opcodes stay below 0x20 so a binary payload can never be mistaken for a text command
+OP_LINE = 0x01
+OP_RECT = 0x02
+OP_CIRC = 0x03
+OP_TEXT = 0x04
+OP_UNDO = 0x05
+OP_CLEAR = 0x06
+OP_STROKE = 0x07
+OP_STROKE_END = 0x08
+OP_SNAPSHOT = 0x09
+OP_SEQ = 0x0A       # followed by the sequence number as a varint
+OP_VIEW = 0x0B
+OP_OPID = 0x0C
+OP_UNDO_ID = 0x0D
+OP_PACE = 0x0E
+OP_COMPRESSED = 0x0F    # starts a frame of a compressed connection, never appears among ops
+
+BOX_STRUCT = struct.Struct(">B4h3sB")       # opcode, x1, y1, x2, y2, rgb, width
+CIRC_STRUCT = struct.Struct(">B3h3sB")      # opcode, x, y, radius, rgb, width
+TEXT_STRUCT = struct.Struct(">B2h3sH")      # opcode, x, y, rgb, utf-8 length, then the text
+OPCODE_STRUCT = struct.Struct(">B")
+STROKE_STRUCT = struct.Struct(">BI3sBH")    # opcode, stroke id, rgb, width, point count, then the
+                                            # first point as int16 and zigzag varint deltas after it
+POINT_STRUCT = struct.Struct(">2h")
+STROKE_END_STRUCT = struct.Struct(">BI")    # opcode, stroke id
+SNAPSHOT_STRUCT = struct.Struct(">BBHI")    # opcode, inner format, open stroke count, compressed
+                                            # length, then the open stroke ids and the zlib data
+SNAPSHOT_TEXT, SNAPSHOT_BINARY = 0, 1
+VIEW_STRUCT = struct.Struct(">B4i")     # opcode, x1, y1, x2, y2
+OPID_STRUCT = struct.Struct(">BII")     # opcode, author, n (also used by UNDO with an id)
+PACE_STRUCT = struct.Struct(">BH")      # opcode, milliseconds
+
+OPCODES = {"LINE": OP_LINE, "RECT": OP_RECT, "UNDO": OP_UNDO, "CLEAR": OP_CLEAR}
+INT16_MIN, INT16_MAX = -32768, 32767
+
+
+def hello_message(epoch=None, last_seq=None, room=None, view=None, compress=False):
+    parts = [f"HELLO {PROTOCOL_VERSION}"]
+    if room:
+        parts.append(f"room={room}")
+    if view:
+        parts.append("view=" + ",".join(str(int(value)) for value in view))
+    if epoch is not None and last_seq is not None:
+        parts += [f"epoch={epoch}", f"seq={last_seq}"]
+    if compress:
+        parts.append("compress=zlib")
+    return " ".join(parts)
+
+def welcome_message(version, epoch=None, compress=False):
+    if epoch is not None and version >= SEQ_VERSION:
+        message = f"WELCOME {version} {epoch}"
+    else:
+        message = f"WELCOME {version}"
+    if compress and version >= COMPRESS_VERSION:
+        message += " compress=zlib"
+    return message
+
+#func to check whether a HELLO asks for (or a WELCOME agrees to) a compressed connection
+def wants_compression(message):
+    return negotiated_version(message) >= COMPRESS_VERSION and "compress=zlib" in message.split()[2:]
+
+#func to pick the version both sides speak from a HELLO or WELCOME message
+def negotiated_version(message):
+    parts = message.split()
+    try:
+        return min(int(parts[1]), PROTOCOL_VERSION)
+    except (IndexError, ValueError):
+        return 1
+
+#func to read a HELLO or WELCOME message, returns (version, board epoch, last seq, room, view) with
+# None for the fields that were not sent
+def parse_handshake(message):
+    parts = message.split()[2:]
+    fields = dict(part.split("=", 1) for part in parts if "=" in part)
+    positional = [part for part in parts if "=" not in part]
+
+    epoch = fields.get("epoch", positional[0] if positional else None)
+    seq = fields.get("seq", positional[1] if len(positional) > 1 else None)
+    try:
+        last_seq = int(seq) if seq is not None else None
+    except ValueError:
+        last_seq = None
+    try:
+        view = tuple(int(value) for value in fields["view"].split(","))
+        view = view if len(view) == 4 else None
+    except (KeyError, ValueError):
+        view = None
+    return negotiated_version(message), epoch, last_seq, fields.get("room"), view
+
+def is_binary(payload):
+    return len(payload) > 0 and payload[0] < 0x20
+
+#func to turn one text command into an op tuple, returns None for anything it does not recognise
+def parse_command(command):
+    parts = command.split(None, 4) if command.startswith("TEXT") else command.split()
+    if not parts:
+        return None
+
+    cmd = parts[0]
+    try:
+        if cmd in ("LINE", "RECT") and len(parts) >= 6:
+            x1, y1, x2, y2 = map(int, parts[1:5])
+            width = int(parts[6]) if len(parts) > 6 else DEFAULT_WIDTH
+            return (cmd, x1, y1, x2, y2, parts[5], width)
+
+        elif cmd == "CIRC" and len(parts) >= 5:
+            x, y, radius = map(int, parts[1:4])
+            width = int(parts[5]) if len(parts) > 5 else DEFAULT_WIDTH
+            return (cmd, x, y, radius, parts[4], width)
+
+        elif cmd == "TEXT" and len(parts) >= 4:
+            x, y = map(int, parts[1:3])
+            text = parts[4] if len(parts) > 4 else ""
+            return (cmd, x, y, parts[3], text)
+
+        elif cmd in ("UNDO", "CLEAR") and len(parts) == 1:
+            return (cmd,)
+
+        elif cmd in ("UNDO", "OPID") and len(parts) == 3:
+            return (cmd, int(parts[1]), int(parts[2]))
+
+        elif cmd == "STROKE" and len(parts) >= 6 and len(parts) % 2 == 0:
+            return (cmd, int(parts[1]), parts[2], int(parts[3]), tuple(map(int, parts[4:])))
+
+        elif cmd == "STROKEEND" and len(parts) == 2:
+            return (cmd, int(parts[1]))
+
+        elif cmd in ("SEQ", "PACE") and len(parts) == 2:
+            return (cmd, int(parts[1]))
+
+        elif cmd == "VIEW" and len(parts) == 5:
+            return (cmd,) + tuple(map(int, parts[1:5]))
+    except ValueError:
+        pass
+    return None
+
+def parse_commands(data):
+    ops = []
+    for command in data.split("\n"):
+        op = parse_command(command)
+        if op:
+            ops.append(op)
+    return ops
+
+#func to rewrite ops for a client older than OPID_VERSION: no OPID, and UNDO without an id
+def plain_ops(ops):
+    return [("UNDO",) if op[0] == "UNDO" else op for op in ops if op[0] != "OPID"]
+
+def format_command(op):
+    if op[0] == "STROKE":
+        op = op[:4] + tuple(op[4])
+    return " ".join(str(part) for part in op)
+
+#func to rewrite strokes as the LINE segments a client older than STROKE_VERSION understands
+def legacy_ops(ops):
+    legacy = []
+    for op in ops:
+        if op[0] == "STROKE":
+            _, _, colour, width, points = op
+            for i in range(0, len(points) - 2, 2):
+                legacy.append(("LINE", points[i], points[i + 1], points[i + 2], points[i + 3], colour, width))
+        elif op[0] != "STROKEEND":
+            legacy.append(op)
+    return legacy
+
+def _write_varint(out, value):
+    value = (value << 1) ^ (value >> 63)    # zigzag so small negative deltas stay small
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(payload, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = payload[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (value >> 1) ^ -(value & 1), offset
+        shift += 7
+
+def _pack_colour(colour):
+    if len(colour) != 7 or colour[0] != "#":
+        return None
+    try:
+        return bytes.fromhex(colour[1:])
+    except ValueError:
+        return None
+
+def _fits(*values):
+    return all(INT16_MIN <= value <= INT16_MAX for value in values)
+
+#func to encode one op in binary, returns None when the op can only be expressed as text
+# (named colours, coordinates outside int16 and so on)
+def encode_op(op):
+    cmd = op[0]
+    if cmd in ("UNDO", "OPID") and len(op) == 3:
+        if not (0 <= op[1] <= 0xFFFFFFFF and 0 <= op[2] <= 0xFFFFFFFF):
+            return None
+        return OPID_STRUCT.pack(OP_OPID if cmd == "OPID" else OP_UNDO_ID, op[1], op[2])
+
+    if cmd in ("UNDO", "CLEAR"):
+        return OPCODE_STRUCT.pack(OPCODES[cmd])
+
+    if cmd == "STROKE":
+        _, stroke_id, colour, width, points = op
+        rgb = _pack_colour(colour)
+        count = len(points) // 2
+        if (rgb is None or not 0 <= stroke_id <= 0xFFFFFFFF or not 0 <= width <= 0xFF
+                or not 0 < count <= 0xFFFF or not _fits(*points)):
+            return None
+        out = bytearray(STROKE_STRUCT.pack(OP_STROKE, stroke_id, rgb, width, count))
+        out += POINT_STRUCT.pack(points[0], points[1])
+        for i in range(2, len(points)):
+            _write_varint(out, points[i] - points[i - 2])
+        return bytes(out)
+
+    if cmd == "STROKEEND":
+        if not 0 <= op[1] <= 0xFFFFFFFF:
+            return None
+        return STROKE_END_STRUCT.pack(OP_STROKE_END, op[1])
+
+    if cmd == "SEQ":
+        out = bytearray(OPCODE_STRUCT.pack(OP_SEQ))
+        _write_varint(out, op[1])
+        return bytes(out)
+
+    if cmd == "PACE":
+        return PACE_STRUCT.pack(OP_PACE, max(0, min(op[1], 0xFFFF)))
+
+    if cmd == "VIEW":
+        if not all(-0x80000000 <= value <= 0x7FFFFFFF for value in op[1:]):
+            return None
+        return VIEW_STRUCT.pack(OP_VIEW, *op[1:])
+
+    if cmd == "TEXT":
+        _, x, y, colour, text = op
+        rgb = _pack_colour(colour)
+        text_bytes = text.encode()
+        if rgb is None or not _fits(x, y) or len(text_bytes) > 0xFFFF:
+            return None
+        return TEXT_STRUCT.pack(OP_TEXT, x, y, rgb, len(text_bytes)) + text_bytes
+
+    if cmd in ("LINE", "RECT"):
+        _, x1, y1, x2, y2, colour, width = op
+        rgb = _pack_colour(colour)
+        if rgb is None or not _fits(x1, y1, x2, y2) or not 0 <= width <= 0xFF:
+            return None
+        return BOX_STRUCT.pack(OPCODES[cmd], x1, y1, x2, y2, rgb, width)
+
+    if cmd == "CIRC":
+        _, x, y, radius, colour, width = op
+        rgb = _pack_colour(colour)
+        if rgb is None or not _fits(x, y, radius) or not 0 <= width <= 0xFF:
+            return None
+        return CIRC_STRUCT.pack(OP_CIRC, x, y, radius, rgb, width)
+
+    return None
+
+#func to encode several ops as one binary payload, or None if any of them needs text
+def encode_ops(ops):
+    encoded = []
+    for op in ops:
+        op_bytes = encode_op(op)
+        if op_bytes is None:
+            return None
+        encoded.append(op_bytes)
+    return b"".join(encoded)
+
+#func to decode a binary payload (bytes or memoryview) holding one or more ops
+def decode_ops(payload):
+    ops = []
+    offset = 0
+    end = len(payload)
+    while offset < end:
+        opcode = payload[offset]
+
+        if opcode in (OP_LINE, OP_RECT):
+            _, x1, y1, x2, y2, rgb, width = BOX_STRUCT.unpack_from(payload, offset)
+            cmd = "LINE" if opcode == OP_LINE else "RECT"
+            ops.append((cmd, x1, y1, x2, y2, "#" + rgb.hex(), width))
+            offset += BOX_STRUCT.size
+
+        elif opcode == OP_CIRC:
+            _, x, y, radius, rgb, width = CIRC_STRUCT.unpack_from(payload, offset)
+            ops.append(("CIRC", x, y, radius, "#" + rgb.hex(), width))
+            offset += CIRC_STRUCT.size
+
+        elif opcode == OP_TEXT:
+            _, x, y, rgb, length = TEXT_STRUCT.unpack_from(payload, offset)
+            offset += TEXT_STRUCT.size
+            text = str(payload[offset:offset + length], 'utf-8')
+            ops.append(("TEXT", x, y, "#" + rgb.hex(), text))
+            offset += length
+
+        elif opcode == OP_UNDO:
+            ops.append(("UNDO",))
+            offset += 1
+
+        elif opcode == OP_CLEAR:
+            ops.append(("CLEAR",))
+            offset += 1
+
+        elif opcode == OP_STROKE:
+            _, stroke_id, rgb, width, count = STROKE_STRUCT.unpack_from(payload, offset)
+            offset += STROKE_STRUCT.size
+            points = list(POINT_STRUCT.unpack_from(payload, offset))
+            offset += POINT_STRUCT.size
+            for i in range(2, count * 2):
+                delta, offset = _read_varint(payload, offset)
+                points.append(points[i - 2] + delta)
+            ops.append(("STROKE", stroke_id, "#" + rgb.hex(), width, tuple(points)))
+
+        elif opcode == OP_STROKE_END:
+            _, stroke_id = STROKE_END_STRUCT.unpack_from(payload, offset)
+            ops.append(("STROKEEND", stroke_id))
+            offset += STROKE_END_STRUCT.size
+
+        elif opcode == OP_SNAPSHOT:
+            _, inner_format, open_count, length = SNAPSHOT_STRUCT.unpack_from(payload, offset)
+            offset += SNAPSHOT_STRUCT.size
+            open_ids = struct.unpack_from(f">{open_count}I", payload, offset)
+            offset += 4 * open_count
+            inner = zlib.decompress(payload[offset:offset + length])
+            offset += length
+            board_ops = decode_ops(inner) if inner_format == SNAPSHOT_BINARY else parse_commands(inner.decode())
+            ops.append(("SNAPSHOT", board_ops, set(open_ids)))
+
+        elif opcode == OP_SEQ:
+            seq, offset = _read_varint(payload, offset + 1)
+            ops.append(("SEQ", seq))
+
+        elif opcode in (OP_OPID, OP_UNDO_ID):
+            _, author, n = OPID_STRUCT.unpack_from(payload, offset)
+            ops.append(("OPID" if opcode == OP_OPID else "UNDO", author, n))
+            offset += OPID_STRUCT.size
+
+        elif opcode == OP_PACE:
+            ops.append(("PACE", PACE_STRUCT.unpack_from(payload, offset)[1]))
+            offset += PACE_STRUCT.size
+
+        elif opcode == OP_VIEW:
+            ops.append(("VIEW",) + VIEW_STRUCT.unpack_from(payload, offset)[1:])
+            offset += VIEW_STRUCT.size
+
+        else:
+            raise ValueError(f"Unknown binary opcode {opcode:#x}")
+    return ops
+
+#func to pack the whole board into one compressed SNAPSHOT payload
+def encode_snapshot(ops, open_ids=()):
+    inner = encode_ops(ops)
+    inner_format = SNAPSHOT_BINARY
+    if inner is None:
+        inner = "\n".join(format_command(op) for op in ops).encode()
+        inner_format = SNAPSHOT_TEXT
+
+    compressed = zlib.compress(inner, SNAPSHOT_COMPRESSION_LEVEL)
+    open_ids = list(open_ids)
+    return (SNAPSHOT_STRUCT.pack(OP_SNAPSHOT, inner_format, len(open_ids), len(compressed))
+            + struct.pack(f">{len(open_ids)}I", *open_ids) + compressed)
+
+def is_compressed(payload):
+    return len(payload) > 0 and payload[0] == OP_COMPRESSED
+
+# Sending side of a compressed connection. Everything it sends is one zlib stream, so repeated
+# colours, widths and nearby coordinates compress against all the traffic before them, not just
+# within one frame. Each compressed frame is OP_COMPRESSED followed by the next piece of the stream
+# (raw deflate), sync flushed so it inflates on arrival to one or more complete frames. The four bytes
+# every sync flush ends with are not sent, as in WebSocket's permessage-deflate. Frames over STREAM_MAX_FRAME
+# are sent as they are, the receiver tells the two apart by their first byte
+class StreamCompressor:
+    def __init__(self, level=STREAM_COMPRESSION_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    #func to turn encoded frames, in order, into the frames to put on the wire: runs of small frames
+    # become one compressed frame, big ones are passed through
+    def pack(self, frames):
+        packed = []
+        batch = []
+        for frame in frames:
+            if len(frame) > STREAM_MAX_FRAME:
+                if batch:
+                    packed.append(self.compress(b"".join(batch)))
+                    batch = []
+                packed.append(frame)
+            else:
+                batch.append(frame)
+        if batch:
+            packed.append(self.compress(b"".join(batch)))
+        return packed
+
+    def compress(self, data):
+        compressor = self.compressor
+        data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        return encode_frame(bytes((OP_COMPRESSED,)) + data[:-len(SYNC_FLUSH_TAIL)])
+
+# Receiving side of a compressed connection, see StreamCompressor
+class StreamDecompressor:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    #func to get the payloads of the frames a compressed payload holds
+    def payloads(self, payload):
+        decompressor = self.decompressor
+        data = decompressor.decompress(bytes(payload[1:]) + SYNC_FLUSH_TAIL, MAX_FRAME_SIZE)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed frame inflates to more than {MAX_FRAME_SIZE} bytes")
+
+        payloads = []
+        offset = 0
+        while offset < len(data):
+            length = int.from_bytes(data[offset:offset + HEADER_SIZE], 'big')
+            offset += HEADER_SIZE
+            if offset + length > len(data):
+                raise ValueError("Compressed frame ends in the middle of a frame")
+            payloads.append(data[offset:offset + length])
+            offset += length
+        return payloads
+
+#func to merge queued payloads into as few payloads as possible: binary ops are self delimiting
+# and are simply concatenated, text commands are joined with newlines
+def coalesce_payloads(payloads):
+    runs = []
+    for payload in payloads:
+        binary = is_binary(payload)
+        if runs and runs[-1][0] == binary:
+            runs[-1][1].append(payload)
+        else:
+            runs.append((binary, [payload]))
+    return [(b"" if binary else b"\n").join(group) for binary, group in runs]
+
+# One message on its way to many peers. The sender's own encoding is reused as is when it suits the
+# recipient, any other encoding is only built (once) if some recipient needs it. Once the server has
+# applied it, seq is set and clients from SEQ_VERSION on get it ahead of the ops.
+# The server also rewrites ops to carry op ids. Clients older than OPID_VERSION get them stripped,
+# and if an UNDO took back something other than the newest entry (which an UNDO without an id
+# cannot express) resync tells the server to send them the board again instead. Clients older than
+# STROKE_VERSION hold a stroke as one item per LINE segment, so they need it again after any stroke
+# is taken back.
+RESYNC_NONE, RESYNC_LEGACY, RESYNC_PLAIN, RESYNC_ALL = 0, 1, 2, 3
+
+class Message:
+    def __init__(self, ops, text=None, binary=None, text_only=False, seq=None):
+        self.ops = ops
+        self.text = text
+        self.binary = binary
+        self.text_only = text_only    # holds commands that have no binary form
+        self.has_strokes = any(op[0] in STROKE_COMMANDS for op in ops)
+        self.seq = seq
+        self.undone = {}    # set by the server: index of each UNDO in ops -> the op it took back
+        self.resync = RESYNC_NONE   # set by the server: which peers need the board again instead
+        self.frames = {}
+
+    @classmethod
+    def from_payload(cls, payload):
+        if is_binary(payload):
+            return cls(decode_ops(payload), binary=bytes(payload))
+        data = str(payload, 'utf-8')
+        ops = parse_commands(data)
+        commands = sum(1 for command in data.split("\n") if command.strip())
+        return cls(ops, text=data, text_only=len(ops) != commands)
+
+    #func to replace the ops after the server rewrote them, the sender's encodings no longer match
+    def set_ops(self, ops):
+        if ops != self.ops:
+            self.ops = ops
+            self.text = self.binary = None
+            self.text_only = False
+            self.frames = {}
+
+    #func to check whether a peer speaking the given version needs the board again instead of this
+    def needs_resync(self, version):
+        return (self.resync == RESYNC_ALL or (self.resync == RESYNC_PLAIN and version < OPID_VERSION)
+                or (self.resync == RESYNC_LEGACY and version < STROKE_VERSION))
+
+    def body(self, binary, legacy, ids=True):
+        ops = self.ops if ids else plain_ops(self.ops)
+        ops = legacy_ops(ops) if legacy else ops
+        original = ids and not legacy
+        if binary:
+            if self.binary is not None and original:
+                return self.binary
+            payload = encode_ops(ops)
+            if payload:
+                return payload
+            # fall back to text when some op has no binary form
+        if self.text is not None and original:
+            return self.text.encode()
+        return "\n".join(format_command(op) for op in ops).encode()
+
+    def payload(self, binary, legacy, sequenced, ids=True):
+        body = self.body(binary, legacy, ids)
+        if not sequenced or self.seq is None:
+            return body
+        if is_binary(body) or (binary and not body):
+            return encode_op(("SEQ", self.seq)) + body
+        return f"SEQ {self.seq}\n".encode() + body if body else f"SEQ {self.seq}".encode()
+
+    #func to get the frame for a peer speaking the given protocol version, encoded at most once per
+    # encoding. Returns None when there is nothing that peer understands (a STROKEEND for a legacy client)
+    def frame(self, version=1):
+        binary = version >= BINARY_VERSION and not self.text_only
+        legacy = version < STROKE_VERSION and self.has_strokes
+        sequenced = version >= SEQ_VERSION
+        ids = version >= OPID_VERSION
+        key = (binary, legacy, sequenced, ids)
+        if key not in self.frames:
+            payload = self.payload(binary, legacy, sequenced, ids)
+            self.frames[key] = encode_frame(payload) if payload else None
+        return self.frames[key]
@@ -0,0 +1,170 @@
+import math
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageColor, ImageFont
+from spatial import SpatialGrid, op_bounds, intersects, scale_op
+
+TILE_SIZE = 512     # pixels per side of one raster tile
+TILE_CACHE_SIZE = 48    # tiles a client keeps drawn (1 MB each), enough for a large window and then some
+MAX_FLATTENED_OPS = 10000   # flattened shapes a client keeps, as many as the server's board
+
+#func to turn a Tk colour (#rrggbb or a name) into RGB, unknown names come out black
+def parse_colour(colour):
+    try:
+        return ImageColor.getrgb(colour)
+    except ValueError:
+        return (0, 0, 0)
+
+#func to draw an op with PIL the way the Tk canvas would, shifted left and up by dx, dy
+def draw_op(draw, op, dx=0, dy=0):
+    cmd = op[0]
+    if cmd == "LINE":
+        _, x1, y1, x2, y2, colour, width = op
+        draw.line([(x1 - dx, y1 - dy), (x2 - dx, y2 - dy)], fill=parse_colour(colour), width=width)
+
+    elif cmd == "RECT":
+        _, x1, y1, x2, y2, colour, width = op
+        box = [min(x1, x2) - dx, min(y1, y2) - dy, max(x1, x2) - dx, max(y1, y2) - dy]
+        draw.rectangle(box, outline=parse_colour(colour), width=width)
+
+    elif cmd == "CIRC":
+        _, x, y, radius, colour, width = op
+        draw.ellipse([x - radius - dx, y - radius - dy, x + radius - dx, y + radius - dy],
+                     outline=parse_colour(colour), width=width)
+
+    elif cmd == "TEXT":
+        _, x, y, colour, text = op
+        draw.text((x - dx, y - dy), text, fill=parse_colour(colour), font=ImageFont.load_default(), anchor="mm")
+
+    elif cmd == "STROKE":
+        _, _, colour, width, points = op
+        xy = [(points[i] - dx, points[i + 1] - dy) for i in range(0, len(points) - 1, 2)]
+        if len(xy) >= 2:
+            draw.line(xy, fill=parse_colour(colour), width=width, joint="curve")
+
+#func to check whether a (zoomed) op leaves a mark anywhere in box. RECT and CIRC are outlines, so
+# a box in their hollow middle (or outside a circle's ring) is not touched even though it is in bounds
+def touches(op, box):
+    bounds = op_bounds(op)
+    if bounds is None or not intersects(bounds, box):
+        return False
+    cmd = op[0]
+    if cmd == "RECT":
+        _, x1, y1, x2, y2, _, width = op
+        pad = width + 1
+        return not (min(x1, x2) + pad < box[0] and min(y1, y2) + pad < box[1]
+                    and box[2] < max(x1, x2) - pad and box[3] < max(y1, y2) - pad)
+    if cmd == "CIRC":
+        _, x, y, radius, _, width = op
+        far_x, far_y = max(abs(box[0] - x), abs(box[2] - x)), max(abs(box[1] - y), abs(box[3] - y))
+        near_x, near_y = max(box[0] - x, 0, x - box[2]), max(box[1] - y, 0, y - box[3])
+        inner, outer = radius - width - 1, radius + width + 1
+        inside = inner > 0 and far_x * far_x + far_y * far_y < inner * inner
+        return not inside and near_x * near_x + near_y * near_y <= outer * outer
+    return True
+
+# Board contents flattened into fixed size transparent tiles, so drawing a long history costs a few
+# images instead of one item per op. Flattened ops are kept in a spatial index and a tile is only
+# drawn when something asks for it (the tiles on screen), from the ops that reach into it, at the
+# current zoom. At most max_tiles tiles are kept, least recently used go first, and tiles nothing is
+# drawn on are never allocated. Past max_ops flattened ops the oldest are dropped, as the server's
+# board drops them
+class TileCache:
+    def __init__(self, tile_size=TILE_SIZE, max_tiles=TILE_CACHE_SIZE, max_ops=MAX_FLATTENED_OPS):
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.max_ops = max_ops
+        self.zoom = 1.0     # tile pixels per board unit
+        self.index = SpatialGrid()  # the flattened ops, in board coordinates
+        self.entries = OrderedDict()    # id(op) -> (op id or None, op), oldest first
+        self.ids = {}       # op id -> op
+        self.tiles = OrderedDict()  # (column, row) -> RGBA image, None when nothing is drawn on it
+
+    def __len__(self):
+        return len(self.entries)
+
+    #func to draw the tiles at another zoom from now on, the ones drawn so far are thrown away
+    def set_zoom(self, zoom):
+        self.zoom = zoom
+        self.tiles.clear()
+
+    #func to flatten an op (in board coordinates), returns the keys of the cached tiles it changed
+    def add(self, op, op_id=None):
+        if len(self.entries) >= self.max_ops:
+            self._discard(next(iter(self.entries)))
+        self.entries[id(op)] = (op_id, op)
+        if op_id:
+            self.ids[op_id] = op
+        self.index.insert(op)
+
+        scaled = scale_op(op, self.zoom)
+        changed = set()
+        for key, tile in list(self.tiles.items()):
+            box = self.tile_box(key)
+            if touches(scaled, box):
+                if tile is None:
+                    tile = self.tiles[key] = Image.new("RGBA", (self.tile_size,) * 2, (0, 0, 0, 0))
+                draw_op(ImageDraw.Draw(tile), scaled, box[0], box[1])
+                changed.add(key)
+        return changed
+
+    #func to take the op with op_id out again, returns the keys of the cached tiles that changed or
+    # None when it is not in the cache
+    def remove(self, op_id):
+        op = self.ids.get(op_id)
+        if op is None:
+            return None
+        return self._discard(id(op))
+
+    #func to take out the newest flattened op, returns what remove does
+    def pop(self):
+        if not self.entries:
+            return None
+        return self._discard(next(reversed(self.entries)))
+
+    def _discard(self, key):
+        op_id, op = self.entries.pop(key)
+        if op_id:
+            self.ids.pop(op_id, None)
+        self.index.remove(op)
+        # what was under it has to be drawn again, the tiles are drawn afresh when next asked for
+        scaled = scale_op(op, self.zoom)
+        changed = {key for key in self.tiles if touches(scaled, self.tile_box(key))}
+        for key in changed:
+            del self.tiles[key]
+        return changed
+
+    def tile_box(self, key):
+        size = self.tile_size
+        return key[0] * size, key[1] * size, (key[0] + 1) * size, (key[1] + 1) * size
+
+    #func to get the keys of the tiles covering area, in zoomed coordinates
+    def keys(self, area):
+        size = self.tile_size
+        x1, y1, x2, y2 = (math.floor(value / size) for value in area)
+        return [(column, row) for column in range(x1, x2 + 1) for row in range(y1, y2 + 1)]
+
+    #func to get the image of one tile, None when nothing is drawn on it
+    def tile(self, key):
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        box = self.tile_box(key)
+        zoom = self.zoom
+        image = None
+        for op in self.index.query(tuple(value / zoom for value in box)):
+            scaled = scale_op(op, zoom)
+            if touches(scaled, box):
+                if image is None:
+                    image = Image.new("RGBA", (self.tile_size,) * 2, (0, 0, 0, 0))
+                draw_op(ImageDraw.Draw(image), scaled, box[0], box[1])
+        self.tiles[key] = image
+        while len(self.tiles) > self.max_tiles:
+            self.tiles.popitem(last=False)
+        return image
+
+    def clear(self):
+        self.index.clear()
+        self.entries.clear()
+        self.ids.clear()
+        self.tiles.clear()
@@ -0,0 +1,289 @@
+import io
+import json
+import math
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from PIL import Image, ImageDraw
+from raster import TILE_SIZE, draw_op
+from spatial import op_bounds, union
+
+logger = logging.getLogger('WhiteboardServer.render')
+
+TILE_CACHE_SIZE = 256       # rendered tiles kept across all boards, least recently used go first
+THUMBNAIL_SIZE = 256        # default longest side of a thumbnail, in pixels
+MAX_THUMBNAIL_SIZE = 2048
+MAX_EXPORT_SIZE = 16384     # longest side of the board that is exported, bigger boards are cut off there
+MAX_EXPORT_PIXELS = 4096 * 4096     # most pixels of a full size export (48 MB as RGB), bigger boards are scaled down to fit
+PNG_COMPRESS_LEVEL = 1      # zlib level of exported PNGs, encoding dominates an export and higher saves little
+BACKGROUND = (255, 255, 255)    # what the Tk canvas shows where nothing is drawn
+
+tiles = OrderedDict()   # (room name, generation, column, row) -> RGB image
+tiles_lock = threading.Lock()
+
+def cached_tile(key):
+    with tiles_lock:
+        tile = tiles.get(key)
+        if tile is not None:
+            tiles.move_to_end(key)
+        return tile
+
+def cache_tile(key, tile):
+    with tiles_lock:
+        tiles[key] = tile
+        tiles.move_to_end(key)
+        while len(tiles) > TILE_CACHE_SIZE:
+            tiles.popitem(last=False)
+
+def drop_tile(key):
+    with tiles_lock:
+        tiles.pop(key, None)
+
+# A room's board as an image, for exporting without a GUI. The board is drawn into TILE_SIZE tiles
+# that are only rendered when an export needs them and then kept in the shared tile cache. Before
+# every export the renderer catches up on the ops applied since the last one (from the board's seq
+# ring): new shapes are drawn straight onto the cached tiles they land on, anything that changes
+# or removes what is already there (stroke chunks, UNDO) drops just the tiles it covers, CLEAR
+# drops them all. When the ring no longer reaches back far enough everything is rendered afresh
+class BoardRenderer:
+    def __init__(self, name, board):
+        self.name = name
+        self.board = board
+        self.generation = 0     # part of every tile key, bumped to drop all of this board's tiles at once
+        self.last_seq = None
+        self.offset = None      # board revision minus seq, only changes when the board is replaced
+        self.bounds = {}        # op id -> box of every entry on the board, to know what an UNDO uncovers
+        self.strokes = {}       # open stroke id -> op id
+        self.line_run = None    # op id of the newest LINE run, a LINE without an OPID extends it
+        self.thumbnail = None   # (seq, size, PNG) of the last thumbnail
+        self.export = None      # (seq, PNG) of the last full size export
+        self.lock = threading.Lock()
+
+    #func to forget every tile and start over from a snapshot of the board
+    def reset(self):
+        board = self.board
+        offset = board.revision - board.seq
+        _, seq, ops, _ = board.snapshot(ids=True)
+        self.generation += 1
+        self.bounds.clear()
+        self.strokes.clear()
+        self.line_run = None
+        op_id = None
+        for op in ops:
+            if op[0] == "OPID":
+                op_id = op[1:]
+                continue
+            bounds = op_bounds(op)
+            if bounds and op_id:
+                self.bounds[op_id] = bounds
+            op_id = None
+        self.last_seq = seq
+        self.offset = offset
+        self.thumbnail = None
+        self.export = None
+
+    #func to bring the cached tiles up to date with the board
+    def update(self):
+        board = self.board
+        if self.last_seq is None or board.revision - board.seq != self.offset:
+            self.reset()
+            return
+        changes = board.ops_since(self.last_seq)
+        # trimming the oldest entries off a full board is not in the ring either, so start over then too
+        if changes is None or len(self.bounds) > 2 * board.ops.maxlen:
+            self.reset()
+            return
+
+        ops, self.last_seq = changes
+        op_id = None
+        for op in ops:
+            cmd = op[0]
+            if cmd == "OPID":
+                op_id = op[1:]
+                continue
+
+            bounds = op_bounds(op)
+            if cmd == "CLEAR":
+                self.generation += 1
+                self.bounds.clear()
+                self.strokes.clear()
+                self.line_run = None
+            elif cmd == "UNDO":
+                # a plain UNDO may only take the last segment off a LINE run, which stays
+                undone = self.bounds.get(op[1:]) if op[1:] == self.line_run else self.bounds.pop(op[1:], None)
+                self.invalidate(undone)
+            elif cmd in ("RECT", "CIRC", "TEXT") and op_id:
+                self.bounds[op_id] = bounds
+                self.draw_on_top(op, bounds)
+            elif cmd in ("STROKE", "LINE"):
+                # chunks grow an entry that may already be under newer ones, and strokes are
+                # simplified once finished, so their area is drawn again rather than painted over
+                if cmd == "STROKE":
+                    entry = op_id or self.strokes.get(op[1])
+                    self.strokes[op[1]] = entry
+                else:
+                    entry = op_id or self.line_run
+                    self.line_run = entry
+                if entry:
+                    self.bounds[entry] = union(self.bounds[entry], bounds) if entry in self.bounds else bounds
+                self.invalidate(bounds)
+            elif cmd == "STROKEEND":
+                self.invalidate(self.bounds.get(self.strokes.pop(op[1], None)))
+            op_id = None
+
+    def tile_keys(self, bounds):
+        size = TILE_SIZE
+        x1, y1, x2, y2 = (int(value // size) for value in bounds)
+        return [(column, row) for column in range(x1, x2 + 1) for row in range(y1, y2 + 1)]
+
+    #func to drop the tiles covering bounds (all of them when bounds is unknown)
+    def invalidate(self, bounds):
+        if bounds is None:
+            self.generation += 1
+            return
+        for column, row in self.tile_keys(bounds):
+            drop_tile((self.name, self.generation, column, row))
+
+    def draw_on_top(self, op, bounds):
+        if bounds is None:
+            return
+        for column, row in self.tile_keys(bounds):
+            tile = cached_tile((self.name, self.generation, column, row))
+            if tile is not None:
+                draw_op(ImageDraw.Draw(tile), op, column * TILE_SIZE, row * TILE_SIZE)
+
+    #func to get one tile, from the cache or drawn from the ops on the board that reach into it
+    def tile(self, column, row):
+        key = (self.name, self.generation, column, row)
+        tile = cached_tile(key)
+        if tile is None:
+            size = TILE_SIZE
+            x, y = column * size, row * size
+            _, _, ops, _ = self.board.snapshot((x, y, x + size, y + size))
+            tile = Image.new("RGB", (size, size), BACKGROUND)
+            draw = ImageDraw.Draw(tile)
+            for op in ops:
+                draw_op(draw, op, x, y)
+            cache_tile(key, tile)
+        return tile
+
+    #func to get the box everything on the board fits in, None for an empty board
+    def content_bounds(self):
+        content = None
+        for bounds in self.bounds.values():
+            content = bounds if content is None else union(content, bounds)
+        if content is None:
+            return None
+        x1, y1, x2, y2 = (math.floor(value) for value in content)
+        return x1, y1, min(x2 + 1, x1 + MAX_EXPORT_SIZE), min(y2 + 1, y1 + MAX_EXPORT_SIZE)
+
+    #func to compose the tiles covering area into an image, each tile scaled by factor
+    def compose(self, area, factor=1.0):
+        x1, y1, x2, y2 = area
+        width, height = max(1, round((x2 - x1) * factor)), max(1, round((y2 - y1) * factor))
+        image = Image.new("RGB", (width, height), BACKGROUND)
+        place = lambda value, origin: round((value * TILE_SIZE - origin) * factor)
+        for column, row in self.tile_keys((x1, y1, x2 - 1, y2 - 1)):
+            tile = self.tile(column, row)
+            left, top = place(column, x1), place(row, y1)
+            if factor != 1.0:
+                # each tile ends where the next one starts so rounding leaves no seams
+                size = (max(1, place(column + 1, x1) - left), max(1, place(row + 1, y1) - top))
+                tile = tile.resize(size, Image.BOX)
+            image.paste(tile, (left, top))
+        return image
+
+    #func to get the whole board as a PNG, at full size unless that is more than MAX_EXPORT_PIXELS.
+    # Kept until the board changes
+    def png(self):
+        with self.lock:
+            self.update()
+            if self.export and self.export[0] == self.last_seq:
+                return self.export[1]
+            area = self.content_bounds() or (0, 0, 1, 1)
+            factor = min(1.0, math.sqrt(MAX_EXPORT_PIXELS / ((area[2] - area[0]) * (area[3] - area[1]))))
+            png = encode_png(self.compose(area, factor))
+            self.export = (self.last_seq, png)
+            return png
+
+    #func to get a PNG of the whole board scaled to fit size pixels, kept until the board changes
+    def thumbnail_png(self, size=THUMBNAIL_SIZE):
+        with self.lock:
+            self.update()
+            if self.thumbnail and self.thumbnail[:2] == (self.last_seq, size):
+                return self.thumbnail[2]
+            area = self.content_bounds() or (0, 0, 1, 1)
+            factor = min(1.0, size / max(area[2] - area[0], area[3] - area[1]))
+            png = encode_png(self.compose(area, factor))
+            self.thumbnail = (self.last_seq, size, png)
+            return png
+
+def encode_png(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+renderers = {}  # room name -> BoardRenderer, made the first time a room is exported
+renderers_lock = threading.Lock()
+
+def renderer_for(room):
+    with renderers_lock:
+        renderer = renderers.get(room.name)
+        if renderer is None or renderer.board is not room.board:
+            renderer = renderers[room.name] = BoardRenderer(room.name, room.board)
+        return renderer
+
+#func to serve board exports over plain HTTP on a background thread. find_room(name) returns the
+# room to export or None, list_rooms() the names worth listing
+#   /rooms                              room names and entry counts as JSON
+#   /rooms/<name>.png                   the whole board at full size (scaled down past MAX_EXPORT_PIXELS)
+#   /rooms/<name>/thumbnail.png?size=N  the whole board scaled down to fit N pixels
+def serve_exports(host, port, find_room, list_rooms):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = [unquote(part) for part in url.path.strip("/").split("/")]
+            try:
+                if parts == ["rooms"]:
+                    body = json.dumps({name: len(room.board) for name, room in list_rooms()}).encode()
+                    self.reply(body, "application/json")
+                    return
+
+                room = None
+                if len(parts) == 2 and parts[0] == "rooms" and parts[1].endswith(".png"):
+                    room = find_room(parts[1][:-4])
+                    render = lambda renderer: renderer.png()
+                elif len(parts) == 3 and parts[0] == "rooms" and parts[2] == "thumbnail.png":
+                    room = find_room(parts[1])
+                    size = int(parse_qs(url.query).get("size", [THUMBNAIL_SIZE])[0])
+                    if not 1 <= size <= MAX_THUMBNAIL_SIZE:
+                        self.send_error(400, f"size must be 1 to {MAX_THUMBNAIL_SIZE}")
+                        return
+                    render = lambda renderer: renderer.thumbnail_png(size)
+                if room is None:
+                    self.send_error(404)
+                    return
+                self.reply(render(renderer_for(room)), "image/png")
+            except ValueError:
+                self.send_error(400)
+            except Exception as e:
+                logger.error(f"Export of {self.path} failed: {e}")
+                self.send_error(500)
+
+        def reply(self, body, content_type):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Board exports available on http://{host}:{port}/rooms")
+    return server
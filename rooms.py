@@ -0,0 +1,242 @@
+import os
+import re
+import time
+import zlib
+import logging
+import threading
+from board import Board
+from journal import Journal
+from framing import encode_frame
+from protocol import (Message, BINARY_VERSION, SNAPSHOT_VERSION, SEQ_VERSION, VIEW_VERSION, OPID_VERSION,
+                      RESYNC_NONE, welcome_message, encode_snapshot, encode_op, plain_ops)
+
+logger = logging.getLogger('WhiteboardServer.rooms')
+
+DEFAULT_ROOM = "default"    # where clients that do not ask for a room (or predate rooms) end up
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+LOAD_SMOOTHING = 0.2    # weight of the newest sample in a room's load average
+
+#func to map a requested room name to a usable one, anything that is not a plain name gets the default room
+def room_name(name):
+    if name and ROOM_NAME.match(name) and name not in (".", ".."):
+        return name
+    return DEFAULT_ROOM
+
+#func to put a viewport's corners in (left, top, right, bottom) order
+def normalize_view(view):
+    return (min(view[0], view[2]), min(view[1], view[3]), max(view[0], view[2]), max(view[1], view[3]))
+
+#func to pick the worker that owns a room when the server is sharded, stable across restarts
+def room_owner(name, workers):
+    return zlib.crc32(name.encode()) % workers
+
+# One named board and the clients drawing on it
+class Room:
+    def __init__(self, name, journal_dir=None):
+        self.name = name
+        self.board = Board()
+        self.clients = {}   # connected clients (sockets or AsyncClients) -> address
+        # author part of op ids -> the client that first used it, None when that was a client of
+        # another node. Only that client may UNDO the author's entries by id
+        self.authors = {}
+        # Held while a message is applied and while a client joins, so a joining client has every op
+        # either in its join frames or in the broadcasts after them, never neither
+        self.lock = threading.Lock()
+        # Held by the threaded server from applying a message until it has been sent to every client,
+        # so two messages applied at once still reach everyone in the order of their seqs
+        self.fanout_lock = threading.Lock()
+        # Frames new clients are brought up to date with, cached until the board changes so a crowd
+        # joining at once costs one serialization. Keyed by protocol version
+        self.frames = {}
+        self.frames_lock = threading.Lock()
+        # How far behind the room is falling: 0 when broadcasts keep up, 1 when they are at the limit
+        # of what the server tolerates. Smoothed over recent broadcasts, see flow.Flow for what it drives
+        self.load = 0.0
+
+        self.journal = None
+        if journal_dir:
+            start = time.perf_counter()
+            self.journal = Journal(os.path.join(journal_dir, name))
+            self.journal.restore(self.board)
+            logger.info(f"Restored {len(self.board)} ops for room {name} in {time.perf_counter() - start:.3f}s")
+
+    #func to fold one load sample (a fraction, 1 meaning at the limit) into the room's load
+    def record_load(self, sample):
+        self.load += LOAD_SMOOTHING * (min(sample, 2.0) - self.load)
+
+    #func to get the whole board as one frame for a client speaking the given protocol version
+    def board_frame(self, version=1):
+        with self.frames_lock:
+            cached = self.frames.get(version)
+            if cached and cached[0] == self.board.revision:
+                return cached[1]
+
+            revision, seq, ops, open_ids = self.board.snapshot(ids=version >= OPID_VERSION)
+            if version >= SNAPSHOT_VERSION:
+                payload = encode_snapshot(ops, open_ids)
+                if version >= SEQ_VERSION:
+                    payload = encode_op(("SEQ", seq)) + payload
+                frame = encode_frame(payload)
+            else:
+                # older clients get every command in a single message, they split on newlines
+                frame = Message(ops).frame(version)
+            self.frames[version] = (revision, frame)
+            return frame
+
+    #func to get what intersects view as one SNAPSHOT frame for a client from VIEW_VERSION on, and the
+    # ids of the unfinished strokes in it. Not cached, every client looks at its own part of the board
+    def view_frame(self, version, view):
+        _, seq, ops, open_ids = self.board.snapshot(view, ids=version >= OPID_VERSION)
+        return encode_frame(encode_op(("SEQ", seq)) + encode_snapshot(ops, open_ids)), open_ids
+
+    #func to move a client's viewport, returns the frame with what it can see there
+    def change_view(self, interest, version, view):
+        view = normalize_view(view)
+        frame, open_ids = self.view_frame(version, view)
+        interest.reset(view, open_ids)
+        return frame
+
+    #func to get the ops a reconnecting client missed since last_seq as one frame, only those it can
+    # see when interest has a viewport, or None when the ring no longer reaches back that far
+    def resume_frame(self, version, last_seq, interest=None):
+        missed = self.board.ops_since(last_seq, ids=version >= OPID_VERSION)
+        if missed is None:
+            return None
+        ops, seq = missed
+        message = Message(ops, seq=seq)
+        if interest is not None and interest.view is not None:
+            message = interest.filter(message) or Message([], seq=seq)
+        return message.frame(version)
+
+    #func to get the frame that replaces a client's board when it could not follow an UNDO: what it
+    # can see when it has a viewport, the whole board otherwise
+    def resync_frame(self, version, interest=None):
+        if interest is not None and interest.view is not None:
+            return self.change_view(interest, version, interest.view)
+        if version >= SNAPSHOT_VERSION:
+            return self.board_frame(version)
+        # without snapshots the board is cleared and drawn again from scratch
+        return Message([("CLEAR",)] + plain_ops(self.board.history()), seq=self.board.seq).frame(version)
+
+    #func to get the frame that takes the shapes flow control dropped (rejected, see flow.Flow) back
+    # off their sender's screen: an UNDO of each by id, or its board sent again when one has no id
+    def reject_frame(self, version, rejected, interest=None):
+        if version >= OPID_VERSION and all(op_id for op_id, _ in rejected):
+            return Message([("UNDO",) + op_id[1:] for op_id, _ in rejected]).frame(version)
+        return self.resync_frame(version, interest)
+
+    #func to get the frames that bring a joining client up to date: WELCOME for clients that can
+    # read it (agreeing to compression when compress is set), then the ops it missed (when resuming,
+    # only those in its view if it sent one) or else what it can see of the board or the whole board
+    def join_frames(self, version, epoch=None, last_seq=None, interest=None, view=None, compress=False):
+        frames = []
+        if version >= BINARY_VERSION:
+            frames.append(encode_frame(welcome_message(version, self.board.epoch, compress)))
+
+        viewing = bool(view and interest and version >= VIEW_VERSION)
+        frame = None
+        if version >= SEQ_VERSION and epoch == self.board.epoch and last_seq is not None:
+            if viewing:
+                # the client still has what it saw before, it follows the strokes it can see from here
+                view = normalize_view(view)
+                interest.reset(view, self.board.open_strokes_in(view))
+            frame = self.resume_frame(version, last_seq, interest if viewing else None)
+        if frame is None:
+            frame = self.change_view(interest, version, view) if viewing else self.board_frame(version)
+        if frame:
+            frames.append(frame)
+        return frames
+
+    #func to add a client to the room, returns its join frames (see join_frames) and the seq they bring
+    # it up to. Ops after that seq are broadcast to it, the ones up to it must not be sent to it again
+    def join(self, client, address, version, epoch=None, last_seq=None, view=None, interest=None, compress=False):
+        with self.lock:
+            frames = self.join_frames(version, epoch, last_seq, interest, view, compress)
+            self.clients[client] = address
+            return frames, self.board.seq
+
+    #func to take a client out of the room, its author ids can be used by whoever comes next (it
+    # again, usually, after reconnecting)
+    def leave(self, client):
+        with self.lock:
+            self.clients.pop(client, None)
+            for author in [author for author, owner in self.authors.items() if owner is client]:
+                del self.authors[author]
+
+    #func to record which client each author id of a message belongs to and drop the UNDOs that take
+    # back another client's entry, or one of the server's (author 0). client is None for messages
+    # of other nodes, which were checked there and are only recorded
+    def claim_authors(self, message, client):
+        ops = []
+        with self.lock:
+            for op in message.ops:
+                if op[0] in ("OPID", "UNDO") and len(op) == 3:
+                    owner = self.authors.setdefault(op[1], client) if op[1] else None
+                    if op[0] == "UNDO" and client is not None and owner is not client:
+                        logger.warning(f"Dropped UNDO of an entry by author {op[1]} from {self.clients.get(client)}")
+                        continue
+                ops.append(op)
+        if len(ops) < len(message.ops):
+            message.set_ops(ops)
+        return message
+
+    #func to apply a message to the board, returns the frame acknowledging its sequence number to a
+    # sender that speaks the given version (None if it does not need one). The message's ops are
+    # rewritten to what was applied: every new entry gets its OPID, every UNDO names the entry it took
+    # back (or is dropped when it took back nothing) and ops repeating an entry already there are dropped
+    def apply(self, message, version):
+        applied = []
+        resync = RESYNC_NONE
+        op_id = None
+        with self.lock:
+            for op in message.ops:
+                if op[0] == "OPID":
+                    op_id = op[1:]
+                    continue
+                effects = {}
+                message.seq = self.board.apply(op, op_id, effects)
+                op_id = None
+                if effects.get("duplicate"):
+                    continue
+                if op[0] == "UNDO":
+                    if "id" not in effects:
+                        continue
+                    message.undone[len(applied)] = effects["undone"]
+                    resync = max(resync, effects.get("resync", RESYNC_NONE))
+                    op = ("UNDO",) + effects["id"]
+                elif "id" in effects:
+                    applied.append(("OPID",) + effects["id"])
+                applied.append(op)
+        message.set_ops(applied)
+        message.resync = resync
+        if message.seq is None:
+            return None
+        return self.ack_frame(version, message.seq)
+
+    #func to get the frame acknowledging a message of a client speaking the given version, with seq
+    # (the newest on the board when None). Clients before SEQ_VERSION are never acknowledged
+    def ack_frame(self, version, seq=None):
+        if version < SEQ_VERSION:
+            return None
+        return Message([], seq=self.board.seq if seq is None else seq).frame(version)
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+rooms = {}
+rooms_lock = threading.Lock()
+
+#func to get a room by name, creating (and restoring it from its journal) the first time it is used
+def get_room(name, journal_dir=None):
+    name = room_name(name)
+    with rooms_lock:
+        room = rooms.get(name)
+        if room is None:
+            room = rooms[name] = Room(name, journal_dir)
+        return room
+
+def close_rooms():
+    with rooms_lock:
+        for room in rooms.values():
+            room.close()
@@ -0,0 +1,206 @@
+from collections import defaultdict
+from protocol import Message
+
+GRID_CELL_SIZE = 256        # board units per side of one grid cell
+GRID_MAX_CELLS = 1024       # ops covering more cells than this are kept aside and match every query
+
+#func to get the box an op covers, (x1, y1, x2, y2) including the pen width, None for ops that are
+# not drawn anywhere
+def op_bounds(op):
+    cmd = op[0]
+    if cmd in ("LINE", "RECT"):
+        _, x1, y1, x2, y2, _, width = op
+        xs, ys = (x1, x2), (y1, y2)
+    elif cmd == "CIRC":
+        _, x, y, radius, _, width = op
+        xs, ys = (x - radius, x + radius), (y - radius, y + radius)
+    elif cmd == "TEXT":
+        _, x, y, _, text = op
+        half = 4 * len(text) + 8    # text is centred on x, y like on the Tk canvas
+        return x - half, y - 12, x + half, y + 12
+    elif cmd == "STROKE":
+        _, _, _, width, points = op
+        if not points:
+            return None
+        xs, ys = points[0::2], points[1::2]
+    else:
+        return None
+    pad = width // 2 + 1
+    return min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad
+
+def intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def union(a, b):
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+#func to scale an op's coordinates (and pen width) by factor, for drawing at a zoom level
+def scale_op(op, factor):
+    if factor == 1:
+        return op
+    cmd = op[0]
+    width = lambda w: max(1, round(w * factor))
+    if cmd in ("LINE", "RECT"):
+        _, x1, y1, x2, y2, colour, w = op
+        return (cmd, x1 * factor, y1 * factor, x2 * factor, y2 * factor, colour, width(w))
+    if cmd == "CIRC":
+        _, x, y, radius, colour, w = op
+        return (cmd, x * factor, y * factor, radius * factor, colour, width(w))
+    if cmd == "TEXT":
+        _, x, y, colour, text = op
+        return (cmd, x * factor, y * factor, colour, text)
+    if cmd == "STROKE":
+        _, stroke_id, colour, w, points = op
+        return (cmd, stroke_id, colour, width(w), [point * factor for point in points])
+    return op
+
+# Uniform grid over the ops on a board so the ops in a viewport can be found without looking at
+# all of them. Ops are tracked by identity and come back from a query in the order they were added
+class SpatialGrid:
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)   # (column, row) -> ids of the ops reaching into that cell
+        self.large = set()      # ids of ops too big to be worth putting in cells
+        self.items = {}     # op id -> [order, op, bounds, cells]
+        self.order = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def _cells(self, bounds):
+        size = self.cell_size
+        x1, y1, x2, y2 = (int(value) // size for value in bounds)
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > GRID_MAX_CELLS:
+            return None
+        return {(column, row) for column in range(x1, x2 + 1) for row in range(y1, y2 + 1)}
+
+    def _place(self, key, cells):
+        if cells is None:
+            self.large.add(key)
+        else:
+            for cell in cells:
+                self.cells[cell].add(key)
+
+    def insert(self, op, bounds=None):
+        bounds = bounds or op_bounds(op)
+        if bounds is None:
+            return
+        cells = self._cells(bounds)
+        self.order += 1
+        self.items[id(op)] = [self.order, op, bounds, cells]
+        self._place(id(op), cells)
+
+    #func to widen the area an op covers, for strokes and LINE runs that keep growing
+    def grow(self, op, bounds):
+        item = self.items.get(id(op))
+        if item is None:
+            self.insert(op, bounds)
+            return
+        item[2] = union(item[2], bounds)
+        if item[3] is None:
+            return
+        cells = self._cells(item[2])
+        if cells is None:
+            self.remove(op)
+            self.items[id(op)] = [item[0], op, item[2], None]
+            self.large.add(id(op))
+            return
+        self._place(id(op), cells - item[3])
+        item[3] = cells
+
+    def remove(self, op):
+        item = self.items.pop(id(op), None)
+        if item is None:
+            return
+        if item[3] is None:
+            self.large.discard(id(op))
+            return
+        for cell in item[3]:
+            keys = self.cells[cell]
+            keys.discard(id(op))
+            if not keys:
+                del self.cells[cell]
+
+    #func to get the ops whose box intersects bounds, oldest first
+    def query(self, bounds):
+        keys = set(self.large)
+        cells = self._cells(bounds)
+        if cells is None:
+            keys = set(self.items)
+        else:
+            for cell in cells:
+                keys |= self.cells.get(cell, set())
+        found = [self.items[key] for key in keys if intersects(self.items[key][2], bounds)]
+        found.sort(key=lambda item: item[0])
+        return [item[1] for item in found]
+
+    def clear(self):
+        self.cells.clear()
+        self.large.clear()
+        self.items.clear()
+
+# What one client gets to see of a room: the ops that intersect its viewport, plus the rest of any
+# stroke it has been sent part of so strokes are never cut off halfway
+class Interest:
+    def __init__(self, view=None):
+        self.view = view    # (x1, y1, x2, y2) in board units, None sees everything
+        self.strokes = set()    # ids of unfinished strokes this client is following
+
+    #func to start over from a snapshot of the view, open_ids are the unfinished strokes in it
+    def reset(self, view, open_ids=()):
+        self.view = view
+        self.strokes = set(open_ids)
+
+    def _visible(self, op):
+        bounds = op_bounds(op)
+        return bounds is not None and intersects(bounds, self.view)
+
+    #func to get the part of a message this client should receive, None when there is nothing
+    def filter(self, message):
+        if self.view is None:
+            return message
+
+        ops = []
+        undone = getattr(message, "undone", {})
+        op_id = None
+        for index, op in enumerate(message.ops):
+            cmd = op[0]
+            # an OPID goes with the op after it, it is only sent if that op is
+            if cmd == "OPID":
+                op_id = op
+                continue
+            sent = len(ops)
+            if cmd == "STROKE":
+                if op[1] in self.strokes:
+                    ops.append(op)
+                elif self._visible(op):
+                    self.strokes.add(op[1])
+                    ops.append(op)
+            elif cmd == "STROKEEND":
+                if op[1] in self.strokes:
+                    self.strokes.discard(op[1])
+                    ops.append(op)
+            elif cmd == "UNDO":
+                # only worth sending if this client was sent what it takes back. Ops replayed to a
+                # reconnecting client do not say what their UNDOs took back, so those are all sent
+                target = undone.get(index)
+                if target is None:
+                    ops.append(op)
+                elif self._visible(target) or (target[0] == "STROKE" and target[1] in self.strokes):
+                    if target[0] == "STROKE":
+                        self.strokes.discard(target[1])
+                    ops.append(op)
+            elif cmd in ("LINE", "RECT", "CIRC", "TEXT"):
+                if self._visible(op):
+                    ops.append(op)
+            else:
+                ops.append(op)
+            if op_id is not None and len(ops) > sent:
+                ops.insert(sent, op_id)
+            op_id = None
+
+        if len(ops) == len(message.ops):
+            return message
+        if not ops:
+            return None
+        return Message(ops, seq=message.seq)
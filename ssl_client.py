@@ -1,16 +1,56 @@
 import os
-import socket
-import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, colorchooser, simpledialog
-import ssl
-from PIL import Image, ImageTk
+from PIL import Image, ImageTk, ImageDraw
 import math
+from protocol import STROKE_VERSION, VIEW_VERSION, OPID_VERSION
+from client_core import ClientCore
+import random
+import time
+from collections import deque
+from raster import TileCache
+from spatial import scale_op
 
 HOST = "10.30.204.222"   #replace with your server's IP address
 PORT = 5555
 BUFFER_SIZE = 1024
 CERTIFICATE_PATH = "certificate.pem"    #set as per the path of the certificate you have generated
+ROOM = "default"            #board to join, everyone in the same room draws on the same board
+RENDER_INTERVAL_MS = 16     #how often ops received from the server are drawn...
+RENDER_BUDGET_MS = 8        #...and how long each of those passes may draw before handing the UI back
+RENDER_SLICE = 512          #most queued ops a pass takes on, so sorting out the queue never eats the budget
+UNDO_WINDOW = 200           #newest shapes kept as canvas items so they can be undone cheaply...
+FLATTEN_BATCH = 200         #...older ones are flattened into raster tiles this many at a time
+UNDO_HISTORY = 1000         #how many of our own shapes undo (and redo) can reach back
+ZOOM_STEP = 1.25            #zoom factor per mouse wheel step...
+MIN_ZOOM, MAX_ZOOM = 0.05, 8    #...within these limits
+VIEW_MARGIN = 0.5           #how much of the board around the window (in window sizes) the server sends us
+VIEW_DELAY_MS = 150         #wait this long after panning or zooming stops before asking for the new view
+COLOUR_WHEEL_SIZE = 100     #pixels per side of the colour wheel...
+COLOUR_WHEEL_RADIUS = 45    #...and of its radius
+
+#func to build the colour wheel image: hue going round by angle at full saturation, with a white
+# centre and a black ring, on the tool panel's background. Built once, every pixel in one pass
+def colour_wheel_image(size=None, radius=None):
+    size = size or COLOUR_WHEEL_SIZE
+    radius = radius or COLOUR_WHEEL_RADIUS
+    centre = size / 2
+    # hue in PIL's 0-255 range from the angle of each pixel centre, clockwise from the right as on screen
+    hues = bytes(int(math.degrees(math.atan2(y + 0.5 - centre, x + 0.5 - centre)) % 360 * 256 / 360) & 0xFF
+                 for y in range(size) for x in range(size))
+    full = Image.new("L", (size, size), 255)
+    wheel = Image.merge("HSV", (Image.frombytes("L", (size, size), hues), full, full)).convert("RGB")
+
+    image = Image.new("RGB", (size, size), "#e0e0e0")
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).ellipse((centre - radius, centre - radius, centre + radius, centre + radius), fill=255)
+    image.paste(wheel, (0, 0), mask)
+
+    draw = ImageDraw.Draw(image)
+    inner = radius / 3
+    draw.ellipse((centre - inner, centre - inner, centre + inner, centre + inner), fill="white", outline="#d0d0d0")
+    draw.ellipse((centre - radius, centre - radius, centre + radius, centre + radius), outline="black", width=1)
+    return image
 
 class WhiteboardClient:
     def __init__(self, root):
@@ -21,34 +61,45 @@ class WhiteboardClient:
 
         # Initialize variables
         self.colour = "#000000"
-        self.shapes = []
+        self.shapes = deque()   # (canvas item, op) of the shapes still drawn as canvas items, oldest first
+        self.tile_cache = TileCache()   # everything older, flattened into images drawn as they come on screen
+        self.tile_items = {}    # tile key -> (PhotoImage, canvas item, image it shows) of the tiles on screen
+        # every shape has the op id the server gave it (servers from OPID_VERSION on), so undoing one
+        # from anywhere on the board is a dict lookup. An undone canvas item is left in shapes as a
+        # tombstone until it would have been flattened
+        self.items_by_id = {}   # op id -> canvas item
+        self.item_ids = {}      # canvas item -> op id
+        self.dead_items = set()     # undone canvas items still in shapes
+        self.next_op_id = None  # OPID received for the next op
+        self.undo_stack = deque(maxlen=UNDO_HISTORY)    # (op id, op) of our own shapes, newest last
+        self.redo_stack = deque(maxlen=UNDO_HISTORY)
+        self.stroke_op_id = None
+        self.zoom = 1.0     # canvas pixels per board unit, panning scrolls the canvas itself
+        self.view_job = None
         self.prev_x, self.prev_y = None, None
         self.current_tool = "pen"   #default tool is the pen
         self.line_width = 2
+        self.strokes = {}   # strokes other users are still drawing, id -> (canvas item, points)
+        self.stroke_id = None
+        self.stroke_points = []     # every point of the stroke being drawn locally
+        self.stroke_pending = []    # points not sent yet, starting with the last point that was sent
+        self.stroke_flush_job = None
+        self.render_queue = deque()     # (arrival time, op) from the receive thread, drawn on the Tk thread
+        self.render_lag = 0.0       # seconds received ops are waiting before they are drawn
+        self.pending_status = None  # (text, colour) for the status label, set from any thread
         self.colour_history = ["#000000", "#FF0000", "#00FF00", "#0000FF", "#FFFF00", "#FF00FF"] #default colours, which can be changed
 
-        self.create_ui()    #create the ui before trying to connect so that race condition doesnt occure between create_ui and receive_data
-        self.setup_connection()
+        #connecting, sending and parsing what the server sends happen in the Tk-free core, received ops come to queue_ops
+        self.connection = ClientCore(HOST, PORT, CERTIFICATE_PATH, ROOM, self.queue_ops, self.set_status)
 
-    def setup_connection(self):
-        try:
-            raw_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.load_verify_locations(CERTIFICATE_PATH)  
-            context.check_hostname = False      #false here because otherwise new certificate will have to be generated each time IP changes
-            context.verify_mode = ssl.CERT_REQUIRED
+        #the window comes up straight away, connecting (TLS handshake and the board arriving) happens in the background
+        self.create_ui()
+        self.connection.start()
+        self.root.after(RENDER_INTERVAL_MS, self.render_queued)
 
-            self.client_socket = context.wrap_socket(raw_socket, server_hostname=HOST)
-            self.client_socket.connect((HOST, PORT))
-
-            # Start receiving data from other clients via server
-            receive_thread = threading.Thread(target=self.receive_data)
-            receive_thread.daemon = True
-            receive_thread.start()
-
-        except Exception as e:
-            messagebox.showerror("Connection Error", f"Failed to connect to server: {e}")
-            exit(1)
+    #func to change the status label, the label itself is only touched on the Tk thread by render_queued
+    def set_status(self, text, connected):
+        self.pending_status = (text, "green" if connected else "red")
 
     def create_ui(self):
 
@@ -66,7 +117,8 @@ class WhiteboardClient:
         self.create_tool_button(tool_panel, "⬜ Rectangle", lambda: self.set_tool("rectangle"))
         self.create_tool_button(tool_panel, "⭕ Circle", lambda: self.set_tool("circle"))
         self.create_tool_button(tool_panel, "📝 Text", lambda: self.set_tool("text"))
-        self.create_tool_button(tool_panel, "↩️ Undo", self.undo)
+        self.create_tool_button(tool_panel, "↩️ Undo", self.undo_own)
+        self.create_tool_button(tool_panel, "↪️ Redo", self.redo_own)
         self.create_tool_button(tool_panel, "🧹 Clear All", self.clear_canvas)
 
         # width change slider
@@ -95,20 +147,33 @@ class WhiteboardClient:
         self.create_tool_button(tool_panel, "🎨 Custom Colour", self.choose_colour)
 
         # Status label
-        self.status_label = tk.Label(tool_panel, text="Connected", fg="green", bg="#e0e0e0")
+        self.status_label = tk.Label(tool_panel, text="Connecting...", fg="orange", bg="#e0e0e0")
         self.status_label.pack(side=tk.BOTTOM, pady=10)
+        self.lag_label = tk.Label(tool_panel, text="Render lag: 0 ms", fg="gray", bg="#e0e0e0")
+        self.lag_label.pack(side=tk.BOTTOM)
 
         # Canvas where u can draw
         canvas_frame = tk.Frame(main_frame, bg="white", bd=2, relief=tk.SUNKEN)
         canvas_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=5, pady=5)
 
-        self.canvas = tk.Canvas(canvas_frame, bg="white", cursor="crosshair")
+        #the board has no edges: confine is off so the canvas can be scrolled anywhere
+        self.canvas = tk.Canvas(canvas_frame, bg="white", cursor="crosshair", confine=False,
+                                scrollregion=(-10**6, -10**6, 10**6, 10**6))
         self.canvas.pack(fill=tk.BOTH, expand=True)
 
         self.canvas.bind("<ButtonPress-1>", self.on_mouse_down)
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_mouse_up)
 
+        #pan by dragging with the right (or middle) button, zoom with the mouse wheel
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", self.on_pan_start)
+            self.canvas.bind(f"<B{button}-Motion>", self.on_pan)
+        self.canvas.bind("<MouseWheel>", self.on_zoom)
+        self.canvas.bind("<Button-4>", self.on_zoom)
+        self.canvas.bind("<Button-5>", self.on_zoom)
+        self.canvas.bind("<Configure>", self.on_resize)
+
         # Temporary shape for drawing
         self.temp_shape = None
         self.start_x, self.start_y = None, None
@@ -119,84 +184,21 @@ class WhiteboardClient:
         btn.pack(pady=3, padx=5, fill=tk.X)
         return btn
 
-    #func to create the colour wheel
+    #func to create the colour wheel, one image item that also serves as the lookup for clicks
     def create_colour_wheel(self, parent):
-        canvas_size = 100
-        wheel_radius = 45
-
-        colour_canvas = tk.Canvas(parent, width=canvas_size, height=canvas_size, bg="#e0e0e0", highlightthickness=0)
+        self.colour_wheel = colour_wheel_image()
+        self.colour_wheel_photo = ImageTk.PhotoImage(self.colour_wheel)    #Tk only shows it while we hold on to it
+        colour_canvas = tk.Canvas(parent, width=COLOUR_WHEEL_SIZE, height=COLOUR_WHEEL_SIZE, bg="#e0e0e0", highlightthickness=0)
         colour_canvas.pack(pady=5)
-
-        # Draw colour wheel by mapping angle to rgb value to get a smooth gradient
-        for angle in range(0, 360, 3):
-            r = wheel_radius
-            x1 = canvas_size/2 + r * math.cos(math.radians(angle))
-            y1 = canvas_size/2 + r * math.sin(math.radians(angle))
-            x2 = canvas_size/2 + r * math.cos(math.radians(angle+5))
-            y2 = canvas_size/2 + r * math.sin(math.radians(angle+5))
-
-            h = angle / 360.0
-            r, g, b = self.hsv_to_rgb(h, 1, 1)
-            hex_colour = f"#{int(r*255):02x}{int(g*255):02x}{int(b*255):02x}"
-
-            colour_canvas.create_polygon(canvas_size/2, canvas_size/2, x1, y1, x2, y2, fill=hex_colour, outline="")
-
-        # Add white center and black ring
-        colour_canvas.create_oval(canvas_size/2-wheel_radius/3, canvas_size/2-wheel_radius/3,
-                               canvas_size/2+wheel_radius/3, canvas_size/2+wheel_radius/3,
-                               fill="white", outline="#d0d0d0")
-
-        colour_canvas.create_oval(canvas_size/2-wheel_radius, canvas_size/2-wheel_radius,
-                               canvas_size/2+wheel_radius, canvas_size/2+wheel_radius,
-                               outline="black", width=1)
-
+        colour_canvas.create_image(0, 0, image=self.colour_wheel_photo, anchor=tk.NW)
         colour_canvas.bind("<Button-1>", self.colour_wheel_click)
 
-    #func to handle click on colour wheel to select a colour
+    #func to handle click on colour wheel to select the colour under the pointer
     def colour_wheel_click(self, event):
-        canvas_size = 100
-        wheel_radius = 45
-        center_x, center_y = canvas_size/2, canvas_size/2
-
-        #find where the click was, and then map it to the rgb value as per the wheel created earlier
-        dx = event.x - center_x
-        dy = event.y - center_y
-        distance = math.sqrt(dx*dx + dy*dy)
-
-        if distance <= wheel_radius:
-            angle = math.degrees(math.atan2(dy, dx))
-            if angle < 0:
-                angle += 360
-
-            h = angle / 360.0
-            r, g, b = self.hsv_to_rgb(h, 1, 1)
-            hex_colour = f"#{int(r*255):02x}{int(g*255):02x}{int(b*255):02x}"
-
-            self.set_colour(hex_colour)
-
-    def hsv_to_rgb(self, h, s, v):
-        if s == 0.0:
-            return v, v, v
-
-        i = int(h * 6)
-        f = (h * 6) - i
-        p = v * (1 - s)
-        q = v * (1 - s * f)
-        t = v * (1 - s * (1 - f))
-
-        i %= 6
-        if i == 0:
-            return v, t, p
-        elif i == 1:
-            return q, v, p
-        elif i == 2:
-            return p, v, t
-        elif i == 3:
-            return p, q, v
-        elif i == 4:
-            return t, p, v
-        else:
-            return v, p, q
+        centre = COLOUR_WHEEL_SIZE / 2
+        if math.hypot(event.x + 0.5 - centre, event.y + 0.5 - centre) <= COLOUR_WHEEL_RADIUS:
+            r, g, b = self.colour_wheel.getpixel((event.x, event.y))
+            self.set_colour(f"#{r:02x}{g:02x}{b:02x}")
 
     #func to change tool and display current tool on title bar
     def set_tool(self, tool):
@@ -222,23 +224,47 @@ class WhiteboardClient:
         if colour:
             self.set_colour(colour)
 
+    #func to get the board coordinates of a mouse event, the canvas may be scrolled and zoomed
+    def board_point(self, event):
+        return (round(self.canvas.canvasx(event.x) / self.zoom), round(self.canvas.canvasy(event.y) / self.zoom))
+
     #mouse down event for the whiteboard, for drawing purpose
     def on_mouse_down(self, event):
-        self.start_x, self.start_y = event.x, event.y
-        self.prev_x, self.prev_y = event.x, event.y
+        x, y = self.board_point(event)
+        self.start_x, self.start_y = x, y
+        self.prev_x, self.prev_y = x, y
+
+        if self.current_tool == "pen" and self.connection.protocol_version >= STROKE_VERSION:
+            self.stroke_id = random.getrandbits(31)
+            self.stroke_op_id = self.connection.new_op_id()
+            self.stroke_points = [x, y]
+            self.stroke_pending = [x, y]
 
         if self.current_tool == "text":
             text = simpledialog.askstring("Text", "Enter text:")
             if text:
-                self.add_text(event.x, event.y, text)
-                self.send_data(f"TEXT {event.x} {event.y} {self.colour} {text}")
+                self.add_own_shape(("TEXT", x, y, self.colour, text))
 
     #mouse drag event for pen, rectangle and circle
     def on_mouse_drag(self, event):
-        if self.current_tool == "pen":  #draws a line with mousedrag
-            self.draw_line(self.prev_x, self.prev_y, event.x, event.y)
-            self.send_data(f"LINE {self.prev_x} {self.prev_y} {event.x} {event.y} {self.colour} {self.line_width}")
-            self.prev_x, self.prev_y = event.x, event.y
+        x, y = self.board_point(event)
+        zoom = self.zoom
+        if self.current_tool == "pen" and self.stroke_id is not None:
+            #draw a temporary segment now, the whole stroke becomes one item on mouse up
+            self.canvas.create_line(self.prev_x * zoom, self.prev_y * zoom, x * zoom, y * zoom, fill=self.colour,
+                                    width=max(1, round(self.line_width * zoom)), capstyle=tk.ROUND, tags="live_stroke")
+            self.stroke_points += [x, y]
+            self.stroke_pending += [x, y]
+            if len(self.stroke_pending) // 2 > self.connection.stroke_flush_points():
+                self.flush_stroke()
+            elif self.stroke_flush_job is None:
+                self.stroke_flush_job = self.root.after(self.connection.stroke_flush_ms(), self.flush_stroke)
+            self.prev_x, self.prev_y = x, y
+
+        elif self.current_tool == "pen":  #draws a line with mousedrag (servers that do not know strokes)
+            self.draw_line(self.prev_x, self.prev_y, x, y)
+            self.connection.send_op(("LINE", self.prev_x, self.prev_y, x, y, self.colour, self.line_width))
+            self.prev_x, self.prev_y = x, y
         
         #draws rect or circle on mousedrag by clearing buffer (temp_shape) and then drawing new shape
         elif self.current_tool in ["rectangle", "circle"]: 
@@ -246,144 +272,422 @@ class WhiteboardClient:
                 self.canvas.delete(self.temp_shape)
 
             if self.current_tool == "rectangle":
-                self.temp_shape = self.canvas.create_rectangle(
-                    self.start_x, self.start_y, event.x, event.y,
-                    outline=self.colour, width=self.line_width
-                )
+                self.temp_shape = self.create_item(("RECT", self.start_x, self.start_y, x, y, self.colour, self.line_width))
                 
             elif self.current_tool == "circle":
-                radius = math.sqrt((event.x - self.start_x)**2 + (event.y - self.start_y)**2)
-                self.temp_shape = self.canvas.create_oval(
-                    self.start_x - radius, self.start_y - radius,
-                    self.start_x + radius, self.start_y + radius,
-                    outline=self.colour, width=self.line_width
-                )
+                radius = int(math.sqrt((x - self.start_x)**2 + (y - self.start_y)**2))
+                self.temp_shape = self.create_item(("CIRC", self.start_x, self.start_y, radius, self.colour, self.line_width))
 
     def on_mouse_up(self, event):
-        if self.current_tool == "rectangle":
+        x, y = self.board_point(event)
+        if self.stroke_id is not None:
+            self.flush_stroke(end=True)
+            self.canvas.delete("live_stroke")
+            if len(self.stroke_points) >= 4:
+                op = ("STROKE", self.stroke_id, self.colour, self.line_width, self.stroke_points)
+                self.add_shape(self.create_item(op), op, self.stroke_op_id)
+                if self.stroke_op_id:
+                    self.undo_stack.append((self.stroke_op_id, op))
+                    self.redo_stack.clear()
+            self.stroke_id = None
+            self.stroke_op_id = None
+            self.stroke_points = []
+
+        elif self.current_tool == "rectangle":
             if self.temp_shape:
                 self.canvas.delete(self.temp_shape)
 
-            shape = self.canvas.create_rectangle(
-                self.start_x, self.start_y, event.x, event.y,
-                outline=self.colour, width=self.line_width
-            )
-            self.shapes.append(shape)
-            self.send_data(f"RECT {self.start_x} {self.start_y} {event.x} {event.y} {self.colour} {self.line_width}")
+            self.add_own_shape(("RECT", self.start_x, self.start_y, x, y, self.colour, self.line_width))
 
         elif self.current_tool == "circle":
             if self.temp_shape:
                 self.canvas.delete(self.temp_shape)
 
-            radius = int(math.sqrt((event.x - self.start_x)**2 + (event.y - self.start_y)**2))
-            shape = self.canvas.create_oval(
-                self.start_x - radius, self.start_y - radius,
-                self.start_x + radius, self.start_y + radius,
-                outline=self.colour, width=self.line_width
-            )
-            self.shapes.append(shape)
-            self.send_data(f"CIRC {self.start_x} {self.start_y} {radius} {self.colour} {self.line_width}")
+            radius = int(math.sqrt((x - self.start_x)**2 + (y - self.start_y)**2))
+            self.add_own_shape(("CIRC", self.start_x, self.start_y, radius, self.colour, self.line_width))
 
         self.temp_shape = None
         self.prev_x, self.prev_y = None, None
         self.start_x, self.start_y = None, None
 
-    def draw_line(self, x1, y1, x2, y2):
-        shape = self.canvas.create_line(x1, y1, x2, y2, fill=self.colour, width=self.line_width, smooth=True, capstyle=tk.ROUND)
-        self.shapes.append(shape)
+    def on_pan_start(self, event):
+        self.canvas.scan_mark(event.x, event.y)
+
+    def on_pan(self, event):
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.refresh_tiles()
+        self.schedule_view_update()
+
+    def on_resize(self, event):
+        self.refresh_tiles()
+        self.schedule_view_update()
+
+    #mouse wheel zooms in and out around the mouse pointer
+    def on_zoom(self, event):
+        zoom_in = event.num == 4 or getattr(event, "delta", 0) > 0
+        zoom = min(MAX_ZOOM, max(MIN_ZOOM, self.zoom * (ZOOM_STEP if zoom_in else 1 / ZOOM_STEP)))
+        if zoom == self.zoom:
+            return
+
+        factor = zoom / self.zoom
+        x, y = self.canvas.canvasx(event.x), self.canvas.canvasy(event.y)
+        self.zoom = zoom
+        self.redraw()
+        #scroll so the point under the mouse stays under the mouse
+        self.canvas.scan_mark(0, 0)
+        self.canvas.scan_dragto(round(x - x * factor), round(y - y * factor), gain=1)
+        self.refresh_tiles()
+        self.schedule_view_update()
+
+    #func to get the part of the board the window shows, in board coordinates
+    def visible_area(self):
+        x1, y1 = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        x2, y2 = x1 + self.canvas.winfo_width(), y1 + self.canvas.winfo_height()
+        return (x1 / self.zoom, y1 / self.zoom, x2 / self.zoom, y2 / self.zoom)
+
+    def schedule_view_update(self):
+        if self.view_job is not None:
+            self.root.after_cancel(self.view_job)
+        self.view_job = self.root.after(VIEW_DELAY_MS, self.update_view)
+
+    #func to tell the server which part of the board to send us. The view reaches VIEW_MARGIN beyond
+    # the window on every side, so it only changes once a pan leaves it or a zoom makes it too big
+    def update_view(self, force=False):
+        self.view_job = None
+        if self.canvas.winfo_width() <= 1:
+            return      #not on screen yet
+        x1, y1, x2, y2 = self.visible_area()
+        connection = self.connection
+        if not force and connection.view:
+            vx1, vy1, vx2, vy2 = connection.view
+            inside = vx1 <= x1 and vy1 <= y1 and x2 <= vx2 and y2 <= vy2
+            if inside and (vx2 - vx1) * (vy2 - vy1) <= 4 * (x2 - x1) * (y2 - y1) * (1 + 2 * VIEW_MARGIN) ** 2:
+                return
+
+        margin_x, margin_y = (x2 - x1) * VIEW_MARGIN, (y2 - y1) * VIEW_MARGIN
+        connection.view = (int(x1 - margin_x), int(y1 - margin_y), int(x2 + margin_x) + 1, int(y2 + margin_y) + 1)
+        if connection.protocol_version >= VIEW_VERSION:
+            connection.send_op(("VIEW",) + connection.view)
+
+    #func to send the pen points gathered so far as one STROKE chunk, plus STROKEEND when the pen is lifted
+    def flush_stroke(self, end=False):
+        if self.stroke_flush_job is not None:
+            self.root.after_cancel(self.stroke_flush_job)
+            self.stroke_flush_job = None
+        if self.stroke_id is None:
+            return
+
+        ops = []
+        if len(self.stroke_pending) >= 4:
+            if self.stroke_op_id and len(self.stroke_pending) == len(self.stroke_points):
+                ops.append(("OPID",) + self.stroke_op_id)     #the first chunk starts the entry
+            ops.append(("STROKE", self.stroke_id, self.colour, self.line_width, tuple(self.stroke_pending)))
+            self.stroke_pending = self.stroke_pending[-2:]
+        if end and len(self.stroke_points) >= 4:
+            ops.append(("STROKEEND", self.stroke_id))
+        if ops:
+            self.connection.send_ops(ops)
 
-    def add_text(self, x, y, text):
-        shape = self.canvas.create_text(x, y, text=text, fill=self.colour, font=("Arial", 12))
-        self.shapes.append(shape)
+    def draw_line(self, x1, y1, x2, y2):
+        op = ("LINE", x1, y1, x2, y2, self.colour, self.line_width)
+        self.add_shape(self.create_item(op), op)
+
+    #func to draw a finished shape of ours and send it, with its op id when the server knows them.
+    # Redo passes the id the shape had before
+    def add_own_shape(self, op, op_id=None):
+        if op_id is None:
+            op_id = self.connection.new_op_id()
+            self.redo_stack.clear()     #a new shape ends what could be redone
+        self.add_shape(self.create_item(op), op, op_id)
+        ops = [op[:4] + (tuple(op[4]),), ("STROKEEND", op[1])] if op[0] == "STROKE" else [op]
+        if op_id:
+            self.undo_stack.append((op_id, op))
+            ops.insert(0, ("OPID",) + op_id)
+        self.connection.send_ops(ops)
+
+    #func to create the canvas item for an op given in board coordinates, at the current zoom
+    def create_item(self, op):
+        op = scale_op(op, self.zoom)
+        cmd = op[0]
+        if cmd == "LINE":
+            _, x1, y1, x2, y2, colour, width = op
+            return self.canvas.create_line(x1, y1, x2, y2, fill=colour, width=width, smooth=True, capstyle=tk.ROUND)
+        elif cmd == "RECT":
+            _, x1, y1, x2, y2, colour, width = op
+            return self.canvas.create_rectangle(x1, y1, x2, y2, outline=colour, width=width)
+        elif cmd == "CIRC":
+            _, x, y, radius, colour, width = op
+            return self.canvas.create_oval(x - radius, y - radius, x + radius, y + radius, outline=colour, width=width)
+        elif cmd == "TEXT":
+            _, x, y, colour, text = op
+            return self.canvas.create_text(x, y, text=text, fill=colour, font=("Arial", max(1, round(12 * self.zoom))))
+        elif cmd == "STROKE":
+            _, _, colour, width, points = op
+            return self.canvas.create_line(*points, fill=colour, width=width, smooth=True,
+                                           capstyle=tk.ROUND, joinstyle=tk.ROUND)
+
+    #func to draw everything again from the ops, after the zoom changed
+    def redraw(self):
+        stroke_ids = {stroke[0]: stroke_id for stroke_id, stroke in self.strokes.items()}
+        shapes = [(shape, op) for shape, op in self.shapes if shape not in self.dead_items]
+        self.canvas.delete("all")
+        self.tile_items = {}
+        self.shapes.clear()
+        self.dead_items.clear()
+        self.tile_cache.set_zoom(self.zoom)     #tiles come back as they are shown again
+        item_ids = self.item_ids
+        self.item_ids = {}
+        for shape, op in shapes:
+            item = self.create_item(op)
+            self.shapes.append((item, op))
+            op_id = item_ids.get(shape)
+            if op_id:
+                self.items_by_id[op_id] = item
+                self.item_ids[item] = op_id
+            stroke_id = stroke_ids.get(shape)
+            if stroke_id is not None:
+                self.strokes[stroke_id] = (item, self.strokes[stroke_id][1])
+
+    #func to keep track of a new canvas item, flattening the oldest ones into tiles once the undo window is full
+    def add_shape(self, shape, op, op_id=None):
+        self.shapes.append((shape, op))
+        if op_id:
+            self.items_by_id[op_id] = shape
+            self.item_ids[shape] = op_id
+        if len(self.shapes) >= UNDO_WINDOW + FLATTEN_BATCH:
+            self.flatten_shapes(FLATTEN_BATCH)
+
+    #func to move the oldest canvas items into the tile images. Strokes other users are still drawing
+    # stay canvas items until they are finished
+    def flatten_shapes(self, count):
+        open_items = {stroke[0] for stroke in self.strokes.values()}
+        kept = []
+        touched = set()
+        for _ in range(min(count, len(self.shapes))):
+            shape, op = self.shapes.popleft()
+            if shape in self.dead_items:
+                self.dead_items.discard(shape)  #already off the canvas
+                continue
+            if shape in open_items:
+                kept.append((shape, op))
+                continue
+            op_id = self.item_ids.pop(shape, None)
+            if op_id:
+                del self.items_by_id[op_id]
+            touched |= self.tile_cache.add(op, op_id)
+            self.canvas.delete(shape)
+        self.shapes.extendleft(reversed(kept))
+        self.refresh_tiles(touched)
+
+    #func to show the tiles covering the window, below every canvas item. Tiles that scrolled out of
+    # the window are let go, changed lists the tiles drawn on since they were last shown
+    def refresh_tiles(self, changed=()):
+        size = self.tile_cache.tile_size
+        x1, y1 = self.canvas.canvasx(0), self.canvas.canvasy(0)
+        area = (x1, y1, x1 + self.canvas.winfo_width(), y1 + self.canvas.winfo_height())
+        visible = set(self.tile_cache.keys(area))
+        for key in [key for key in self.tile_items if key not in visible]:
+            self.canvas.delete(self.tile_items.pop(key)[1])
+
+        for key in visible:
+            image = self.tile_cache.tile(key)
+            tile = self.tile_items.get(key)
+            if image is None:
+                if tile:
+                    self.canvas.delete(tile[1])
+                    del self.tile_items[key]
+            elif tile and tile[2] is image and key not in changed:
+                continue
+            elif tile:
+                tile[0].paste(image)
+                self.tile_items[key] = (tile[0], tile[1], image)
+            else:
+                photo = ImageTk.PhotoImage(image)
+                item = self.canvas.create_image(key[0] * size, key[1] * size, image=photo, anchor=tk.NW, tags="tile")
+                self.canvas.tag_lower(item)
+                self.tile_items[key] = (photo, item, image)
 
+    #func to take back the newest shape on the board, whoever drew it (an UNDO without an op id)
     def undo(self, from_server=False):
+        while self.shapes and self.shapes[-1][0] in self.dead_items:
+            self.dead_items.discard(self.shapes.pop()[0])
         if self.shapes:
-            shape = self.shapes.pop()
+            shape, _ = self.shapes.pop()
+            self.forget_item(shape)
             self.canvas.delete(shape)
-
-            if not from_server:
-                self.send_data("UNDO")
+        elif len(self.tile_cache):
+            self.refresh_tiles(self.tile_cache.pop())
+        else:
+            return
+
+        if not from_server:
+            self.connection.send_op(("UNDO",))
+
+    def forget_item(self, shape):
+        op_id = self.item_ids.pop(shape, None)
+        if op_id:
+            del self.items_by_id[op_id]
+        for stroke_id, stroke in list(self.strokes.items()):
+            if stroke[0] == shape:
+                del self.strokes[stroke_id]
+
+    #func to take a shape off the board by op id. A canvas item goes right away, a shape already
+    # flattened into the tiles means drawing the tiles under it again. Returns False if it is not on the board
+    def remove_shape(self, op_id):
+        shape = self.items_by_id.get(op_id)
+        if shape is not None:
+            self.forget_item(shape)
+            self.canvas.delete(shape)
+            self.dead_items.add(shape)
+            return True
+        changed = self.tile_cache.remove(op_id)
+        if changed is not None:
+            self.refresh_tiles(changed)
+            return True
+        return False
+
+    #undo button: takes back our own newest shape when the server knows op ids, the newest one on the board otherwise
+    def undo_own(self):
+        if self.connection.protocol_version < OPID_VERSION:
+            self.undo()
+            return
+        while self.undo_stack:
+            op_id, op = self.undo_stack.pop()
+            if self.remove_shape(op_id):
+                self.redo_stack.append((op_id, op))
+                self.connection.send_op(("UNDO",) + op_id)
+                return
+
+    #redo button: draws our newest undone shape again under the same op id
+    def redo_own(self):
+        if self.connection.protocol_version < OPID_VERSION or not self.redo_stack:
+            return
+        self.add_own_shape(*reversed(self.redo_stack.pop()))
 
     def clear_canvas(self, from_server=False):
         self.canvas.delete("all")
-        self.shapes = []
-
-    def send_data(self, data):
-        try:
-            message = data.encode()
-            message_length = len(message)
-            self.client_socket.sendall(message_length.to_bytes(4, 'big'))
-            self.client_socket.sendall(message)
-        except Exception as e:
-            print(f"Send error details: {str(e)}")  # Add detailed logging
-            self.status_label.config(text=f"Disconnected: {str(e)}", fg="red")
-            messagebox.showerror("Error", f"Failed to send data: {e}")
-
-    def receive_data(self):
-        while True:
-            try:
-                message_length = int.from_bytes(self.client_socket.recv(4), 'big')
-                data = self.client_socket.recv(message_length).decode()
-
-                if not data:
-                    break
-
-                self.process_command(data)
-            except Exception as e:
-                print(f"Receive error details: {str(e)}")  
-                self.status_label.config(text=f"Disconnected: {str(e)}", fg="red")
-                messagebox.showerror("Error", f"Failed to receive data: {e}")
+        self.shapes.clear()
+        self.strokes = {}
+        self.tile_cache.clear()
+        self.tile_items = {}
+        self.items_by_id = {}
+        self.item_ids = {}
+        self.dead_items = set()
+
+    #func to hand ops from the receive thread to the Tk thread, which is the only one allowed to draw
+    def queue_ops(self, ops):
+        now = time.perf_counter()
+        for op in ops:
+            if op[0] == "SNAPSHOT":
+                #queued in pieces so a big board is drawn over several frames instead of freezing the UI
+                _, board_ops, open_ids = op
+                self.render_queue.append((now, ("CLEAR",)))
+                self.render_queue.extend((now, board_op) for board_op in board_ops)
+                self.render_queue.append((now, ("SNAPSHOTEND", open_ids)))
+            else:
+                self.render_queue.append((now, op))
+
+    #func run by the Tk main loop every RENDER_INTERVAL_MS to draw what has been received. A pass takes
+    # at most RENDER_SLICE ops, stops after RENDER_BUDGET_MS (having drawn at least one) and leaves the
+    # rest for the next one, so a burst from many drawers or a big snapshot is spread over frames
+    # while mouse and keyboard events still get handled in between
+    def render_queued(self):
+        start = time.perf_counter()
+        deadline = start + RENDER_BUDGET_MS / 1000
+
+        if self.pending_status:
+            text, colour = self.pending_status
+            self.pending_status = None
+            self.status_label.config(text=text, fg=colour)
+
+        if self.connection.view_stale:
+            self.connection.view_stale = False
+            self.update_view(force=True)
+
+        queue = self.render_queue
+        batch = coalesce_render_ops([queue.popleft() for _ in range(min(len(queue), RENDER_SLICE))])
+        lag = 0.0
+        for index, (arrived, op) in enumerate(batch):
+            if index and index % 8 == 0 and time.perf_counter() > deadline:
+                queue.extendleft(reversed(batch[index:]))
                 break
-
-    def process_command(self, data):
-        commands = data.split("\n")
-        for command in commands:
-            parts = command.split()
-            if not parts:
+            self.apply_op(op)
+            lag = max(lag, start - arrived)
+        if self.render_queue:
+            lag = max(lag, time.perf_counter() - self.render_queue[0][0])
+
+        self.render_lag = lag
+        text = f"Render lag: {lag * 1000:.0f} ms"
+        if self.lag_label.cget("text") != text:
+            self.lag_label.config(text=text)
+        self.root.after(RENDER_INTERVAL_MS, self.render_queued)
+
+    #func to draw one op received from the server
+    def apply_op(self, op):
+        cmd = op[0]
+        op_id, self.next_op_id = self.next_op_id, None
+
+        if cmd == "OPID":
+            self.next_op_id = op[1:]    #the id of the shape the next op starts
+
+        elif cmd in ("LINE", "RECT", "CIRC", "TEXT"):
+            self.add_shape(self.create_item(op), op, op_id)
+
+        elif cmd == "STROKE":
+            _, stroke_id, colour, width, points = op
+            stroke = self.strokes.get(stroke_id)
+            if stroke:
+                #later chunks extend the same canvas item, they start with the point the last one ended on
+                stroke[1].extend(points[2:])
+                self.canvas.coords(stroke[0], *[point * self.zoom for point in stroke[1]])
+            elif len(points) >= 4:
+                points = list(points)
+                op = ("STROKE", stroke_id, colour, width, points)
+                self.strokes[stroke_id] = (self.create_item(op), points)
+                self.add_shape(self.strokes[stroke_id][0], op, op_id)
+
+        elif cmd == "STROKEEND":
+            self.strokes.pop(op[1], None)
+
+        elif cmd == "SNAPSHOTEND":
+            #the whole board has been drawn after a snapshot, only the strokes still being drawn stay open
+            open_ids = op[1]
+            self.strokes = {stroke_id: stroke for stroke_id, stroke in self.strokes.items() if stroke_id in open_ids}
+
+        elif cmd == "UNDO" and len(op) == 3:
+            self.remove_shape(op[1:])
+
+        elif cmd == "UNDO":
+            self.undo(from_server=True)
+
+        elif cmd == "CLEAR":
+            self.clear_canvas(from_server=True)
+
+#func to shrink a batch of queued (arrival time, op) before drawing it: nothing before the last CLEAR
+# would stay on screen, and chunks of the same stroke are merged so it gets one coords update per frame
+def coalesce_render_ops(batch):
+    for index in range(len(batch) - 1, 0, -1):
+        if batch[index][1][0] == "CLEAR":
+            batch = batch[index:]
+            break
+
+    merged = []
+    open_chunks = {}    # stroke id -> index in merged of the chunk later ones are added to
+    for arrived, op in batch:
+        cmd = op[0]
+        if cmd == "STROKE":
+            index = open_chunks.get(op[1])
+            if index is not None:
+                merged[index][1][4].extend(op[4][2:])   #chunks overlap by one point
                 continue
-
-            cmd = parts[0]
-
-            if cmd == "LINE" and len(parts) >= 6:
-                x1, y1, x2, y2 = map(int, parts[1:5])
-                colour = parts[5]
-                width = int(parts[6]) if len(parts) > 6 else 2
-
-                shape = self.canvas.create_line(x1, y1, x2, y2, fill=colour, width=width, smooth=True, capstyle=tk.ROUND)
-                self.shapes.append(shape)
-
-            elif cmd == "RECT" and len(parts) >= 6:
-                x1, y1, x2, y2 = map(int, parts[1:5])
-                colour = parts[5]
-                width = int(parts[6]) if len(parts) > 6 else 2
-
-                shape = self.canvas.create_rectangle(x1, y1, x2, y2, outline=colour, width=width)
-                self.shapes.append(shape)
-
-            elif cmd == "CIRC" and len(parts) >= 5:
-                x, y, radius = map(int, parts[1:4])
-                colour = parts[4]
-                width = int(parts[5]) if len(parts) > 5 else 2
-
-                shape = self.canvas.create_oval(x - radius, y - radius, x + radius, y + radius, outline=colour, width=width)
-                self.shapes.append(shape)
-
-            elif cmd == "TEXT" and len(parts) >= 4:
-                x, y = map(int, parts[1:3])
-                colour = parts[3]
-                text = " ".join(parts[4:])
-
-                shape = self.canvas.create_text(x, y, text=text, fill=colour, font=("Arial", 12))
-                self.shapes.append(shape)
-
-            elif cmd == "UNDO":
-                self.undo(from_server=True)
-
-            elif cmd == "CLEAR":
-                self.clear_canvas(from_server=True)
-
-            else:
-                print(f"Unknown command: {command}")
+            open_chunks[op[1]] = len(merged)
+            op = op[:4] + (list(op[4]),)
+        elif cmd == "STROKEEND":
+            open_chunks.pop(op[1], None)
+        elif cmd in ("UNDO", "CLEAR"):
+            open_chunks.clear()
+        merged.append((arrived, op))
+    return merged
 
 def main():
     root = tk.Tk()
@@ -1,9 +1,22 @@
 import os
 import socket
+import tempfile
+import multiprocessing
 import threading
 import ssl
 import logging
+import asyncio
+import itertools
 import time
+from collections import deque
+from framing import encode_frame, send_frame, FrameReader, HEADER_SIZE, MAX_FRAME_SIZE
+from protocol import (Message, VIEW_VERSION, PACE_VERSION, parse_handshake, coalesce_payloads, encode_op,
+                      wants_compression, is_compressed, StreamCompressor, StreamDecompressor)
+from rooms import DEFAULT_ROOM, rooms, get_room, close_rooms, room_name, room_owner
+from bus import UnixHub, UnixBus
+from spatial import Interest
+from metrics import Metrics
+from flow import Flow
 
 # Configure logging
 logging.basicConfig(
@@ -19,110 +32,742 @@ BUFFER_SIZE = 1024
 CERTFILE_PATH = "certificate.pem"
 KEYFILE_PATH = "key.pem"
 
-# Dictionary to store connected clients
-clients = {}
+# "threaded" runs one OS thread per connection, "async" runs every connection on one asyncio event loop
+# and "sharded" runs WORKER_COUNT async worker processes that each own a share of the rooms
+SERVER_MODE = "threaded"
 
-# List to store drawing history for new clients
-drawing_history = []
-MAX_HISTORY_SIZE = 100  # Limit history size to prevent memory issues
+# Sharded mode only: every worker accepts on PORT (SO_REUSEPORT) and does the TLS work for the
+# connections it gets. Connections to a room another worker owns are piped to that worker over its
+# UNIX socket in WORKER_SOCKET_DIR, so each room lives in exactly one process. Only the room's own
+# work (applying, broadcasting, encoding) stays in its owner: the worker that accepted a connection
+# keeps decrypting, encrypting and pumping its bytes, so a busy room still costs CPU in every worker
+# that accepted some of its clients. None puts the sockets in a directory named after PORT in the
+# temporary directory, worked out when the server starts so two servers on different ports never share it
+WORKER_COUNT = os.cpu_count() or 1
+WORKER_SOCKET_DIR = None
 
-def handle_client(client_socket, address):
+# Async mode only: each client gets a bounded outbound queue drained by its own writer task
+SEND_QUEUE_SIZE = 256
+# What to do when a client's queue is full: "drop" the new message, "coalesce" the queued
+# messages into one newline-separated message, or "disconnect" the slow client
+SLOW_CONSUMER_POLICY = "coalesce"
+
+# Directory the boards are journaled to (one subdirectory per room) so they survive a restart,
+# None keeps them in memory only
+JOURNAL_DIR = None
+
+# Federation: nodes serving the same rooms exchange ops through the bus hub listening on this UNIX
+# socket, so a room can have more users than one process can serve. None runs this node standalone
+FEDERATION_BUS = None
+# Run the bus hub inside this node, exactly one node (or `python bus.py`) has to
+FEDERATION_HUB = False
+
+# How long a new connection may take to send HELLO before it is treated as an old text-only client
+HELLO_TIMEOUT = 1.0
+
+# Connections the kernel queues before they are accepted, a whole class joining at once fits
+LISTEN_BACKLOG = 512
+# TLS handshakes run on the connection's own thread (or task), never in the accept loop, and a
+# client that has not finished its handshake after this many seconds is dropped
+TLS_HANDSHAKE_TIMEOUT = 5.0
+# TLS 1.3 session tickets issued per connection, so a reconnecting client can resume its session
+# instead of doing a full handshake. TLS 1.2 clients resume from the server's session cache
+TLS_SESSION_TICKETS = 2
+
+# Flow control: each connection may send RATE_LIMIT_OPS ops a second, in bursts of up to
+# RATE_LIMIT_BURST. Past that its stroke chunks are merged and its other drawing ops dropped, and
+# clients from PACE_VERSION on are told to slow down. See flow.Flow
+RATE_LIMIT_OPS = 240
+RATE_LIMIT_BURST = 480
+# Threaded mode: a broadcast that takes this long means the room is fully loaded. Async mode measures
+# load by how full the peers' send queues are instead
+SLOW_BROADCAST_SECONDS = 0.02
+
+# Compress the connections of clients that ask for it (protocol version 10), see protocol.StreamCompressor.
+# In async mode a client's writer waits COMPRESS_BATCH_MS after the first frame is queued so the
+# frames that follow it are compressed together, threaded mode compresses every frame on its own
+COMPRESSION = True
+COMPRESS_BATCH_MS = 5
+
+# Serve Prometheus metrics over plain HTTP on this port, None turns metrics off. Sharded workers use
+# METRICS_PORT + their index. Keep METRICS_HOST local unless the scraper runs elsewhere
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
+# Serve PNG exports and thumbnails of the boards over plain HTTP on this port (needs Pillow), None
+# turns exporting off. Sharded workers use EXPORT_PORT + their index and export the rooms they own.
+# See render.serve_exports for the paths
+EXPORT_PORT = None
+EXPORT_HOST = "127.0.0.1"
+
+# Threaded mode: protocol version negotiated by each socket, clients that never said HELLO are version 1
+client_versions = {}
+# Threaded mode: what each socket gets to see of its room, see spatial.Interest
+client_interests = {}
+# Threaded mode: rate limit of each socket, see flow.Flow
+client_flows = {}
+# Threaded mode: seq of the last op each socket was sent in its join frames, older broadcasts skip it
+client_join_seqs = {}
+# Threaded mode: [lock, compressor or None] of each socket. Any thread may broadcast to a socket, the
+# lock keeps their frames from interleaving (which corrupts TLS records) and leaving in another
+# order than they went into the compressor
+client_senders = {}
+
+# Set in each worker process when sharded: the index of this worker
+SHARD_INDEX = None
+
+# Federated nodes hand every message to the bus and only apply what it delivers back, in the same
+# global order on every node. Messages wait in pending (by tag) until their own delivery comes back
+bus = None
+bus_tags = itertools.count()
+pending = {}
+event_loop = None   # set in async mode, bus deliveries arrive on another thread
+metrics = None      # metrics.Metrics when METRICS_PORT is set, every update checks for None first
+
+def is_hello(message):
+    return message is not None and message.text is not None and message.text.startswith("HELLO")
+
+#func to get the room a new client asked for in its first message
+def requested_room(first_message):
+    if is_hello(first_message):
+        return room_name(parse_handshake(first_message.text)[3])
+    return DEFAULT_ROOM
+
+# Works out the room and how to bring a new client up to date from its first message (None if it
+# sent nothing within HELLO_TIMEOUT). Returns the room, the protocol version, what the client has
+# already (board epoch, last seq and viewport, the arguments Room.join takes after the version), the
+# first message if it was an ordinary one that still has to be handled and whether the connection
+# is compressed after the first of the join frames (the WELCOME)
+def join_client(first_message):
+    if not is_hello(first_message):
+        return get_room(DEFAULT_ROOM, JOURNAL_DIR), 1, (None, None, None), first_message, False
+
+    version, epoch, last_seq, name, view = parse_handshake(first_message.text)
+    compress = COMPRESSION and wants_compression(first_message.text)
+    return get_room(name, JOURNAL_DIR), version, (epoch, last_seq, view), None, compress
+
+#func to get the messages in a frame from a client, a compressed frame can hold several
+def client_messages(payload, decompressor=None):
+    if is_compressed(payload):
+        if decompressor is None:
+            raise ValueError("Compressed frame on a connection that is not compressed")
+        messages = [Message.from_payload(inner) for inner in decompressor.payloads(payload)]
+    else:
+        messages = [Message.from_payload(payload)]
+    if metrics:
+        for index, message in enumerate(messages):
+            metrics.received(message, len(payload) + HEADER_SIZE if index == 0 else 0)
+    return messages
+
+#func to take VIEW ops out of a message, returns (the newest view or None, the rest of the message
+# or None when nothing is left)
+def split_view(message):
+    views = [op[1:] for op in message.ops if op[0] == "VIEW"]
+    if not views:
+        return None, message
+    ops = [op for op in message.ops if op[0] != "VIEW"]
+    return views[-1], Message(ops) if ops else None
+
+#func to get the frame telling a client how many milliseconds to leave between its stroke chunks
+def pace_frame(pace_ms):
+    return encode_frame(encode_op(("PACE", pace_ms)))
+
+#func to do the server side of the TLS handshake on a freshly accepted socket, returns the TLS
+# socket or None when the handshake failed or took longer than TLS_HANDSHAKE_TIMEOUT
+def tls_handshake(raw_socket, context, client_id):
+    started = time.perf_counter()
+    try:
+        client_socket = context.wrap_socket(raw_socket, server_side=True, do_handshake_on_connect=False)
+        client_socket.settimeout(TLS_HANDSHAKE_TIMEOUT)
+        client_socket.do_handshake()
+    except (ssl.SSLError, OSError) as e:
+        logger.warning(f"TLS handshake with {client_id} failed: {e}")
+        raw_socket.close()
+        return None
+    if metrics:
+        metrics.observe_handshake(time.perf_counter() - started)
+    return client_socket
+
+def handle_client(client_socket, address, context=None):
     client_id = f"{address[0]}:{address[1]}"
     logger.info(f"New connection from {client_id}")
+    room = None
+
+    if context:
+        client_socket = tls_handshake(client_socket, context, client_id)
+        if client_socket is None:
+            return
 
     try:
-        # Send drawing history to new client
-        for cmd in drawing_history:
-            try:
-                message = cmd.encode()
-                message_length = len(message)
-                client_socket.sendall(message_length.to_bytes(4, 'big'))
-                client_socket.sendall(message)
-                time.sleep(0.01)  # Small delay to prevent overwhelming the client
-            except Exception as e:
-                logger.error(f"Error sending history to client {client_id}: {e}")
-                break
+        # New clients open with HELLO, which decides the room and how the board is sent to them. Old
+        # clients never send it, so stop waiting after HELLO_TIMEOUT and treat them as version 1
+        reader = FrameReader(client_socket)
+        first_message = None
+        client_socket.settimeout(HELLO_TIMEOUT)
+        try:
+            payload = reader.read_frame()
+            if not payload:
+                return
+            first_message = Message.from_payload(payload)
+            if metrics:
+                metrics.received(first_message, len(payload) + HEADER_SIZE)
+        except socket.timeout:
+            pass
+        client_socket.settimeout(None)
+
+        # Send the whole board (or what it missed or can see) to new client in one frame. Broadcasts
+        # reach it from the moment it joins but wait on its send lock until the join frames are out
+        interest = client_interests[client_socket] = Interest()
+        client_flows[client_socket] = Flow(RATE_LIMIT_OPS, RATE_LIMIT_BURST, client_id)
+        room, version, known, first_message, compress = join_client(first_message)
+        client_versions[client_socket] = version
+        sender = client_senders[client_socket] = [threading.Lock(), None]
+        decompressor = None
+        with sender[0]:
+            frames, client_join_seqs[client_socket] = room.join(client_socket, address, version, *known,
+                                                                interest, compress)
+            for frame in frames:
+                send_frame(client_socket, frame)
+                if metrics:
+                    metrics.sent(len(frame))
+            if compress:
+                sender[1] = StreamCompressor()
+                decompressor = StreamDecompressor()
+
+        if first_message:
+            handle_message(first_message, client_socket, room)
 
         # Handle client messages
         while True:
-            message_length = int.from_bytes(client_socket.recv(4), 'big')
-            if message_length <= 0:
-                break
-
-            data = client_socket.recv(message_length).decode()
-            if not data:
+            payload = reader.read_frame()
+            if not payload:
                 break
 
-            logger.debug(f"Received from {client_id}: {data[:50]}...")
-
-            # Store commands that modify the canvas in history
-            if data.startswith(("LINE", "RECT", "CIRC", "TEXT")):
-                drawing_history.append(data)
-                # Trim history if it gets too long
-                if len(drawing_history) > MAX_HISTORY_SIZE:
-                    drawing_history.pop(0)
-            elif data == "CLEAR":
-                drawing_history.clear()
-            elif data == "UNDO" and drawing_history:
-                drawing_history.pop()
-
-            # Broadcast to all clients
-            broadcast(data, client_socket)
+            for message in client_messages(payload, decompressor):
+                logger.debug("Received from %s: %d ops", client_id, len(message.ops))
+                handle_message(message, client_socket, room)
     except Exception as e:
         logger.error(f"Error handling client {client_id}: {e}")
     finally:
         client_socket.close()
-        if client_socket in clients:
-            del clients[client_socket]
+        if room:
+            room.leave(client_socket)
+        client_versions.pop(client_socket, None)
+        client_interests.pop(client_socket, None)
+        client_flows.pop(client_socket, None)
+        client_join_seqs.pop(client_socket, None)
+        client_senders.pop(client_socket, None)
         logger.info(f"Connection closed for {client_id}")
 
-def broadcast(message, sender_socket):
+def handle_message(message, sender_socket, room):
+    view, message = split_view(message)
+    version = client_versions.get(sender_socket, 1)
+    if view and version >= VIEW_VERSION:
+        with room.fanout_lock:
+            send_to_client(sender_socket, room.change_view(client_interests[sender_socket], version, view))
+    if not message:
+        return
+
+    message = room.claim_authors(message, sender_socket)
+    flow = client_flows[sender_socket]
+    message, pace_ms = flow.admit(message, room.load)
+    if pace_ms is not None and version >= PACE_VERSION:
+        send_to_client(sender_socket, pace_frame(pace_ms))
+    if flow.rejected:
+        with room.fanout_lock:
+            send_to_client(sender_socket, room.reject_frame(version, flow.rejected, client_interests[sender_socket]))
+    if not message:
+        # held back or dropped, acknowledged all the same so the client does not send it again
+        ack = room.ack_frame(version)
+        if ack:
+            send_to_client(sender_socket, ack)
+        return
+
+    if bus:
+        publish_message(message, sender_socket, room)
+    else:
+        deliver_message(message, sender_socket, room)
+
+#func to apply a message and send it on as one step, one message of a room at a time. Every peer
+# a send blocks on holds up all broadcasts anyway, and this way nobody sees ops out of seq order
+def deliver_message(message, sender_socket, room):
+    with room.fanout_lock:
+        ack = room.apply(message, client_versions.get(sender_socket, 1))
+        if ack and sender_socket:
+            try:
+                send_to_client(sender_socket, ack)
+            except Exception as e:
+                logger.error(f"Error acknowledging client {room.clients.get(sender_socket)}: {e}")
+
+        # Broadcast to all clients in the room, unless it only repeated what the board already has
+        if message.ops:
+            broadcast(message, sender_socket, room)
+
+def broadcast(message, sender_socket, room):
+    started = time.perf_counter()
+    clients = room.clients
     dropped_clients = []
 
-    for client_socket in clients:
-        if client_socket != sender_socket:
+    for client_socket in list(clients):
+        # a client that joined after the message was applied has it in its join frames already
+        if client_socket != sender_socket and message.seq > client_join_seqs.get(client_socket, 0):
             try:
-                message_bytes = message.encode()
-                message_length = len(message_bytes)
-                client_socket.sendall(message_length.to_bytes(4, 'big'))
-                client_socket.sendall(message_bytes)
+                # each encoding is built once and reused for every peer that speaks it and sees it all
+                interest = client_interests.get(client_socket)
+                version = client_versions.get(client_socket, 1)
+                if message.needs_resync(version):
+                    frame = room.resync_frame(version, interest)
+                else:
+                    visible = interest.filter(message) if interest else message
+                    frame = visible.frame(version) if visible else None
+                if frame:
+                    send_to_client(client_socket, frame)
             except Exception as e:
-                logger.error(f"Error broadcasting to client {clients[client_socket]}: {e}")
+                logger.error(f"Error broadcasting to client {clients.get(client_socket)}: {e}")
                 dropped_clients.append(client_socket)
 
     # Remove dropped clients
     for client in dropped_clients:
         if client in clients:
             del clients[client]
+    elapsed = time.perf_counter() - started
+    room.record_load(elapsed / SLOW_BROADCAST_SECONDS)
+    if metrics:
+        metrics.observe_broadcast(elapsed)
+
+#func to send one frame to a client in threaded mode
+def send_to_client(client_socket, frame):
+    lock, compressor = client_senders[client_socket]
+    with lock:
+        frames = compressor.pack([frame]) if compressor else [frame]
+        for frame in frames:
+            send_frame(client_socket, frame)
+    if metrics:
+        metrics.sent(sum(len(frame) for frame in frames))
+
+# Outbound side of one client in async mode. Messages wait in a bounded queue and a dedicated
+# writer task flushes them, so a slow peer only ever holds up its own queue, never the broadcast
+class AsyncClient:
+    def __init__(self, reader, writer, client_id):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = client_id
+        self.queue = deque()    # encoded frames waiting to be written
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.version = 1
+        self.interest = Interest()  # what this client gets to see of its room
+        self.flow = Flow(RATE_LIMIT_OPS, RATE_LIMIT_BURST, client_id)
+        self.compressor = None      # set once the connection is compressed, with the decompressor
+        self.decompressor = None
+
+    #func to compress the connection from here on. The frames sent so far (the WELCOME) are written
+    # straight away, ahead of everything queued later
+    def start_compression(self, frames):
+        for frame in frames:
+            self.writer.write(frame)
+            if metrics:
+                metrics.sent(len(frame))
+        self.compressor = StreamCompressor()
+        self.decompressor = StreamDecompressor()
+
+    def enqueue(self, frame, force=False):
+        if self.closed:
+            return
+        if not force and len(self.queue) >= SEND_QUEUE_SIZE:
+            if SLOW_CONSUMER_POLICY == "disconnect":
+                logger.warning(f"Disconnecting slow client {self.client_id}")
+                self.close()
+                return
+            elif SLOW_CONSUMER_POLICY == "coalesce":
+                # Clients already split a message on newlines, so the backlog can travel as one message
+                pending = coalesce_payloads([queued[HEADER_SIZE:] for queued in self.queue])
+                self.queue.clear()
+                self.queue.extend(encode_frame(payload) for payload in pending)
+            else:
+                if self.dropped == 0:
+                    logger.warning(f"Send queue full for {self.client_id}, dropping messages")
+                self.dropped += 1
+                return
+        self.queue.append(frame)
+        self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                if self.compressor and COMPRESS_BATCH_MS:
+                    await asyncio.sleep(COMPRESS_BATCH_MS / 1000)  # the frames right behind this one join its batch
+                    if self.closed:
+                        break
+                frames = list(self.queue)
+                self.queue.clear()
+                if self.compressor:
+                    frames = self.compressor.pack(frames)
+                for frame in frames:
+                    self.writer.write(frame)
+                    if metrics:
+                        metrics.sent(len(frame))
+                await self.writer.drain()
+        except Exception as e:
+            logger.error(f"Error writing to client {self.client_id}: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.ready.set()
+            self.writer.close()
+
+def broadcast_async(message, sender, room):
+    started = metrics and time.perf_counter()
+    backlog = 0     # longest send queue in the room, how far behind its slowest peer is
+    for client in list(room.clients):
+        backlog = max(backlog, len(client.queue))
+        if client is not sender:
+            if message.needs_resync(client.version):
+                frame = room.resync_frame(client.version, client.interest)
+            else:
+                visible = client.interest.filter(message)
+                frame = visible.frame(client.version) if visible else None
+            if frame:
+                client.enqueue(frame)
+    room.record_load(backlog / SEND_QUEUE_SIZE)
+    if metrics:
+        metrics.observe_broadcast(time.perf_counter() - started)
+
+#func to read one frame, returns its payload or None once the client has closed the connection
+async def read_payload_async(reader, client_id, timeout=None):
+    # only the header read can time out, so a timeout never leaves half a frame behind
+    message_length = int.from_bytes(await asyncio.wait_for(reader.readexactly(HEADER_SIZE), timeout), 'big')
+    if message_length <= 0:
+        return None
+    if message_length > MAX_FRAME_SIZE:
+        logger.warning(f"Oversized frame ({message_length} bytes) from {client_id}")
+        return None
+    return await reader.readexactly(message_length)
+
+#func to read the first message of a connection, which is never compressed
+async def read_message_async(reader, client_id, timeout=None):
+    payload = await read_payload_async(reader, client_id, timeout)
+    return client_messages(payload)[0] if payload else None
+
+async def handle_client_async(reader, writer):
+    address = writer.get_extra_info('peername')
+    client_id = f"{address[0]}:{address[1]}" if address else "worker connection"
+    logger.info(f"New connection from {client_id}")
+
+    # Wait for HELLO like the threaded mode does, old clients never send one
+    first_message = None
+    try:
+        first_message = await read_message_async(reader, client_id, HELLO_TIMEOUT)
+        if first_message is None:
+            writer.close()
+            return
+    except asyncio.TimeoutError:
+        pass
+    except (asyncio.IncompleteReadError, ConnectionError):
+        writer.close()
+        return
+
+    if SHARD_INDEX is not None:
+        owner = room_owner(requested_room(first_message), WORKER_COUNT)
+        if owner != SHARD_INDEX:
+            await proxy_to_worker(reader, writer, owner, first_message, client_id)
+            return
+
+    client = AsyncClient(reader, writer, client_id)
+    writer_task = asyncio.create_task(client.write_loop())
+    room = None
+
+    try:
+        # Send the whole board (or what it missed) to new client, the queue bound only applies to live traffic
+        room, client.version, known, first_message, compress = join_client(first_message)
+        frames, _ = room.join(client, address, client.version, *known, client.interest, compress)
+        if compress:
+            client.start_compression(frames[:1])
+            frames = frames[1:]
+        for frame in frames:
+            client.enqueue(frame, force=True)
+
+        if first_message:
+            handle_message_async(first_message, client, room)
+
+        # Handle client messages
+        while not client.closed:
+            payload = await read_payload_async(reader, client_id)
+            if payload is None:
+                break
+
+            for message in client_messages(payload, client.decompressor):
+                logger.debug("Received from %s: %d ops", client_id, len(message.ops))
+                handle_message_async(message, client, room)
+    except asyncio.IncompleteReadError:
+        pass
+    except Exception as e:
+        logger.error(f"Error handling client {client_id}: {e}")
+    finally:
+        if room:
+            room.leave(client)
+        client.close()
+        await writer_task
+        logger.info(f"Connection closed for {client_id}")
+
+def handle_message_async(message, sender, room):
+    view, message = split_view(message)
+    if view and sender.version >= VIEW_VERSION:
+        sender.enqueue(room.change_view(sender.interest, sender.version, view), force=True)
+    if not message:
+        return
+
+    message = room.claim_authors(message, sender)
+    message, pace_ms = sender.flow.admit(message, room.load)
+    if pace_ms is not None and sender.version >= PACE_VERSION:
+        sender.enqueue(pace_frame(pace_ms), force=True)
+    if sender.flow.rejected:
+        sender.enqueue(room.reject_frame(sender.version, sender.flow.rejected, sender.interest), force=True)
+    if not message:
+        ack = room.ack_frame(sender.version)
+        if ack:
+            sender.enqueue(ack)
+        return
+
+    if bus:
+        publish_message(message, sender, room)
+    else:
+        deliver_message_async(message, sender, room)
+
+def deliver_message_async(message, sender, room):
+    ack = room.apply(message, sender.version if sender else 1)
+    if ack and sender:
+        sender.enqueue(ack)
+    if message.ops:
+        broadcast_async(message, sender, room)
+
+#func to hand a client's message to the federation bus instead of applying it straight away
+def publish_message(message, sender, room):
+    tag = next(bus_tags)
+    pending[tag] = sender
+    try:
+        bus.publish(room.name, message.body(not message.text_only, False), tag)
+    except Exception as e:
+        pending.pop(tag, None)
+        logger.error(f"Error publishing to the federation bus: {e}")
+
+#func called by the bus for every message of every node, in the global order
+def on_bus_message(name, payload, ours, tag):
+    sender = pending.pop(tag, None) if ours else None
+    if SHARD_INDEX is not None and room_owner(name, WORKER_COUNT) != SHARD_INDEX:
+        return
+    message = Message.from_payload(payload)
+    room = get_room(name, JOURNAL_DIR)
+    if not ours:
+        room.claim_authors(message, None)
+    if event_loop:
+        event_loop.call_soon_threadsafe(deliver_message_async, message, sender, room)
+    else:
+        deliver_message(message, sender, room)
+
+#func called by the bus when this node connects, to start every room from the federation's board
+def on_bus_sync(name, ops, open_ids, seq):
+    if SHARD_INDEX is not None and room_owner(name, WORKER_COUNT) != SHARD_INDEX:
+        return
+    room = get_room(name, JOURNAL_DIR)
+    if event_loop:
+        event_loop.call_soon_threadsafe(room.board.restore, ops, open_ids, seq)
+    else:
+        room.board.restore(ops, open_ids, seq)
+
+def join_federation():
+    global bus
+    if FEDERATION_BUS:
+        bus = UnixBus(FEDERATION_BUS, on_bus_message, on_bus_sync)
+        logger.info(f"Joined federation bus {FEDERATION_BUS} as node {bus.node_id:08x}")
+
+#func to start serving metrics if METRICS_PORT is set, each sharded worker on a port of its own
+def start_metrics(shard_index=None):
+    global metrics
+    if METRICS_PORT is None:
+        return
+    metrics = Metrics()
+    metrics.add_gauge("whiteboard_connected_clients", "Clients connected to each room",
+                      lambda: [({"room": room.name}, len(room.clients)) for room in list(rooms.values())])
+    metrics.add_gauge("whiteboard_board_ops", "Entries on each room's board",
+                      lambda: [({"room": room.name}, len(room.board)) for room in list(rooms.values())])
+    metrics.add_gauge("whiteboard_send_queue_depth", "Frames waiting in each client's outbound queue (async mode)",
+                      lambda: [({"room": room.name, "client": client.client_id}, len(client.queue))
+                               for room in list(rooms.values()) for client in list(room.clients)
+                               if isinstance(client, AsyncClient)])
+    metrics.add_gauge("whiteboard_room_load", "How far behind each room's broadcasts are, 1 is the limit",
+                      lambda: [({"room": room.name}, room.load) for room in list(rooms.values())])
+    metrics.serve(METRICS_HOST, METRICS_PORT + (shard_index or 0))
+
+#func to start serving board exports if EXPORT_PORT is set, each sharded worker on a port of its own
+def start_exports(shard_index=None):
+    if EXPORT_PORT is None:
+        return
+    from render import serve_exports     # Pillow is only needed when exporting
+
+    # rooms that are not loaded yet can still be exported from their journal
+    def find_room(name):
+        if room_name(name) != name or (shard_index is not None and room_owner(name, WORKER_COUNT) != shard_index):
+            return None
+        if name in rooms or (JOURNAL_DIR and os.path.isdir(os.path.join(JOURNAL_DIR, name))):
+            return get_room(name, JOURNAL_DIR)
+        return None
+
+    serve_exports(EXPORT_HOST, EXPORT_PORT + (shard_index or 0), find_room, lambda: list(rooms.items()))
+
+def worker_socket_path(index):
+    return os.path.join(WORKER_SOCKET_DIR, f"worker-{index}.sock")
+
+#func to pipe a connection whose room belongs to another worker through to that worker. TLS stays
+# here, the owner sees a plain connection that starts with the client's HELLO
+async def proxy_to_worker(reader, writer, owner, first_message, client_id):
+    if is_hello(first_message):
+        opening = [first_message.text]
+    else:
+        # old clients never say HELLO, speak for them so the owner does not wait for one as well
+        opening = [f"HELLO 1 room={DEFAULT_ROOM}"]
+        if first_message:
+            opening.append(first_message.binary if first_message.binary is not None else first_message.text)
+
+    async def pump(source, destination):
+        try:
+            while True:
+                data = await source.read(65536)
+                if not data:
+                    break
+                destination.write(data)
+                await destination.drain()
+        except Exception:
+            pass
+        finally:
+            destination.close()
+
+    try:
+        owner_reader, owner_writer = await asyncio.open_unix_connection(worker_socket_path(owner))
+    except Exception as e:
+        logger.error(f"Cannot reach worker {owner} for {client_id}: {e}")
+        writer.close()
+        return
+
+    owner_writer.write(b"".join(encode_frame(message) for message in opening))
+    logger.debug(f"Piping {client_id} to worker {owner}")
+    await asyncio.gather(pump(reader, owner_writer), pump(owner_reader, writer))
+
+def create_ssl_context():
+    try:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=CERTFILE_PATH, keyfile=KEYFILE_PATH)
+        context.options &= ~ssl.OP_NO_TICKET
+        context.num_tickets = TLS_SESSION_TICKETS
+        logger.info("SSL enabled")
+        return context
+    except FileNotFoundError:
+        logger.warning(f"Certificate files not found. Running without SSL.")
+        logger.warning(f"Expected certificate files at: {CERTFILE_PATH} and {KEYFILE_PATH}")
+    except Exception as e:
+        logger.warning(f"Failed to initialize SSL: {e}")
+        logger.warning("Running without SSL")
+    return None
+
+async def serve_async(shard_index=None):
+    global event_loop
+    event_loop = asyncio.get_running_loop()
+    start_metrics(shard_index)
+    start_exports(shard_index)
+    join_federation()
+    context = create_ssl_context()
+    # asyncio does the handshakes on the event loop alongside everything else
+    server = await asyncio.start_server(handle_client_async, HOST if HOST else None, PORT, ssl=context,
+                                        ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT if context else None,
+                                        backlog=LISTEN_BACKLOG, reuse_address=True,
+                                        reuse_port=shard_index is not None)
+    if shard_index is None:
+        logger.info(f"Async server started on {HOST if HOST else '*'}:{PORT}")
+        async with server:
+            await server.serve_forever()
+        return
+
+    path = worker_socket_path(shard_index)
+    if os.path.exists(path):
+        os.remove(path)
+    worker_server = await asyncio.start_unix_server(handle_client_async, path, backlog=LISTEN_BACKLOG)
+    logger.info(f"Worker {shard_index} started on {HOST if HOST else '*'}:{PORT}")
+    async with server, worker_server:
+        await asyncio.gather(server.serve_forever(), worker_server.serve_forever())
+
+def run_worker(shard_index, socket_dir):
+    global SHARD_INDEX, WORKER_SOCKET_DIR
+    SHARD_INDEX = shard_index
+    WORKER_SOCKET_DIR = socket_dir
+    try:
+        asyncio.run(serve_async(shard_index))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        close_rooms()
 
 def main():
+    hub = None
+    if FEDERATION_HUB and FEDERATION_BUS:
+        hub = UnixHub(FEDERATION_BUS)
+        hub.start()
+    try:
+        serve()
+    finally:
+        if hub:
+            hub.close()
+
+def serve():
+    if SERVER_MODE == "sharded":
+        socket_dir = WORKER_SOCKET_DIR or os.path.join(tempfile.gettempdir(), f"whiteboard-{PORT}")
+        os.makedirs(socket_dir, exist_ok=True)
+        workers = [multiprocessing.Process(target=run_worker, args=(index, socket_dir), daemon=True)
+                   for index in range(WORKER_COUNT)]
+        for worker in workers:
+            worker.start()
+        logger.info(f"Sharded server started with {WORKER_COUNT} workers")
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            logger.info("Server shutting down.")
+        return
+
+    if SERVER_MODE == "async":
+        try:
+            asyncio.run(serve_async())
+        except KeyboardInterrupt:
+            logger.info("Server shutting down.")
+        finally:
+            close_rooms()
+        return
+
+    start_metrics()
+    start_exports()
+    join_federation()
+
     # Create server socket
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
     try:
         server_socket.bind((HOST, PORT))
-        server_socket.listen(5)
+        server_socket.listen(LISTEN_BACKLOG)
         logger.info(f"Server started on {HOST if HOST else '*'}:{PORT}")
 
         # Create SSL context
-        try:
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_cert_chain(certfile=CERTFILE_PATH, keyfile=KEYFILE_PATH)
-            server_socket = context.wrap_socket(server_socket, server_side=True)
-            logger.info("SSL enabled")
-        except FileNotFoundError:
-            logger.warning(f"Certificate files not found. Running without SSL.")
-            logger.warning(f"Expected certificate files at: {CERTFILE_PATH} and {KEYFILE_PATH}")
-        except Exception as e:
-            logger.warning(f"Failed to initialize SSL: {e}")
-            logger.warning("Running without SSL")
+        context = create_ssl_context()
 
-        # Accept connections
+        # Accept connections, each one does its TLS handshake on its own thread so a slow one holds up nobody
         while True:
             client_socket, address = server_socket.accept()
-            clients[client_socket] = address
-            client_thread = threading.Thread(target=handle_client, args=(client_socket, address))
+            client_thread = threading.Thread(target=handle_client, args=(client_socket, address, context))
             client_thread.daemon = True
             client_thread.start()
 
@@ -132,6 +777,9 @@ def main():
         logger.error(f"Server error: {e}")
     finally:
         server_socket.close()
+        if bus:
+            bus.close()
+        close_rooms()
 
 if __name__ == "__main__":
     main()
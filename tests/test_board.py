@@ -0,0 +1,94 @@
+import random
+from board import Board, simplify, COMPACT_MIN_TOMBSTONES
+
+def rect(n):
+    return ("RECT", n, 0, n + 10, 10, "#000000", 2)
+
+def test_simplify_drops_collinear_points():
+    assert simplify([0, 0, 1, 0, 2, 0, 3, 0, 10, 0]) == [0, 0, 10, 0]
+
+def test_simplify_keeps_corners_and_ends():
+    points = [0, 0, 5, 0, 10, 0, 10, 5, 10, 10]
+    assert simplify(points) == [0, 0, 10, 0, 10, 10]
+
+def test_simplify_stays_within_tolerance():
+    rng = random.Random(1)
+    points = []
+    for i in range(200):
+        points += [i, rng.randint(-3, 3)]
+    simplified = simplify(points, 2.0)
+    assert simplified[:2] == points[:2] and simplified[-2:] == points[-2:]
+    kept = list(zip(simplified[0::2], simplified[1::2]))
+    for x, y in zip(points[0::2], points[1::2]):
+        # every dropped point lies close to the segment that replaced it
+        (x1, y1), (x2, y2) = next((a, b) for a, b in zip(kept, kept[1:]) if a[0] <= x <= b[0])
+        distance = abs((x - x1) * (y2 - y1) - (y - y1) * (x2 - x1)) / ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5
+        assert distance <= 2.0 + 1e-9
+
+def test_stroke_chunks_merge_into_one_simplified_entry():
+    board = Board()
+    board.apply(("STROKE", 7, "#000000", 2, (0, 0, 1, 0, 2, 0)), (9, 1))
+    board.apply(("STROKE", 7, "#000000", 2, (2, 0, 3, 0, 4, 0)))
+    board.apply(("STROKEEND", 7))
+    assert board.history() == [("STROKE", 7, "#000000", 2, (0, 0, 4, 0))]
+    assert board.snapshot(ids=True)[2][0] == ("OPID", 9, 1)
+
+def test_undo_by_id_leaves_tombstones_until_compacted():
+    board = Board()
+    count = 4 * COMPACT_MIN_TOMBSTONES
+    for n in range(count):
+        board.apply(rect(n), (1, n))
+    for n in range(COMPACT_MIN_TOMBSTONES):
+        board.apply(("UNDO", 1, 2 * n))
+    assert len(board.ops) == count     # only marked dead so far
+    assert len(board) == count - COMPACT_MIN_TOMBSTONES
+    assert (1, 0) not in board.ids
+
+    board.apply(("UNDO", 1, 2 * COMPACT_MIN_TOMBSTONES))
+    assert not board.dead and len(board.ops) == len(board)     # compacted
+    live = [rect(n) for n in range(count) if n % 2 or n > 2 * COMPACT_MIN_TOMBSTONES]
+    assert board.history() == live
+    assert board.index.query((-100, -100, 10000, 100)) == live
+
+def test_plain_undo_skips_tombstones():
+    board = Board()
+    for n in range(3):
+        board.apply(rect(n), (1, n))
+    board.apply(("UNDO", 1, 2))
+    effects = {}
+    board.apply(("UNDO",), None, effects)
+    assert effects["id"] == (1, 1)
+    assert board.history() == [rect(0)]
+
+def test_duplicate_op_ids_are_ignored():
+    board = Board()
+    board.apply(rect(1), (1, 1))
+    effects = {}
+    board.apply(rect(1), (1, 1), effects)
+    assert effects["duplicate"] and len(board) == 1
+
+def test_ops_since():
+    board = Board()
+    board.apply(rect(1), (1, 1))
+    seq = board.seq
+    board.apply(rect(2), (1, 2))
+    board.apply(("UNDO", 1, 2))
+    assert board.ops_since(seq) == ([("OPID", 1, 2), rect(2), ("UNDO", 1, 2)], seq + 2)
+    assert board.ops_since(board.seq) == ([], board.seq)
+    assert board.ops_since(board.seq + 1) is None
+
+def test_ops_since_needs_a_resync_after_an_undo_old_clients_cannot_follow():
+    board = Board()
+    board.apply(rect(1), (1, 1))
+    board.apply(rect(2), (1, 2))
+    seq = board.seq
+    board.apply(("UNDO", 1, 1))    # from the middle, which a plain UNDO cannot express
+    assert board.ops_since(seq, ids=True) is not None
+    assert board.ops_since(seq, ids=False) is None
+
+def test_full_board_drops_the_oldest_entries():
+    board = Board(max_size=3)
+    for n in range(5):
+        board.apply(rect(n), (1, n))
+    assert board.history() == [rect(2), rect(3), rect(4)]
+    assert (1, 0) not in board.ids and len(board.index) == 3
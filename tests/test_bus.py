@@ -0,0 +1,110 @@
+import time
+import threading
+from board import Board
+import bus
+from bus import Hub, LocalBus, UnixHub, UnixBus
+from protocol import Message, encode_ops
+
+# A node as the server runs it: its own board per room, changed only by what the bus delivers
+class Node:
+    def __init__(self):
+        self.boards = {}
+        self.bus = None
+
+    def board(self, room):
+        return self.boards.setdefault(room, Board())
+
+    def on_message(self, room, payload, ours, tag):
+        self.board(room).apply_all(Message.from_payload(payload).ops)
+
+    def on_sync(self, room, ops, open_ids, seq):
+        self.board(room).restore(ops, open_ids, seq)
+
+    def draw(self, room, ops):
+        self.bus.publish(room, encode_ops(ops), 0)
+
+def contents(board):
+    return board.snapshot(ids=True)[1:]
+
+def draw_concurrently(nodes, count):
+    def draw(node, author):
+        for n in range(count):
+            node.draw("room", [("OPID", author, n), ("RECT", n, author, n + 5, author + 5, "#000000", 2)])
+            if n % 7 == 0:
+                node.draw("room", [("UNDO", author, n - 1)] if n else [("UNDO",)])
+    threads = [threading.Thread(target=draw, args=(node, author + 1)) for author, node in enumerate(nodes)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return len(nodes) * (count + (count + 6) // 7)     # messages published
+
+#func to wait until every node has had the deliveries up to seq, which arrive on threads of their own
+def settle(nodes, seq):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not all(node.bus.seq == seq for node in nodes):
+        time.sleep(0.01)
+
+def test_local_nodes_end_with_identical_boards():
+    hub = Hub()
+    nodes = [Node(), Node()]
+    for node in nodes:
+        node.bus = LocalBus(hub, node.on_message, node.on_sync)
+    published = draw_concurrently(nodes, 200)
+    settle(nodes, published)
+
+    first, second = (node.boards["room"] for node in nodes)
+    assert contents(first) == contents(second)
+    assert len(first) > 300
+    assert nodes[0].bus.seq == nodes[1].bus.seq == hub.seq == published
+
+def test_late_node_is_synced():
+    hub = Hub()
+    early = Node()
+    early.bus = LocalBus(hub, early.on_message, early.on_sync)
+    early.draw("room", [("OPID", 1, 1), ("STROKE", 4, "#000000", 2, (0, 0, 10, 10))])
+    early.draw("other", [("OPID", 1, 2), ("RECT", 0, 0, 5, 5, "#000000", 2)])
+
+    late = Node()
+    late.bus = LocalBus(hub, late.on_message, late.on_sync)
+    early.draw("room", [("STROKE", 4, "#000000", 2, (10, 10, 20, 0)), ("STROKEEND", 4)])
+    settle([early, late], hub.seq)
+    for room in ("room", "other"):
+        assert contents(late.boards[room]) == contents(early.boards[room])
+
+def test_unix_nodes_end_with_identical_boards(tmp_path):
+    hub = UnixHub(str(tmp_path / "bus.sock"))
+    hub.start()
+    nodes = [Node(), Node()]
+    try:
+        for node in nodes:
+            node.bus = UnixBus(hub.path, node.on_message, node.on_sync)
+        published = draw_concurrently(nodes, 100)
+        settle(nodes, published)
+
+        first, second = (node.boards["room"] for node in nodes)
+        assert contents(first) == contents(second)
+        assert len(first) > 150
+    finally:
+        for node in nodes:
+            if node.bus:
+                node.bus.close()
+        hub.close()
+
+def test_a_node_that_falls_behind_is_dropped_without_holding_up_the_others(monkeypatch):
+    monkeypatch.setattr(bus, "NODE_QUEUE_SIZE", 10)
+    hub = Hub()
+    fast = Node()
+    fast.bus = LocalBus(hub, fast.on_message, fast.on_sync)
+    stuck = threading.Event()
+    dropped = threading.Event()
+    hub.add_node(lambda *delivery: stuck.wait(), dropped.set)
+
+    started = time.monotonic()
+    for n in range(20):
+        fast.draw("room", [("OPID", 1, n), ("RECT", n, 0, n + 5, 5, "#000000", 2)])
+        settle([fast], n + 1)
+    assert time.monotonic() - started < 1
+    assert dropped.wait(1) and len(hub.nodes) == 1
+    assert len(fast.boards["room"]) == 20
+    stuck.set()
@@ -0,0 +1,47 @@
+import time
+from collections import deque
+from types import SimpleNamespace
+import ssl_client
+from ssl_client import WhiteboardClient, coalesce_render_ops
+
+class FakeClient:
+    render_queued = WhiteboardClient.render_queued
+
+    def __init__(self, op_seconds=0.0):
+        self.render_queue = deque()
+        self.pending_status = None
+        self.connection = SimpleNamespace(view_stale=False)
+        self.lag_label = SimpleNamespace(cget=lambda option: "", config=lambda **options: None)
+        self.root = SimpleNamespace(after=lambda ms, callback: None)
+        self.op_seconds = op_seconds
+        self.drawn = []
+
+    def apply_op(self, op):
+        if self.op_seconds:
+            time.sleep(self.op_seconds)
+        self.drawn.append(op)
+
+def test_big_backlog_drains_over_passes():
+    client = FakeClient()
+    client.render_queue.extend((0.0, ("RECT", i, 0, i + 5, 5, "#000000", 2)) for i in range(20000))
+    passes = 0
+    while client.render_queue:
+        before = len(client.drawn)
+        client.render_queued()
+        assert len(client.drawn) > before
+        passes += 1
+    assert len(client.drawn) == 20000 and passes >= 20000 / ssl_client.RENDER_SLICE
+
+def test_every_pass_draws_something_when_ops_are_slow():
+    client = FakeClient(op_seconds=ssl_client.RENDER_BUDGET_MS / 1000)
+    client.render_queue.extend((0.0, ("RECT", i, 0, i + 5, 5, "#000000", 2)) for i in range(3))
+    for _ in range(3):
+        client.render_queued()
+    assert len(client.drawn) == 3
+
+def test_coalesce_merges_stroke_chunks_and_skips_what_a_clear_wipes():
+    batch = [(0.0, ("RECT", 0, 0, 5, 5, "#000000", 2)), (0.0, ("CLEAR",)),
+             (0.0, ("STROKE", 1, "#000000", 2, (0, 0, 1, 1))), (0.0, ("STROKE", 1, "#000000", 2, (1, 1, 2, 2))),
+             (0.0, ("STROKEEND", 1))]
+    ops = [op for _, op in coalesce_render_ops(batch)]
+    assert ops == [("CLEAR",), ("STROKE", 1, "#000000", 2, [0, 0, 1, 1, 2, 2]), ("STROKEEND", 1)]
@@ -0,0 +1,105 @@
+from client_core import ClientCore
+from framing import HEADER_SIZE
+from protocol import PROTOCOL_VERSION, Message, decode_ops, welcome_message
+from rooms import Room
+
+# Stands in for the TLS socket, keeping what the client sends
+class FakeSocket:
+    session = None
+
+    def __init__(self):
+        self.sent = []
+
+    def connect(self, address):
+        pass
+
+    def sendall(self, frame):
+        self.sent.append(bytes(frame))
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+    def messages(self):
+        return [decode_ops(frame[HEADER_SIZE:]) for frame in self.sent if not frame[HEADER_SIZE:].startswith(b"HELLO")]
+
+class FakeContext:
+    def wrap_socket(self, raw_socket, server_hostname=None, session=None):
+        raw_socket.close()
+        self.socket = FakeSocket()
+        return self.socket
+
+def rect(n):
+    return ("RECT", n, 0, n + 5, 5, "#000000", 2)
+
+def connected_client():
+    client = ClientCore("localhost", 0, None)
+    client.context = FakeContext()
+    client.connect()
+    return client
+
+def welcome(client, epoch="e1"):
+    client.handle_payload(welcome_message(PROTOCOL_VERSION, epoch).encode())
+
+def test_ops_drawn_before_the_welcome_are_sent_after_it():
+    client = ClientCore("localhost", 0, None)
+    client.send_ops([rect(0)])     # offline
+    client.context = FakeContext()
+    client.connect()
+    client.send_ops([rect(1)])     # connected, but not welcomed yet
+    assert client.context.socket.messages() == []
+
+    welcome(client)
+    assert client.context.socket.messages() == [[rect(0)], [rect(1)]]
+    assert list(client.in_flight) == [[rect(0)], [rect(1)]]
+
+def test_acknowledgements_are_counted():
+    client = connected_client()
+    welcome(client)
+    client.send_ops([rect(0)])
+    client.send_ops([rect(1)])
+    client.handle_ops([("SEQ", 10)])   # what brings us up to date after WELCOME, not an ack
+    assert len(client.in_flight) == 2
+    client.handle_ops([("SEQ", 11), rect(5)])     # someone else's op
+    assert len(client.in_flight) == 2
+    client.handle_ops([("SEQ", 12)])
+    assert list(client.in_flight) == [[rect(1)]]
+    client.handle_ops([("SEQ", 13), ("SEQ", 14)])
+    assert not client.in_flight and client.last_seq == 14
+
+def test_unacknowledged_ops_are_sent_again_after_reconnecting():
+    client = connected_client()
+    welcome(client)
+    client.send_ops([rect(0)])
+    client.send_ops([rect(1)])
+    client.handle_ops([("SEQ", 1)])
+    client.handle_ops([("SEQ", 2)])    # acknowledges rect(0)
+    client.drop_connection("test")
+    client.send_ops([rect(2)])
+
+    client.connect()
+    welcome(client)
+    assert client.context.socket.messages() == [[rect(1)], [rect(2)]]
+    # a snapshot after the reconnect does not hold what was sent again, so that is drawn on top
+    received = []
+    client.on_ops = received.extend
+    client.handle_ops([("SEQ", 3), ("SNAPSHOT", [rect(0)], set())])
+    assert received == [("SNAPSHOT", [rect(0)], set()), rect(1), rect(2)]
+
+def test_an_entry_the_server_got_before_the_connection_dropped_is_not_drawn_twice():
+    room = Room("test")
+    client = connected_client()
+    welcome(client)
+    client.send_ops([("OPID",) + client.new_op_id(), rect(0)])
+    # the server applied it, but the connection dropped before the ack arrived
+    room.apply(Message(client.context.socket.messages()[-1]), PROTOCOL_VERSION)
+    client.drop_connection("test")
+
+    client.connect()
+    welcome(client)
+    message = Message(client.context.socket.messages()[-1])
+    ack = room.apply(message, PROTOCOL_VERSION)
+    assert message.ops == [] and len(room.board) == 1
+    assert decode_ops(ack[HEADER_SIZE:]) == [("SEQ", room.board.seq)]     # acknowledged all the same
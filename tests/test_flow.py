@@ -0,0 +1,92 @@
+from flow import TokenBucket, Flow, PACE_MS, DECIMATE_LOAD
+from framing import HEADER_SIZE
+from protocol import Message, PROTOCOL_VERSION, decode_ops
+from rooms import Room
+
+def chunk(stroke_id, start, count=4):
+    points = []
+    for x in range(start, start + count):
+        points += [x, x % 2]
+    return ("STROKE", stroke_id, "#000000", 2, tuple(points))
+
+def test_bucket_refills_up_to_burst():
+    bucket = TokenBucket(10, 5)
+    assert all(bucket.take() for _ in range(5))
+    assert not bucket.take()
+    bucket.refill(bucket.updated + 0.25)
+    assert bucket.take() and bucket.take() and not bucket.take()
+    bucket.refill(bucket.updated + 60)
+    assert bucket.tokens == 5
+
+def test_forced_takes_run_into_bounded_debt():
+    bucket = TokenBucket(10, 5)
+    for _ in range(20):
+        assert bucket.take(force=True)
+    assert bucket.tokens == -5
+
+def test_ops_within_the_limit_pass_unchanged():
+    flow = Flow(100, 10)
+    message = Message([("OPID", 1, 1), ("RECT", 0, 0, 5, 5, "#000000", 2)])
+    admitted, pace = flow.admit(message, now=flow.bucket.updated)
+    assert admitted is message and pace is None
+
+def test_held_chunks_are_merged_and_released_with_strokeend():
+    flow = Flow(1, 2)
+    now = flow.bucket.updated
+    ops = []
+    for n, start in enumerate(range(0, 30, 3)):
+        message = Message(([("OPID", 1, 1)] if n == 0 else []) + [chunk(7, start)])
+        admitted, _ = flow.admit(message, now=now)
+        ops += admitted.ops if admitted else []
+    admitted, _ = flow.admit(Message([("STROKEEND", 7)]), now=now)
+    ops += admitted.ops
+    assert ops[0] == ("OPID", 1, 1) and ops[-1] == ("STROKEEND", 7)
+
+    # the chunks that went out still join up into the whole stroke
+    points = list(ops[1][4])
+    for op in ops[2:-1]:
+        assert op[0] == "STROKE" and tuple(points[-2:]) == op[4][:2]
+        points += op[4][2:]
+    expected = []
+    for start in range(0, 30, 3):
+        expected += list(chunk(7, start)[4])[0 if start == 0 else 2:]
+    assert points == expected
+    assert not flow.held
+
+def test_excess_shapes_are_dropped_but_undo_and_clear_go_through():
+    flow = Flow(1, 2)
+    now = flow.bucket.updated
+    shapes = [("RECT", n, 0, n + 5, 5, "#000000", 2) for n in range(5)]
+    admitted, _ = flow.admit(Message(shapes + [("UNDO",), ("CLEAR",)]), now=now)
+    assert admitted.ops == shapes[:2] + [("UNDO",), ("CLEAR",)]
+    assert flow.dropped == 3
+    assert flow.rejected == [(None, shape) for shape in shapes[2:]]
+
+def test_dropped_shapes_are_taken_back_off_their_senders_screen():
+    room = Room("test")
+    flow = Flow(1, 1)
+    shapes = [("RECT", n, 0, n + 5, 5, "#000000", 2) for n in range(2)]
+    flow.admit(Message([("OPID", 3, 1), shapes[0], ("OPID", 3, 2), shapes[1]]), now=flow.bucket.updated)
+    assert flow.rejected == [(("OPID", 3, 2), shapes[1])]
+    frame = room.reject_frame(PROTOCOL_VERSION, flow.rejected)
+    assert decode_ops(frame[HEADER_SIZE:]) == [("UNDO", 3, 2)]
+    # without an id to undo by the sender gets the board again
+    room.apply(Message([shapes[0]]), PROTOCOL_VERSION)
+    frame = room.reject_frame(PROTOCOL_VERSION, [(None, shapes[1])])
+    assert decode_ops(frame[HEADER_SIZE:])[1][0] == "SNAPSHOT"
+
+def test_pace_is_asked_for_under_load_and_lifted_after():
+    flow = Flow(100, 100)
+    now = flow.bucket.updated
+    _, pace = flow.admit(Message([("CLEAR",)]), load=0.9, now=now)
+    assert pace == PACE_MS
+    _, pace = flow.admit(Message([("CLEAR",)]), load=0.9, now=now)
+    assert pace is None     # only sent when it changes
+    _, pace = flow.admit(Message([("CLEAR",)]), load=0.0, now=now)
+    assert pace == 0
+
+def test_chunks_are_simplified_under_load():
+    flow = Flow(100, 100)
+    straight = ("STROKE", 1, "#000000", 2, tuple(v for x in range(20) for v in (x, 0)))
+    admitted, _ = flow.admit(Message([straight]), load=DECIMATE_LOAD, now=flow.bucket.updated)
+    assert admitted.ops == [("STROKE", 1, "#000000", 2, (0, 0, 19, 0))]
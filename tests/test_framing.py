@@ -0,0 +1,40 @@
+import pytest
+from framing import FrameReader, encode_frame, HEADER_SIZE
+from protocol import Message, decode_ops
+
+# A socket that hands out what was sent in pieces of at most chunk bytes, as TLS often does
+class TricklingSocket:
+    def __init__(self, data, chunk):
+        self.data = memoryview(data)
+        self.chunk = chunk
+        self.calls = 0
+
+    def recv_into(self, buffer, size):
+        self.calls += 1
+        count = min(size, self.chunk, len(self.data))
+        buffer[:count] = self.data[:count]
+        self.data = self.data[count:]
+        return count
+
+def test_frames_arrive_whole_across_partial_reads():
+    payloads = [b"a" * 10, b"", b"bc" * 1000]
+    sock = TricklingSocket(b"".join(encode_frame(payload) for payload in payloads), chunk=3)
+    reader = FrameReader(sock, buffer_size=16)
+    assert [bytes(reader.read_frame()) for _ in payloads] == payloads
+    assert reader.read_frame() is None
+    assert sock.calls > 2000 // 3
+
+def test_connection_closed_in_the_middle_of_a_frame():
+    reader = FrameReader(TricklingSocket(encode_frame(b"hello")[:-2], chunk=4))
+    with pytest.raises(ConnectionError):
+        reader.read_frame()
+
+def test_large_text_payload():
+    text = "ü" * 30000 + "end"
+    op = ("TEXT", 1, 2, "#000000", text)
+    message = Message([op])
+    frame = message.frame(10)
+    assert message.frame(10) is frame     # encoded once, however many peers get it
+    reader = FrameReader(TricklingSocket(frame, chunk=1000))
+    assert decode_ops(reader.read_frame()) == [op]
+    assert len(frame) > 60000 + HEADER_SIZE
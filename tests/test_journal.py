@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+from board import Board
+from framing import encode_frame
+from journal import Journal, journal_path, checkpoint_path, read_journal
+
+def rect(n):
+    return ("RECT", n, 0, n + 10, 10, "#000000", 2)
+
+def journaled_board(directory, **options):
+    board = Board()
+    journal = Journal(str(directory), **options)
+    journal.restore(board)
+    return board, journal
+
+def test_restore_replays_the_journal(tmp_path):
+    board, journal = journaled_board(tmp_path)
+    for n in range(5):
+        board.apply(rect(n), (1, n))
+    board.apply(("UNDO", 1, 2))
+    board.apply(("STROKE", 3, "#000000", 2, (0, 0, 5, 5)), (1, 9))
+    journal.close()
+
+    restored, journal = journaled_board(tmp_path)
+    assert restored.snapshot(ids=True)[2:] == board.snapshot(ids=True)[2:]
+    journal.close()
+
+def test_restore_cuts_off_a_torn_record(tmp_path):
+    board, journal = journaled_board(tmp_path)
+    for n in range(3):
+        board.apply(rect(n), (1, n))
+    journal.close()
+    path = journal_path(str(tmp_path), 0)
+    intact = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b"\x00\x00\x00\x20\x02\x00")    # a crash in the middle of the next record
+
+    restored, journal = journaled_board(tmp_path)
+    assert restored.history() == [rect(n) for n in range(3)]
+    assert os.path.getsize(path) == intact
+    # appending carries on from the intact part
+    restored.apply(rect(3), (1, 3))
+    journal.close()
+    ops, length = read_journal(path)
+    assert ops[-2:] == [("OPID", 1, 3), rect(3)] and length == os.path.getsize(path)
+
+def test_restore_skips_a_corrupt_record(tmp_path):
+    board, journal = journaled_board(tmp_path)
+    board.apply(rect(0), (1, 0))
+    journal.close()
+    with open(journal_path(str(tmp_path), 0), "ab") as f:
+        f.write(encode_frame(b"\x02\x00\x01"))     # whole, but a RECT cut short
+    board, journal = journaled_board(tmp_path)
+    board.apply(rect(1), (1, 1))
+    journal.close()
+
+    restored, journal = journaled_board(tmp_path)
+    assert restored.history() == [rect(0), rect(1)]
+    journal.close()
+
+def test_restore_from_a_checkpoint(tmp_path):
+    board, journal = journaled_board(tmp_path, checkpoint_every=4)
+    for n in range(10):
+        board.apply(rect(n), (1, n))
+    journal.close()
+    # checkpoints are written in the background, wait for the last one
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and not os.path.exists(checkpoint_path(str(tmp_path), journal.generation)):
+        time.sleep(0.01)
+    assert os.path.exists(checkpoint_path(str(tmp_path), journal.generation))
+
+    restored, journal = journaled_board(tmp_path)
+    assert restored.snapshot(ids=True)[2] == board.snapshot(ids=True)[2]
+    journal.close()
+
+def test_restore_after_a_plain_undo_took_a_segment_off_a_line_run(tmp_path):
+    board, journal = journaled_board(tmp_path)
+    for n in range(3):
+        board.apply(("LINE", n * 10, 0, n * 10 + 10, 0, "#000000", 2))
+    board.apply(("UNDO",))
+    journal.close()
+
+    restored, journal = journaled_board(tmp_path)
+    assert len(board) == 1
+    assert restored.snapshot(ids=True)[2:] == board.snapshot(ids=True)[2:]
+    journal.close()
+
+def test_appends_do_not_wait_for_fsync(tmp_path, monkeypatch):
+    board, journal = journaled_board(tmp_path, fsync_interval=0.01)
+    syncing = threading.Event()
+    def slow_fsync(fd):
+        syncing.set()
+        time.sleep(0.5)
+    monkeypatch.setattr(os, "fsync", slow_fsync)
+    board.apply(rect(0), (1, 0))
+    assert syncing.wait(2)
+    started = time.monotonic()
+    board.apply(rect(1), (1, 1))
+    assert time.monotonic() - started < 0.25
+    monkeypatch.undo()
+    journal.close()
@@ -0,0 +1,101 @@
+import pytest
+from framing import encode_frame, HEADER_SIZE
+from protocol import (Message, encode_op, encode_ops, decode_ops, parse_command, format_command, encode_snapshot,
+                      hello_message, welcome_message, parse_handshake, wants_compression, StreamCompressor,
+                      StreamDecompressor, coalesce_payloads, is_compressed, STREAM_MAX_FRAME)
+
+OPS = [
+    ("LINE", 1, 2, 3, 4, "#ff0000", 2),
+    ("RECT", -5, -6, 300, 400, "#00ff00", 10),
+    ("CIRC", 50, 60, 25, "#0000ff", 1),
+    ("TEXT", 10, 20, "#123456", "héllo wörld"),
+    ("UNDO",),
+    ("CLEAR",),
+    ("UNDO", 12345, 7),
+    ("OPID", 0xFFFFFFFF, 1),
+    ("STROKE", 42, "#abcdef", 3, (0, 0, 5, -3, 1000, 200, -32768, 32767)),
+    ("STROKEEND", 42),
+    ("SEQ", 123456789),
+    ("PACE", 200),
+    ("VIEW", -100000, -5, 100000, 5),
+]
+
+@pytest.mark.parametrize("op", OPS, ids=lambda op: op[0])
+def test_binary_round_trip(op):
+    assert decode_ops(encode_op(op)) == [op]
+
+def test_several_ops_round_trip():
+    assert decode_ops(encode_ops(OPS)) == OPS
+
+@pytest.mark.parametrize("op", [op for op in OPS if op[0] != "TEXT"], ids=lambda op: op[0])
+def test_text_round_trip(op):
+    assert parse_command(format_command(op)) == op
+
+def test_text_keeps_spaces():
+    op = ("TEXT", 1, 2, "black", "two  words here")
+    assert parse_command(format_command(op)) == op
+
+@pytest.mark.parametrize("op", [
+    ("LINE", 0, 0, 40000, 0, "#000000", 2),     # outside int16
+    ("RECT", 0, 0, 1, 1, "red", 2),             # named colour
+    ("STROKE", 1, "#000000", 300, (0, 0, 1, 1)),    # width over a byte
+])
+def test_ops_without_binary_form(op):
+    assert encode_op(op) is None
+    assert encode_ops([("CLEAR",), op]) is None
+
+def test_unknown_opcode():
+    with pytest.raises(ValueError):
+        decode_ops(b"\x1f")
+
+def test_snapshot_round_trip():
+    board = [op for op in OPS if op[0] in ("OPID", "LINE", "RECT", "CIRC", "TEXT", "STROKE")]
+    [(cmd, ops, open_ids)] = decode_ops(encode_snapshot(board, [42]))
+    assert (cmd, ops, open_ids) == ("SNAPSHOT", board, {42})
+
+def test_snapshot_falls_back_to_text():
+    board = [("RECT", 0, 0, 1, 1, "red", 2)]
+    [(_, ops, _)] = decode_ops(encode_snapshot(board))
+    assert ops == board
+
+def test_handshake():
+    hello = hello_message("abcd", 17, "maths", (0, -10, 800, 600), compress=True)
+    assert parse_handshake(hello)[1:] == ("abcd", 17, "maths", (0, -10, 800, 600))
+    assert wants_compression(hello)
+    assert not wants_compression(hello_message())
+    assert wants_compression(welcome_message(10, "abcd", compress=True))
+    assert not wants_compression(welcome_message(9, "abcd", compress=True))
+    assert parse_handshake("WELCOME 5 abcd 17")[1:3] == ("abcd", 17)
+    assert parse_handshake("HELLO x")[0] == 1
+
+def test_stream_compression_round_trip():
+    compressor, decompressor = StreamCompressor(), StreamDecompressor()
+    payloads = [encode_op(op) for op in OPS] * 20
+    received = []
+    for start in range(0, len(payloads), 7):
+        for frame in compressor.pack([encode_frame(payload) for payload in payloads[start:start + 7]]):
+            payload = frame[HEADER_SIZE:]
+            assert is_compressed(payload)
+            received += decompressor.payloads(payload)
+    assert received == payloads
+
+def test_stream_compression_passes_big_frames_through():
+    big = encode_frame(b"\x06" * (STREAM_MAX_FRAME + 1))
+    small = encode_frame(encode_op(("CLEAR",)))
+    packed = StreamCompressor().pack([small, big, small])
+    assert len(packed) == 3 and packed[1] is big
+    decompressor = StreamDecompressor()
+    assert decompressor.payloads(packed[0][HEADER_SIZE:]) == [encode_op(("CLEAR",))]
+    assert decompressor.payloads(packed[2][HEADER_SIZE:]) == [encode_op(("CLEAR",))]
+
+def test_coalesce_payloads():
+    merged = coalesce_payloads([encode_op(("CLEAR",)), encode_op(("UNDO",)), b"LINE 0 0 1 1 red", b"UNDO"])
+    assert merged == [encode_op(("CLEAR",)) + encode_op(("UNDO",)), b"LINE 0 0 1 1 red\nUNDO"]
+
+def test_message_frames_for_old_clients():
+    stroke = ("STROKE", 1, "#000000", 2, (0, 0, 10, 0, 10, 10))
+    message = Message([("OPID", 5, 1), stroke, ("STROKEEND", 1)], seq=9)
+    assert decode_ops(message.frame(10)[HEADER_SIZE:]) == [("SEQ", 9)] + message.ops
+    assert decode_ops(message.frame(5)[HEADER_SIZE:]) == [("SEQ", 9), stroke, ("STROKEEND", 1)]
+    assert message.frame(1)[HEADER_SIZE:] == b"LINE 0 0 10 0 #000000 2\nLINE 10 0 10 10 #000000 2"
+    assert Message([("STROKEEND", 1)]).frame(1) is None
@@ -0,0 +1,53 @@
+from PIL import Image, ImageDraw, ImageChops
+from raster import TileCache, draw_op
+
+def composed(cache, size):
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    for key in cache.keys((0, 0, size - 1, size - 1)):
+        tile = cache.tile(key)
+        if tile is not None:
+            image.paste(tile, (key[0] * cache.tile_size, key[1] * cache.tile_size))
+    return image
+
+def test_tiles_match_drawing_the_ops_directly():
+    cache = TileCache(tile_size=64)
+    ops = [("RECT", 10, 10, 150, 90, "#ff0000", 3), ("CIRC", 100, 100, 60, "#0000ff", 2),
+           ("LINE", 0, 190, 190, 0, "#00ff00", 4), ("STROKE", 1, "#000000", 2, [5, 5, 60, 120, 180, 30])]
+    for n, op in enumerate(ops):
+        cache.add(op, (1, n))
+    cache.remove((1, 1))
+
+    expected = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+    for op in ops[:1] + ops[2:]:
+        draw_op(ImageDraw.Draw(expected), op)
+    assert ImageChops.difference(composed(cache, 256), expected).getbbox() is None
+
+def test_only_tiles_with_something_on_them_are_drawn():
+    cache = TileCache()
+    cache.set_zoom(8)
+    cache.add(("RECT", 0, 0, 40000, 40000, "#000000", 2))
+    middle = cache.keys((160000, 160000, 161000, 160700))
+    assert all(cache.tile(key) is None for key in middle)
+    assert cache.tile((0, 0)) is not None
+
+def test_tile_count_is_bounded():
+    cache = TileCache(tile_size=16, max_tiles=10)
+    cache.add(("LINE", 0, 0, 1000, 0, "#000000", 2))
+    for column in range(60):
+        cache.tile((column, 0))
+    assert len(cache.tiles) == 10
+
+def test_oldest_ops_are_dropped_past_the_limit():
+    cache = TileCache(max_ops=3)
+    for n in range(5):
+        cache.add(("RECT", n, n, n + 5, n + 5, "#000000", 1), (1, n))
+    assert len(cache) == 3
+    assert cache.remove((1, 0)) is None and cache.remove((1, 4)) is not None
+
+def test_undo_of_the_newest_op_redraws_what_was_under_it():
+    cache = TileCache(tile_size=64)
+    cache.add(("RECT", 10, 10, 50, 50, "#000000", 2))
+    before = composed(cache, 64)
+    cache.add(("LINE", 0, 0, 63, 63, "#ff0000", 3))
+    assert cache.pop() == {(0, 0)}
+    assert ImageChops.difference(composed(cache, 64), before).getbbox() is None
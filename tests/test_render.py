@@ -0,0 +1,29 @@
+import io
+from PIL import Image
+import render
+from protocol import Message, PROTOCOL_VERSION
+from rooms import Room
+
+def export_size(renderer):
+    return Image.open(io.BytesIO(renderer.png())).size
+
+def test_big_boards_are_exported_scaled_down_to_the_pixel_budget(monkeypatch):
+    monkeypatch.setattr(render, "MAX_EXPORT_PIXELS", 500 * 500)
+    room = Room("render-test")
+    room.apply(Message([("RECT", 0, 0, 100, 100, "#000000", 2)]), PROTOCOL_VERSION)
+    renderer = render.BoardRenderer(room.name, room.board)
+    small = export_size(renderer)
+    assert 100 <= small[0] < 500 and small[0] == small[1]
+
+    room.apply(Message([("RECT", 1900, 900, 1999, 999, "#ff0000", 2)]), PROTOCOL_VERSION)
+    width, height = export_size(renderer)
+    assert width * height <= 500 * 500 and round(width / height) == 2
+
+def test_export_is_kept_until_the_board_changes():
+    room = Room("render-test")
+    room.apply(Message([("CIRC", 50, 50, 20, "#0000ff", 2)]), PROTOCOL_VERSION)
+    renderer = render.BoardRenderer(room.name, room.board)
+    png = renderer.png()
+    assert renderer.png() is png
+    room.apply(Message([("UNDO",)]), PROTOCOL_VERSION)
+    assert renderer.png() is not png
@@ -0,0 +1,54 @@
+from framing import HEADER_SIZE
+from protocol import PROTOCOL_VERSION, Message, decode_ops
+from rooms import Room
+from spatial import Interest
+
+def rect(x, y):
+    return ("RECT", x, y, x + 10, y + 10, "#000000", 2)
+
+def room_with(ops):
+    room = Room("test")
+    for op in ops:
+        room.apply(Message([op]), PROTOCOL_VERSION)
+    return room
+
+def test_resume_with_a_view_sends_only_the_missed_ops_in_it():
+    room = room_with([rect(0, 0)])
+    last_seq = room.board.seq
+    room.apply(Message([rect(20, 20)]), PROTOCOL_VERSION)
+    room.apply(Message([rect(5000, 5000)]), PROTOCOL_VERSION)
+    room.apply(Message([("UNDO",)]), PROTOCOL_VERSION)
+
+    interest = Interest()
+    welcome, frame = room.join_frames(PROTOCOL_VERSION, room.board.epoch, last_seq, interest, (100, 100, -100, -100))
+    ops = decode_ops(frame[HEADER_SIZE:])
+    assert ops[0] == ("SEQ", room.board.seq)
+    assert [op for op in ops if op[0] == "RECT"] == [rect(20, 20)]
+    # which entry an UNDO took back is not known when replaying, so the client gets to ignore it
+    assert [op[0] for op in ops].count("UNDO") == 1
+    assert interest.view == (-100, -100, 100, 100)
+
+def test_resume_with_a_view_falls_back_to_a_snapshot_of_it():
+    room = room_with([rect(0, 0), rect(5000, 5000)])
+    interest = Interest()
+    welcome, frame = room.join_frames(PROTOCOL_VERSION, "another", 0, interest, (-100, -100, 100, 100))
+    ops = decode_ops(frame[HEADER_SIZE:])
+    assert ops[0] == ("SEQ", room.board.seq)
+    assert ops[1][0] == "SNAPSHOT"
+    assert rect(0, 0) in ops[1][1] and rect(5000, 5000) not in ops[1][1]
+
+def test_only_the_client_that_drew_an_entry_can_undo_it_by_id():
+    room = Room("test")
+    alice, bob = object(), object()
+    room.apply(room.claim_authors(Message([("OPID", 7, 1), rect(0, 0)]), alice), PROTOCOL_VERSION)
+
+    assert room.claim_authors(Message([("UNDO", 7, 1)]), bob).ops == []
+    assert room.claim_authors(Message([("UNDO", 0, 1)]), alice).ops == []
+    # ops of other nodes were checked there
+    assert room.claim_authors(Message([("UNDO", 7, 1)]), None).ops == [("UNDO", 7, 1)]
+    room.apply(room.claim_authors(Message([("UNDO", 7, 1)]), alice), PROTOCOL_VERSION)
+    assert len(room.board) == 0
+
+    # once alice is gone her author id is free for her next connection
+    room.leave(alice)
+    assert room.claim_authors(Message([("UNDO", 7, 1)]), bob).ops == [("UNDO", 7, 1)]
@@ -0,0 +1,55 @@
+import pytest
+import ssl_server
+from ssl_server import AsyncClient
+from framing import HEADER_SIZE, encode_frame
+from protocol import Message, decode_ops
+
+class FakeWriter:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+def rect_frame(n):
+    return Message([("RECT", n, 0, n + 5, 5, "#000000", 2)]).frame(10)
+
+@pytest.fixture
+def slow_client(monkeypatch):
+    monkeypatch.setattr(ssl_server, "SEND_QUEUE_SIZE", 4)
+    return AsyncClient(None, FakeWriter(), "slow")
+
+def fill(client, count):
+    for n in range(count):
+        client.enqueue(rect_frame(n))
+
+def test_drop_policy_drops_what_does_not_fit(slow_client, monkeypatch):
+    monkeypatch.setattr(ssl_server, "SLOW_CONSUMER_POLICY", "drop")
+    fill(slow_client, 6)
+    assert list(slow_client.queue) == [rect_frame(n) for n in range(4)]
+    assert slow_client.dropped == 2 and not slow_client.closed
+    slow_client.enqueue(rect_frame(9), force=True)    # replies to the client itself always go out
+    assert len(slow_client.queue) == 5
+
+def test_coalesce_policy_folds_the_backlog_into_one_message(slow_client, monkeypatch):
+    monkeypatch.setattr(ssl_server, "SLOW_CONSUMER_POLICY", "coalesce")
+    fill(slow_client, 6)
+    ops = [op for frame in slow_client.queue for op in decode_ops(frame[HEADER_SIZE:])]
+    assert ops == [("RECT", n, 0, n + 5, 5, "#000000", 2) for n in range(6)]
+    assert len(slow_client.queue) < 6 and slow_client.dropped == 0
+
+def test_coalesce_policy_keeps_text_and_binary_apart(slow_client, monkeypatch):
+    monkeypatch.setattr(ssl_server, "SLOW_CONSUMER_POLICY", "coalesce")
+    for frame in (encode_frame("LINE 0 0 1 1 #000000 2"), encode_frame("LINE 1 1 2 2 #000000 2"),
+                  rect_frame(0), rect_frame(1), encode_frame("CLEAR")):
+        slow_client.enqueue(frame)
+    assert [frame[HEADER_SIZE:] for frame in slow_client.queue] == [
+        b"LINE 0 0 1 1 #000000 2\nLINE 1 1 2 2 #000000 2", rect_frame(0)[HEADER_SIZE:] + rect_frame(1)[HEADER_SIZE:],
+        b"CLEAR"]
+
+def test_disconnect_policy_closes_the_slow_client(slow_client, monkeypatch):
+    monkeypatch.setattr(ssl_server, "SLOW_CONSUMER_POLICY", "disconnect")
+    fill(slow_client, 5)
+    assert slow_client.closed and slow_client.writer.closed
+    slow_client.enqueue(rect_frame(9))
+    assert len(slow_client.queue) == 4